@@ -8,42 +8,20 @@ import cv2
 import numpy as np
 import imutils
 import argparse
-import itertools
 import tf2_ros as tf2
 import tf
-from collections import defaultdict
 from std_msgs.msg import String
 from sensor_msgs.msg import Image
 from sensor_msgs.msg import CameraInfo
 from geometry_msgs.msg import Pose, PoseArray, TransformStamped
 from cv_bridge import CvBridge, CvBridgeError
-import cv2.aruco as aruco
 
 import utils
-
-# Names of each possible ArUco tag OpenCV supports
-ARUCO_DICT = {
-    "DICT_4X4_50": aruco.DICT_4X4_50,
-    "DICT_4X4_100": aruco.DICT_4X4_100,
-    "DICT_4X4_250": aruco.DICT_4X4_250,
-    "DICT_4X4_1000": aruco.DICT_4X4_1000,
-    "DICT_5X5_50": aruco.DICT_5X5_50,
-    "DICT_5X5_100": aruco.DICT_5X5_100,
-    "DICT_5X5_250": aruco.DICT_5X5_250,
-    "DICT_5X5_1000": aruco.DICT_5X5_1000,
-    "DICT_6X6_50": aruco.DICT_6X6_50,
-    "DICT_6X6_100": aruco.DICT_6X6_100,
-    "DICT_6X6_250": aruco.DICT_6X6_250,
-    "DICT_6X6_1000": aruco.DICT_6X6_1000,
-    "DICT_7X7_50": aruco.DICT_7X7_50,
-    "DICT_7X7_100": aruco.DICT_7X7_100,
-    "DICT_7X7_250": aruco.DICT_7X7_250,
-    "DICT_7X7_1000": aruco.DICT_7X7_1000,
-    "DICT_ARUCO_ORIGINAL": aruco.DICT_ARUCO_ORIGINAL,
-    "DICT_APRILTAG_16h5": aruco.DICT_APRILTAG_16h5,
-    "DICT_APRILTAG_25h9": aruco.DICT_APRILTAG_25h9,
-    "DICT_APRILTAG_36h10": aruco.DICT_APRILTAG_36h10,
-    "DICT_APRILTAG_36h11": aruco.DICT_APRILTAG_36h11}
+import aruco_detector
+import calibration
+import camera_model
+import image_io
+import image_renderer
 
 
 class ArucoCalibrate(object):
@@ -58,19 +36,34 @@ class ArucoCalibrate(object):
         self.camera_info_topic = kwargs["camera_info_topic"]
         self.camera_frame_id = kwargs["camera_frame_id"]
 
-        #--- Used when finding transforms between markers ----#
-        self.marker_transforms_list = []  # Transformations between markers
-        self.marker_id_list = []  # Ids of markers
-        self.marker_updates_list = []
-        #-----------------------------------------------------#
+        # Dictionary and detector parameters are built once
+        self.detector = aruco_detector.ArucoDetector(
+            self.marker_type, self.marker_size, kwargs.get("aruco_detector_profile", "default"))
+
+        # Transforms between markers seen together
+        self.estimator = calibration.PairwiseTransformEstimator()
 
         #---- Markers detected at each camera frame ----#
-        self.marker_pose_list = PoseArray()  # Poses of markers in camera frame
-        self.detected_ids = []  # Coresponding detected ids
+        self.marker_trans = np.zeros((0, 3))  # Positions of markers in camera frame
+        self.marker_quats = np.zeros((0, 4))  # Orientations of markers in camera frame
+        self.detected_ids = np.zeros(0, dtype=int)  # Coresponding detected ids
+        # (marker_trans, marker_quats, detected_ids), replaced as a whole by img_cb
+        self.detections = (self.marker_trans, self.marker_quats, self.detected_ids)
+        self.frame_count = 0  # Number of processed frames
+        self.used_frame_count = 0  # Frame count find_transforms last used
         #----------------------------------------------#
 
+        #---- Camera model, set by info_cb ----#
+        self.camera_models = camera_model.CameraModelCache(max_size=1)
+        self.camera_model = None
+        self.K = None
+        self.D = None
+        #--------------------------------------#
+
         # ROS Publisher
-        self.aruco_pub = rospy.Publisher("aruco_img", Image, queue_size=10)
+        self.image_publisher = image_renderer.AnnotatedImagePublisher(
+            self.detector, "aruco_img",
+            kwargs.get("aruco_img_rate", 0.0), kwargs.get("aruco_img_scale", 1.0))
         self.tf_brodcaster = tf2.TransformBroadcaster()
         self.tf_static_brodcaster = tf2.StaticTransformBroadcaster()
 
@@ -121,23 +114,25 @@ class ArucoCalibrate(object):
         Args:
             msg {Image}: The image message.
         ----------
-            self.markers_img: An image with drawn markers.
-            self.marker_pose_list {PoseArray}: A list of poses of the markers in the camera frame.
-            self.detected_ids {list}: A corresponding list to self.marker_pose_list, containing the detected ids.
+            self.marker_trans {np.array}: (N,3) positions of the markers in the camera frame.
+            self.marker_quats {np.array}: (N,4) orientations of the markers in the camera frame.
+            self.detected_ids {np.array}: (N,) the corresponding detected ids.
         """
 
         try:
             self.color_msg = msg
-            self.color_img = self.bridge.imgmsg_to_cv2(self.color_msg, "bgr8")
+            frame = image_io.ImageFrame(self.color_msg, self.bridge)
 
         except CvBridgeError as e:
-            print(e)
+            rospy.logerr(e)
+            return
 
-        markers_img, marker_pose_list, id_list = self.detect_aruco(
-            self.color_img)
-        self.merkers_img = markers_img
-        self.marker_pose_list = marker_pose_list
+        marker_trans, marker_quats, id_list = self.detect_aruco(frame)
+        self.marker_trans = marker_trans
+        self.marker_quats = marker_quats
         self.detected_ids = id_list
+        self.detections = (marker_trans, marker_quats, id_list)
+        self.frame_count += 1
 
     def info_cb(self, msg):
         """
@@ -146,313 +141,107 @@ class ArucoCalibrate(object):
         Args:
             msg {CameraInfo}: The camera information message.
         ----------
+            self.camera_model {CameraModel}: The cached camera model.
             self.K {numpy.array}: The camera matrix.
             self.D {numpy.array}: The distortion coefficients.
         """
-        self.K = np.reshape(msg.K, (3, 3))    # Camera matrix
-        # Distortion matrix. 5 for IntelRealsense, 8 for AzureKinect
-        self.D = np.array(msg.D)
+        # The model is only rebuilt when the intrinsics change
+        model = self.camera_models.get(msg)
+        if model is not self.camera_model:
+            self.camera_model = model
+            self.K, self.D = model.K, model.D
 
-    def detect_aruco(self, img, broadcast_markers_tf=True):
+    def detect_aruco(self, frame, broadcast_markers_tf=True):
         """
-        Given an RDB image detect aruco markers. 
+        Given an image detect aruco markers. 
         ----------
         Args:
-            img -- RBG image
+            frame {ImageFrame} -- The camera image
         ----------
         Returns:
-            image_with_aruco -- image with aruco markers
-            marker_pose_list {PoseArray} -- list of poses of the detected markers
-            id_list {list} -- list of detected ids
+            marker_trans {np.array} -- (N,3) positions of the detected markers
+            marker_quats {np.array} -- (N,4) orientations of the detected markers
+            id_list {np.array} -- (N,) detected ids
         """
-
-        # Create parameters for marker detection
-        aruco_dict = aruco.Dictionary_get(ARUCO_DICT[self.marker_type])
-        parameters = aruco.DetectorParameters_create()
-
-        parameters.minCornerDistanceRate = 0.02
-        parameters.minMarkerDistanceRate = 0.02
-        parameters.cornerRefinementMethod = aruco.CORNER_REFINE_CONTOUR
-
         # Detect aruco markers
-        corners, ids, rejected = aruco.detectMarkers(
-            img, aruco_dict, parameters=parameters)
+        corners, ids, rejected = self.detector.detect(frame.gray)
+        cameraMatrix = self.K
+        distCoeffs = self.D
 
-        marker_pose_list = PoseArray()
-        id_list = []
         if len(corners) > 0:
-            markerLength = self.marker_size
-            cameraMatrix = self.K
-            distCoeffs = self.D
-            output_img = img.copy()
-
-            # For numerous markers:
-            for i, marker_id in enumerate(ids):
-                # Draw bounding box on the marker
-                img = aruco.drawDetectedMarkers(img, [corners[i]], marker_id)
+            # All markers are estimated in one call
+            marker_trans, marker_quats, rvecs = self.detector.estimate_marker_poses(
+                corners, cameraMatrix, distCoeffs)
+            id_list = np.reshape(ids, -1).astype(int)
 
-                rvec, tvec, _ = aruco.estimatePoseSingleMarkers(
-                    [corners[i]], markerLength, cameraMatrix, distCoeffs)
-                output_img = aruco.drawAxis(
-                    img, cameraMatrix, distCoeffs, rvec, tvec, 0.05)
-
-                # Convert its pose to Pose.msg format in order to publish
-                marker_pose = self.make_pose(rvec, tvec)
-
-                if broadcast_markers_tf == True:
+            if broadcast_markers_tf == True:
+                for i, marker_id in enumerate(id_list):
                     tf_marker = TransformStamped()
                     tf_marker.header.stamp = rospy.Time.now()
                     tf_marker.header.frame_id = self.camera_frame_id
                     tf_marker.child_frame_id = "marker_{}".format(marker_id)
+                    marker_pose = utils.quat_trans_to_pose(marker_trans[i], marker_quats[i])
                     tf_marker.transform.translation = marker_pose.position
                     tf_marker.transform.rotation = marker_pose.orientation
                     self.tf_brodcaster.sendTransform(tf_marker)
 
-                marker_pose_list.poses.append(marker_pose)
-                id_list.append(int(marker_id))
-
-            output_img = aruco.drawDetectedMarkers(
-                img, rejected, borderColor=(100, 0, 240))
-
         else:
-            output_img = img
+            marker_trans = np.zeros((0, 3))
+            marker_quats = np.zeros((0, 4))
+            id_list = np.zeros(0, dtype=int)
+            rvecs = np.zeros((0, 3))
 
-        out_img = Image()
-        out_img = self.bridge.cv2_to_imgmsg(output_img, "bgr8")
-        self.aruco_pub.publish(out_img)
+        # Drawing happens on the render worker, only while someone is subscribed
+        self.image_publisher.submit(
+            frame, corners, ids, rejected, rvecs, marker_trans, cameraMatrix, distCoeffs)
 
-        return output_img, marker_pose_list, id_list
-
-    def make_pose(self, rvec, tvec):
-        """
-        Given a rotation vector and a translation vector, returns a Pose.
-        ----------
-        Args:
-            rvec {np.array} -- rotation vector of the marker
-            tvec {np.array} -- translation vector of the marker
-        ----------
-        Returns:
-            Pose -- Pose of the marker
-        """
-        marker_pose = Pose()
-        tvec = np.squeeze(tvec)
-        rvec = np.squeeze(rvec)
-
-        r_mat = np.eye(3)
-        cv2.Rodrigues(rvec, r_mat)
-        tf_mat = np.eye(4)
-        tf_mat[0:3, 0:3] = r_mat
-
-        quat = tf.transformations.quaternion_from_matrix(tf_mat)
-
-        marker_pose.position.x = tvec[0]
-        marker_pose.position.y = tvec[1]
-        marker_pose.position.z = tvec[2]
-
-        marker_pose.orientation.x = quat[0]
-        marker_pose.orientation.y = quat[1]
-        marker_pose.orientation.z = quat[2]
-        marker_pose.orientation.w = quat[3]
-
-        return marker_pose
+        return marker_trans, marker_quats, id_list
 
     def find_transforms(self):
         """
         Given the detected markers, find and update the transforms between the markers.
         ----------
-            self.marker_pose_list {PoseArray}: A list of poses of the markers in the camera frame.
-            self.detected_ids {list}: A corresponding list to self.marker_pose_list, containing the detected ids.
+            self.marker_trans {np.array}: (N,3) positions of the markers in the camera frame.
+            self.marker_quats {np.array}: (N,4) orientations of the markers in the camera frame.
+            self.detected_ids {np.array}: (N,) the corresponding detected ids.
         ----------
-            self.marker_transforms_list {list}: A list of transforms between the markers.
-            self.marker_id_list {list}: A list of combination of markers.
-            self.marker_updates_list {list}: How many times each combination has been updated.
+        Returns:
+            bool: False if no new frame was processed since the last call.
         """
-        marker_pose_list = self.marker_pose_list
-        detected_ids = self.detected_ids
-
-        # Get all possible combinations of markers
-        id_index = range(len(detected_ids))
-        pose_combinations = list(itertools.combinations(id_index, 2))
-
-        # For each possible calculation, calculate the transfromation matrix
-        for i, j in pose_combinations:
-            combination = [detected_ids[i], detected_ids[j]]
-            if combination in self.marker_id_list:
-                pose_0 = marker_pose_list.poses[i]
-                pose_1 = marker_pose_list.poses[j]
-            elif combination[::-1] in self.marker_id_list:
-                combination = [detected_ids[j], detected_ids[i]]
-                pose_0 = marker_pose_list.poses[j]
-                pose_1 = marker_pose_list.poses[i]
-            else:
-                pose_0 = marker_pose_list.poses[i]
-                pose_1 = marker_pose_list.poses[j]
-
-            # Find the transform between the two markers
-            tf_matrix_0 = utils.pose_to_matrix(pose_0)
-            tf_matrix_1 = utils.pose_to_matrix(pose_1)
-
-            tf_matrix_0_inv = tf.transformations.inverse_matrix(tf_matrix_0)
-
-            tf_0_to_1 = np.dot(tf_matrix_0_inv, tf_matrix_1)
-
-            trans, rotation = utils.matrix_to_quat_trans(tf_0_to_1)
-
-            # If the transform does not yet exist add it. If it already exists update it with a weighted update.
-            if (combination not in self.marker_id_list) & (combination[::-1] not in self.marker_id_list):
-                self.marker_transforms_list.append(
-                    [np.array(trans), np.array(rotation)])
-                self.marker_id_list.append(combination)
-                self.marker_updates_list.append(1)
-
-            else:
-                combination_idx = self.marker_id_list.index(combination)
-                average_translation = 0.99 * \
-                    self.marker_transforms_list[combination_idx][0] + \
-                    0.01 * np.array(trans)
-                average_rotation = utils.average_quaternions(
-                    [self.marker_transforms_list[combination_idx][1], np.array(rotation)], weights=[0.9, 0.1])
-
-                self.marker_transforms_list[combination_idx][0] = average_translation
-                self.marker_transforms_list[combination_idx][1] = average_rotation
-                self.marker_updates_list[combination_idx] += 1
-        return
+        # Each frame is one sample, counting it twice would understate the variance
+        frame_count = self.frame_count
+        if frame_count == self.used_frame_count:
+            return False
+        self.used_frame_count = frame_count
+        self.estimator.update(*self.detections)
+        return True
 
     def set_transfroms(self, id_main):
         """
         Given the transforms found in the "find_transforms" function, set the transforms between the markers.
-        Shortest "path" between a marker and the main marker is used.
-        The transforms are saved in the "marker_transforms.npz" file.
+        All transforms between marker pairs are combined in one least squares solve of the pose graph,
+        each pair weighted by how many times it was updated.
+        The transforms are saved in the "marker_transforms.npz" file, the statistics of each
+        pair in "marker_transforms_stats.npz".
         ----------
         Args:
             id_main {int}: The id of the main marker.
         ----------
             self.marker_transforms {dict} : A dictionary of transforms between the markers.
         """
-        graph = self.build_graph(self.marker_id_list)
-        paths = {}
-        mk_tf = {}
-        for start in graph.keys():
-            if start == id_main:
-                continue
-            else:
-                paths[start] = self.BFS_SP(graph, start, id_main)
-
-        for marker_id in paths.keys():
-            path = paths[marker_id]
-            path_len = len(path)
-            curr_idx = 0
-            next_idx = 1
-            while next_idx < path_len:
-                combination = [path[curr_idx], path[next_idx]]
-                if combination in self.marker_id_list:
-                    comb_idx = self.marker_id_list.index(combination)
-                    marker_tf = self.marker_transforms_list[comb_idx]
-                    marker_tf_mtx = utils.quat_trans_to_matrix(
-                        marker_tf[0], marker_tf[1])
+        mk_tf = self.estimator.solve(id_main)
 
-                else:
-                    combination = [path[next_idx], path[curr_idx]]
-                    comb_idx = self.marker_id_list.index(combination)
-                    marker_tf = self.marker_transforms_list[comb_idx]
-                    marker_tf_mtx_b = utils.quat_trans_to_matrix(
-                        marker_tf[0], marker_tf[1])
-                    marker_tf_mtx = tf.transformations.inverse_matrix(
-                        marker_tf_mtx_b)
-
-                if marker_id in mk_tf:
-                    mk_tf[marker_id] = np.matmul(
-                        marker_tf_mtx, mk_tf[marker_id])
-                else:
-                    mk_tf[marker_id] = marker_tf_mtx
-                curr_idx = next_idx
-                next_idx += 1
+        unconnected = sorted(self.estimator.marker_ids() - set(mk_tf.keys()) - set([int(id_main)]))
+        if len(unconnected) > 0:
+            rospy.logwarn("Markers {} were never seen together with the main marker (or a marker connected to it)".format(unconnected))
 
         self.marker_transforms = mk_tf
-        np.savez(os.path.join(self.save_dir,
-                 'marker_transforms.npz'), mk_tf_dict=mk_tf)
+        path = calibration.save_marker_transforms(self.save_dir, mk_tf)
+        self.estimator.save_statistics(self.save_dir)
 
-        print("The following transforms were saved:", self.load_marker_transform(
-            os.path.join(self.save_dir, 'marker_transforms.npz')))
+        print("The following transforms were saved:", self.load_marker_transform(path))
         return
 
-    def build_graph(self, edges):
-        """
-        Build a node graph given a list of edges.
-        ----------
-        Args:
-            edges {list}: A list of edges.
-        ----------
-        Returns:
-            graph {dict}: A dictionary of nodes and its neighbors.
-        """
-        graph = defaultdict(list)
-
-        # Loop to iterate over every
-        # edge of the graph
-        for edge in edges:
-            a, b = edge[0], edge[1]
-
-            # Creating the graph
-            # as adjacency list
-            graph[a].append(b)
-            graph[b].append(a)
-        return graph
-
-    def BFS_SP(self, graph, start, goal):
-        """
-        Find the shortest path between two nodes in a graph.
-        ----------
-        Args:
-            graph {dict}: A dictionary of nodes and its neighbors.
-            start {int}: The id of the start node.
-            goal {int}: The id of the goal node.
-        ----------
-        Returns:
-            path {list}: A list of nodes in the shortest path.
-        """
-        explored = []
-
-        # Queue for traversing the
-        # graph in the BFS
-        queue = [[start]]
-
-        # If the desired node is
-        # reached
-        if start == goal:
-            print("Same Node")
-            return None
-
-        # Loop to traverse the graph
-        # with the help of the queue
-        while queue:
-            path = queue.pop(0)
-            node = path[-1]
-
-            # Condition to check if the
-            # current node is not visited
-            if node not in explored:
-                neighbours = graph[node]
-
-                # Loop to iterate over the
-                # neighbours of the node
-                for neighbour in neighbours:
-                    new_path = list(path)
-                    new_path.append(neighbour)
-                    queue.append(new_path)
-
-                    # Condition to check if the
-                    # neighbour node is the goal
-                    if neighbour == goal:
-                        return new_path
-                explored.append(node)
-
-        # Condition when the nodes
-        # are not connected
-        print("So sorry, but a connecting"
-              "path doesn't exist :(")
-        return None
-
 
 def main():
     rospy.loginfo("Starting ArUco calibration")
@@ -460,9 +249,19 @@ def main():
 
     aruco_type = rospy.get_param("~aruco_type", "DICT_6X6_100")
     aruco_length = rospy.get_param("~aruco_length", "0.0489")
+    aruco_detector_profile = rospy.get_param("~aruco_detector_profile", "default")
+    aruco_img_rate = rospy.get_param("~aruco_img_rate", 0.0)
+    aruco_img_scale = rospy.get_param("~aruco_img_scale", 1.0)
     aruco_update_rate = rospy.get_param("~aruco_update_rate", "0.1")
     aruco_main_marker_id = rospy.get_param("~aruco_main_marker_id", "0")
     aruco_save_dir = rospy.get_param("~aruco_save_dir", None)
+    # Calibration stops once every pair on the spanning tree of the main marker is converged
+    calib_translation_std = rospy.get_param("~aruco_calib_translation_std", 0.003)
+    calib_rotation_std = rospy.get_param("~aruco_calib_rotation_std", 0.02)
+    calib_min_samples = rospy.get_param("~aruco_calib_min_samples", 30)
+    calib_min_markers = rospy.get_param("~aruco_calib_min_markers", 0)
+    calib_min_time = rospy.get_param("~aruco_calib_min_time", 10.0)
+    calib_max_time = rospy.get_param("~aruco_calib_max_time", 0.0)
     camera_img_topic = rospy.get_param(
         "~camera_img_topic", "/camera/rgb/image_raw")
     camera_info_topic = rospy.get_param(
@@ -472,6 +271,9 @@ def main():
     params = {
         "aruco_type": aruco_type,
         "aruco_length": aruco_length,
+        "aruco_detector_profile": aruco_detector_profile,
+        "aruco_img_rate": aruco_img_rate,
+        "aruco_img_scale": aruco_img_scale,
         "aruco_update_rate": aruco_update_rate,
         "aruco_main_marker_id": aruco_main_marker_id,
         "camera_img_topic": camera_img_topic,
@@ -495,11 +297,21 @@ def main():
 
         if aruco_find_transform == True:
             aruco_detect.test_camera_tf()
-            if rospy.get_time() - start_time < 60:
-                aruco_detect.find_transforms()
-                print(aruco_detect.detected_ids)
+            # Leaves time to bring every face of the object into view
+            converged = (rospy.get_time() - start_time >= calib_min_time
+                         and aruco_detect.estimator.converged(
+                             aruco_main_marker_id, calib_translation_std**2, calib_rotation_std**2,
+                             calib_min_samples, calib_min_markers))
+            timed_out = calib_max_time > 0 and rospy.get_time() - start_time >= calib_max_time
+            if not converged and not timed_out:
+                if aruco_detect.find_transforms():
+                    print(aruco_detect.detected_ids)
                 rospy.sleep(0.01)
             else:
+                if converged:
+                    rospy.loginfo("Calibration converged after {:.1f} s".format(rospy.get_time() - start_time))
+                else:
+                    rospy.logwarn("Calibration did not converge in {} s".format(calib_max_time))
                 aruco_detect.set_transfroms(aruco_main_marker_id)
                 aruco_find_transform = False
                 rospy.signal_shutdown("Calibration finished successfully")
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+"""
+Calibrate the transforms between markers from a recording instead of a live camera.
+The markers are detected on all cores and every frame is used, in recording order.
+The result is the same marker_transforms.npz aruco_calibrate.py writes.
+
+    python aruco_calibrate_offline.py --images /path/to/frames --camera_info camera.yaml
+    python aruco_calibrate_offline.py --bag calibration.bag --topic /rgb/image_raw --info_topic /rgb/camera_info
+
+The camera info yaml is the format written by camera_calibration (camera_matrix and
+distortion_coefficients). With a bag the first message on --info_topic is used instead.
+"""
+
+from __future__ import print_function
+import argparse
+import collections
+import glob
+import multiprocessing
+import os
+import time
+
+import cv2
+import numpy as np
+import yaml
+
+import aruco_detector
+import calibration
+import image_io
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".pgm")
+
+# Detector of a worker process, set up once by init_worker
+_worker = {}
+
+# Plain copies of bag messages sent to the workers. The message classes rosbag
+# generates at read time can not be unpickled by the workers.
+RawImage = collections.namedtuple("RawImage", ["header", "encoding", "height", "width", "step", "data"])
+CompressedFrame = collections.namedtuple("CompressedFrame", ["data"])
+
+
+def init_worker(aruco_type, aruco_length, profile, camera_matrix, dist_coeffs):
+    # Each process runs single threaded, the pool provides the parallelism
+    cv2.setNumThreads(1)
+    _worker["detector"] = aruco_detector.ArucoDetector(aruco_type, aruco_length, profile)
+    _worker["K"] = camera_matrix
+    _worker["D"] = dist_coeffs
+
+
+def load_gray(source):
+    """
+    Load a frame as a single channel image.
+    ----------
+    Args:
+        source: An image path, a RawImage, a CompressedFrame or a gray image.
+    """
+    if isinstance(source, str):
+        return cv2.imread(source, cv2.IMREAD_GRAYSCALE)
+    if isinstance(source, CompressedFrame):
+        data = np.frombuffer(source.data, dtype=np.uint8)
+        return cv2.imdecode(data, cv2.IMREAD_GRAYSCALE)
+    if isinstance(source, RawImage):
+        return image_io.ImageFrame(source).gray
+    return source
+
+
+def detect_markers(source):
+    """
+    Detect the markers of one frame. Runs in a worker process.
+    ----------
+    Returns:
+        marker_trans {np.array}: (N,3) positions of the markers in the camera frame.
+        marker_quats {np.array}: (N,4) orientations of the markers in the camera frame.
+        id_list {np.array}: (N,) the corresponding detected ids.
+    """
+    img = load_gray(source)
+    if img is None:
+        return np.zeros((0, 3)), np.zeros((0, 4)), np.zeros(0, dtype=int)
+    detector = _worker["detector"]
+    corners, ids, _ = detector.detect(img)
+    if len(corners) == 0:
+        return np.zeros((0, 3)), np.zeros((0, 4)), np.zeros(0, dtype=int)
+    marker_trans, marker_quats, _ = detector.estimate_marker_poses(corners, _worker["K"], _worker["D"])
+    return marker_trans, marker_quats, np.reshape(ids, -1).astype(int)
+
+
+def load_camera_info_yaml(path):
+    """
+    Returns:
+        K {np.array}: The camera matrix.
+        D {np.array}: The distortion coefficients.
+    """
+    with open(path) as f:
+        info = yaml.safe_load(f)
+    K = np.reshape(info["camera_matrix"]["data"], (3, 3)).astype(np.float64)
+    D = np.array(info["distortion_coefficients"]["data"], dtype=np.float64)
+    return K, D
+
+
+def image_folder_frames(folder):
+    paths = sorted(glob.glob(os.path.join(folder, "*")))
+    return [path for path in paths if path.lower().endswith(IMAGE_EXTENSIONS)]
+
+
+def bag_camera_info(bag_path, info_topic):
+    import rosbag
+    with rosbag.Bag(bag_path) as bag:
+        for _, msg, _ in bag.read_messages(topics=[info_topic]):
+            return np.reshape(msg.K, (3, 3)).astype(np.float64), np.array(msg.D, dtype=np.float64)
+    raise ValueError("No camera info on {} in {}".format(info_topic, bag_path))
+
+
+def bag_frames(bag_path, topic):
+    """
+    Yield the images of a bag as objects the worker processes can unpickle: the
+    data of compressed and 8 bit images, other encodings converted to gray here.
+    """
+    import rosbag
+    with rosbag.Bag(bag_path) as bag:
+        for _, msg, _ in bag.read_messages(topics=[topic]):
+            if hasattr(msg, "format"):
+                yield CompressedFrame(bytes(msg.data))
+            elif msg.encoding in image_io.ENCODINGS:
+                yield RawImage(None, msg.encoding, msg.height, msg.width, msg.step, bytes(msg.data))
+            else:
+                yield image_io.ImageFrame(msg).gray
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--images", help="Folder of recorded frames")
+    source.add_argument("--bag", help="Bag file with the recorded frames")
+    parser.add_argument("--topic", default="/camera/rgb/image_raw", help="Image topic in the bag")
+    parser.add_argument("--info_topic", default=None, help="Camera info topic in the bag")
+    parser.add_argument("--camera_info", default=None, help="Camera info yaml file")
+    parser.add_argument("--aruco_type", default="DICT_6X6_100")
+    parser.add_argument("--aruco_length", type=float, default=0.0489)
+    parser.add_argument("--aruco_detector_profile", default="default")
+    parser.add_argument("--aruco_main_marker_id", type=int, default=0)
+    parser.add_argument("--aruco_save_dir", default=".")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    if args.camera_info is not None:
+        K, D = load_camera_info_yaml(args.camera_info)
+    elif args.bag is not None and args.info_topic is not None:
+        K, D = bag_camera_info(args.bag, args.info_topic)
+    else:
+        parser.error("--camera_info, or --info_topic with --bag, is required")
+
+    if args.images is not None:
+        frames = image_folder_frames(args.images)
+    else:
+        frames = bag_frames(args.bag, args.topic)
+
+    start_time = time.time()
+    estimator = calibration.PairwiseTransformEstimator()
+    pool = multiprocessing.Pool(
+        args.processes, init_worker,
+        (args.aruco_type, args.aruco_length, args.aruco_detector_profile, K, D))
+    frame_count = 0
+    # imap keeps the recording order, the estimator updates are order dependent
+    for marker_trans, marker_quats, id_list in pool.imap(detect_markers, frames, chunksize=4):
+        estimator.update(marker_trans, marker_quats, id_list)
+        frame_count += 1
+    pool.close()
+    pool.join()
+
+    mk_tf = estimator.solve(args.aruco_main_marker_id)
+    unconnected = sorted(estimator.marker_ids() - set(mk_tf.keys()) - set([args.aruco_main_marker_id]))
+    if len(unconnected) > 0:
+        print("Markers {} were never seen together with the main marker (or a marker connected to it)".format(unconnected))
+
+    path = calibration.save_marker_transforms(args.aruco_save_dir, mk_tf)
+    estimator.save_statistics(args.aruco_save_dir)
+    print("Calibrated {} markers from {} frames in {:.1f} s, saved to {}".format(
+        len(mk_tf), frame_count, time.time() - start_time, path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,408 @@
+import cv2
+import cv2.aruco as aruco
+import numpy as np
+import tf
+from geometry_msgs.msg import Pose
+
+import utils
+
+# Names of each possible ArUco tag OpenCV supports
+ARUCO_DICT = {
+    "DICT_4X4_50": aruco.DICT_4X4_50,
+    "DICT_4X4_100": aruco.DICT_4X4_100,
+    "DICT_4X4_250": aruco.DICT_4X4_250,
+    "DICT_4X4_1000": aruco.DICT_4X4_1000,
+    "DICT_5X5_50": aruco.DICT_5X5_50,
+    "DICT_5X5_100": aruco.DICT_5X5_100,
+    "DICT_5X5_250": aruco.DICT_5X5_250,
+    "DICT_5X5_1000": aruco.DICT_5X5_1000,
+    "DICT_6X6_50": aruco.DICT_6X6_50,
+    "DICT_6X6_100": aruco.DICT_6X6_100,
+    "DICT_6X6_250": aruco.DICT_6X6_250,
+    "DICT_6X6_1000": aruco.DICT_6X6_1000,
+    "DICT_7X7_50": aruco.DICT_7X7_50,
+    "DICT_7X7_100": aruco.DICT_7X7_100,
+    "DICT_7X7_250": aruco.DICT_7X7_250,
+    "DICT_7X7_1000": aruco.DICT_7X7_1000,
+    "DICT_ARUCO_ORIGINAL": aruco.DICT_ARUCO_ORIGINAL,
+    "DICT_APRILTAG_16h5": aruco.DICT_APRILTAG_16h5,
+    "DICT_APRILTAG_25h9": aruco.DICT_APRILTAG_25h9,
+    "DICT_APRILTAG_36h10": aruco.DICT_APRILTAG_36h10,
+    "DICT_APRILTAG_36h11": aruco.DICT_APRILTAG_36h11}
+
+# Named sets of DetectorParameters fields. "default" matches the values the
+# nodes have always used.
+DETECTOR_PROFILES = {
+    "default": {
+        "minCornerDistanceRate": 0.02,
+        "minMarkerDistanceRate": 0.02,
+        "cornerRefinementMethod": aruco.CORNER_REFINE_CONTOUR,
+    },
+    "fast": {
+        "minCornerDistanceRate": 0.02,
+        "minMarkerDistanceRate": 0.02,
+        "adaptiveThreshWinSizeMin": 5,
+        "adaptiveThreshWinSizeMax": 23,
+        "adaptiveThreshWinSizeStep": 18,
+        "cornerRefinementMethod": aruco.CORNER_REFINE_NONE,
+    },
+    "accurate": {
+        "minCornerDistanceRate": 0.02,
+        "minMarkerDistanceRate": 0.02,
+        "cornerRefinementMethod": aruco.CORNER_REFINE_SUBPIX,
+        "cornerRefinementWinSize": 5,
+        "cornerRefinementMaxIterations": 50,
+        "cornerRefinementMinAccuracy": 0.01,
+    },
+}
+
+
+def marker_corner_points(marker_size):
+    """
+    Corners of a marker in its own frame, in the order detectMarkers returns them
+    (top left, top right, bottom right, bottom left), as estimatePoseSingleMarkers uses them.
+    ----------
+    Returns:
+        np.array: (4,3) corner positions in m.
+    """
+    half = 0.5 * float(marker_size)
+    return np.array([[-half, half, 0.0],
+                     [half, half, 0.0],
+                     [half, -half, 0.0],
+                     [-half, -half, 0.0]])
+
+
+class ArucoDetector(object):
+    def __init__(self, marker_type="DICT_6X6_100", marker_size=0.05, profile="default", **overrides):
+        """
+        Marker detection engine shared by the node, the service and the calibration.
+        The dictionary and the detector parameters are built once and only rebuilt
+        when the configuration changes.
+        ----------
+        Args:
+            marker_type {string}: The type of ArUco marker to detect.
+            marker_size {float}: The size of the ArUco marker in m.
+            profile {string}: Name of the parameter profile in DETECTOR_PROFILES.
+        Keyword Args:
+            Any DetectorParameters field, overriding the value from the profile.
+        """
+        self.marker_size = float(marker_size)
+        self.axis_length = 0.05
+
+        self.marker_type = None
+        self.profile = None
+        self.overrides = None
+        self.aruco_dict = None
+        self.parameters = None
+        self.configure(marker_type, profile, **overrides)
+
+    def configure(self, marker_type=None, profile=None, **overrides):
+        """
+        Update the detector configuration. The dictionary and the parameters are
+        rebuilt only if the requested configuration differs from the current one.
+        ----------
+        Args:
+            marker_type {string}: The type of ArUco marker to detect.
+            profile {string}: Name of the parameter profile in DETECTOR_PROFILES.
+        Keyword Args:
+            Any DetectorParameters field, overriding the value from the profile.
+        """
+        if marker_type is None:
+            marker_type = self.marker_type
+        if profile is None:
+            profile = self.profile
+
+        if marker_type not in ARUCO_DICT:
+            raise ValueError("Unknown ArUco dictionary {}".format(marker_type))
+        if profile not in DETECTOR_PROFILES:
+            raise ValueError("Unknown detector profile {}".format(profile))
+
+        if marker_type != self.marker_type:
+            self.aruco_dict = aruco.Dictionary_get(ARUCO_DICT[marker_type])
+            self.marker_type = marker_type
+
+        if profile != self.profile or overrides != self.overrides:
+            settings = dict(DETECTOR_PROFILES[profile])
+            settings.update(overrides)
+            parameters = aruco.DetectorParameters_create()
+            for name, value in settings.items():
+                setattr(parameters, name, value)
+            self.parameters = parameters
+            self.profile = profile
+            self.overrides = overrides
+
+    def detect(self, img):
+        """
+        Detect aruco markers in an image.
+        ----------
+        Args:
+            img {np.array} -- image
+        ----------
+        Returns:
+            corners {list} -- corners of the detected markers
+            ids {np.array} -- ids of the detected markers
+            rejected {list} -- corners of the rejected candidates
+        """
+        return aruco.detectMarkers(img, self.aruco_dict, parameters=self.parameters)
+
+    def estimate_poses(self, corners, camera_matrix, dist_coeffs):
+        """
+        Estimate the pose of every detected marker in a single call.
+        ----------
+        Args:
+            corners {list} -- corners of the detected markers
+            camera_matrix {np.array} -- camera matrix 3x3
+            dist_coeffs {np.array} -- distortion coefficients (len 4,5,8 or 12)
+        ----------
+        Returns:
+            rvecs {np.array} -- (N,3) rotation vector of each marker
+            tvecs {np.array} -- (N,3) translation vector of each marker
+        """
+        if len(corners) == 0:
+            return np.zeros((0, 3)), np.zeros((0, 3))
+        rvecs, tvecs, _ = aruco.estimatePoseSingleMarkers(
+            corners, self.marker_size, camera_matrix, dist_coeffs)
+        return np.reshape(rvecs, (-1, 3)), np.reshape(tvecs, (-1, 3))
+
+    def estimate_marker_poses(self, corners, camera_matrix, dist_coeffs):
+        """
+        Estimate the pose of every detected marker as stacked translations and quaternions.
+        ----------
+        Args:
+            corners {list} -- corners of the detected markers
+            camera_matrix {np.array} -- camera matrix 3x3
+            dist_coeffs {np.array} -- distortion coefficients (len 4,5,8 or 12)
+        ----------
+        Returns:
+            trans {np.array} -- (N,3) [t_x, t_y, t_z] of each marker
+            quats {np.array} -- (N,4) [q_x, q_y, q_z, q_w] of each marker
+            rvecs {np.array} -- (N,3) rotation vector of each marker
+        """
+        rvecs, tvecs = self.estimate_poses(corners, camera_matrix, dist_coeffs)
+        return tvecs, utils.rvecs_to_quaternions(rvecs), rvecs
+
+    def draw(self, img, corners, ids, rejected, rvecs, tvecs, camera_matrix, dist_coeffs):
+        """
+        Draw the detected markers, their axes and the rejected candidates on the image.
+        ----------
+        Args:
+            img {np.array} -- BGR image, drawn on in place
+            corners, ids, rejected -- output of detect
+            rvecs, tvecs -- output of estimate_poses
+            camera_matrix {np.array} -- camera matrix 3x3
+            dist_coeffs {np.array} -- distortion coefficients
+        ----------
+        Returns:
+            output_img -- image with aruco markers
+        """
+        if len(corners) == 0:
+            return img
+        for i, marker_id in enumerate(ids):
+            img = aruco.drawDetectedMarkers(img, [corners[i]], marker_id)
+            img = aruco.drawAxis(
+                img, camera_matrix, dist_coeffs, rvecs[i], tvecs[i], self.axis_length)
+        return aruco.drawDetectedMarkers(img, rejected, borderColor=(100, 0, 240))
+
+
+class PyramidDetector(object):
+    def __init__(self, detector, factor=2.0, refine_iterations=30, refine_epsilon=0.01):
+        """
+        Finds the markers on a downscaled copy of the image, then refines the corners
+        at full resolution with cornerSubPix.
+        ----------
+        Args:
+            detector {ArucoDetector}: The detector used on the downscaled image.
+            factor {float}: Downscaling factor, e.g. 2 searches a half resolution image.
+            refine_iterations {int}: Maximum cornerSubPix iterations.
+            refine_epsilon {float}: cornerSubPix termination accuracy in pixels.
+        """
+        self.detector = detector
+        self.factor = float(factor)
+        # The window has to cover the error of the upscaled corners
+        self.refine_window = int(np.ceil(self.factor)) + 2
+        self.criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER,
+                         int(refine_iterations), float(refine_epsilon))
+
+    def detect(self, img):
+        """
+        Detect aruco markers. Same interface as ArucoDetector.detect.
+        """
+        if self.factor <= 1.0:
+            return self.detector.detect(img)
+
+        small = cv2.resize(img, None, fx=1.0 / self.factor, fy=1.0 / self.factor,
+                           interpolation=cv2.INTER_AREA)
+        corners, ids, rejected = self.detector.detect(small)
+        corners = [self.upscale(c) for c in corners]
+        rejected = [self.upscale(c) for c in rejected]
+        if len(corners) > 0:
+            corners = self.refine(img, corners)
+        return corners, ids, rejected
+
+    def upscale(self, points):
+        # Pixel centres: x_full + 0.5 = factor * (x_small + 0.5)
+        return (points + 0.5) * self.factor - 0.5
+
+    def refine(self, img, corners):
+        """
+        Refine the corners of each marker on a grayscale crop of the full resolution image.
+        """
+        height, width = img.shape[0:2]
+        margin = 2 * self.refine_window + 2
+        refined = []
+        for marker_corners in corners:
+            points = np.reshape(marker_corners, (4, 2))
+            x0, y0 = np.maximum(np.floor(points.min(axis=0)).astype(int) - margin, 0)
+            x1, y1 = np.minimum(np.ceil(points.max(axis=0)).astype(int) + margin, [width, height])
+            crop = img[y0:y1, x0:x1]
+            if crop.ndim == 3:
+                crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+
+            offset = np.array([x0, y0], dtype=np.float32)
+            local = np.ascontiguousarray(points - offset, dtype=np.float32)
+            cv2.cornerSubPix(crop, local, (self.refine_window, self.refine_window),
+                             (-1, -1), self.criteria)
+            refined.append(np.reshape(local + offset, (1, 4, 2)))
+        return refined
+
+
+class RoiTracker(object):
+    def __init__(self, detector, padding=0.5, min_padding=20, full_scan_interval=10):
+        """
+        Runs the detector only on padded crops around the markers seen in the previous
+        frame. The full frame is scanned every full_scan_interval frames, when there
+        is nothing to track, or when a tracked marker is lost.
+        ----------
+        Args:
+            detector {ArucoDetector}: The detector used on the crops.
+            padding {float}: Padding around each marker, relative to the marker size in pixels.
+            min_padding {int}: Minimum padding around each marker in pixels.
+            full_scan_interval {int}: Number of frames between full frame scans.
+        """
+        self.detector = detector
+        self.padding = float(padding)
+        self.min_padding = int(min_padding)
+        self.full_scan_interval = int(full_scan_interval)
+
+        self.prev_corners = []
+        # Frames since the last full scan, that frame included
+        self.frames_since_full_scan = 0
+
+    def reset(self):
+        self.prev_corners = []
+        self.frames_since_full_scan = 0
+
+    def detect(self, img, hint_corners=None):
+        """
+        Detect aruco markers, scanning only around the expected marker positions when possible.
+        ----------
+        Args:
+            img {np.array} -- image
+            hint_corners {list} -- expected corners of the markers (e.g. the projection
+                of the last object pose). The previous detections are used if None.
+        ----------
+        Returns:
+            corners, ids, rejected -- same as ArucoDetector.detect
+        """
+        if hint_corners is None:
+            hint_corners = self.prev_corners
+
+        if len(hint_corners) == 0 or self.frames_since_full_scan >= self.full_scan_interval:
+            corners, ids, rejected = self.full_scan(img)
+        else:
+            corners, ids, rejected = self.roi_scan(img, hint_corners)
+            if len(corners) < len(hint_corners):
+                # A marker was lost, look for it in the whole image
+                corners, ids, rejected = self.full_scan(img)
+            else:
+                self.frames_since_full_scan += 1
+
+        self.prev_corners = corners
+        return corners, ids, rejected
+
+    def full_scan(self, img):
+        self.frames_since_full_scan = 1
+        return self.detector.detect(img)
+
+    def roi_scan(self, img, hint_corners):
+        height, width = img.shape[0:2]
+        corners = []
+        ids = []
+        rejected = []
+        for x0, y0, x1, y1 in self.regions(hint_corners, width, height):
+            roi_corners, roi_ids, roi_rejected = self.detector.detect(img[y0:y1, x0:x1])
+            offset = np.array([x0, y0], dtype=np.float32)
+            corners.extend(c + offset for c in roi_corners)
+            rejected.extend(c + offset for c in roi_rejected)
+            if roi_ids is not None:
+                ids.append(roi_ids)
+
+        if len(ids) == 0:
+            return corners, None, rejected
+        return corners, np.concatenate(ids), rejected
+
+    def regions(self, hint_corners, width, height):
+        """
+        Padded bounding boxes around the hinted markers, with overlapping boxes merged.
+        ----------
+        Returns:
+            boxes {list}: (x0, y0, x1, y1) pixel boxes clipped to the image.
+        """
+        points = np.reshape(np.array(hint_corners, dtype=np.float64), (-1, 4, 2))
+        lower = points.min(axis=1)
+        upper = points.max(axis=1)
+        pad = np.maximum(self.padding * (upper - lower).max(axis=1), self.min_padding)
+        lower = np.clip(lower - pad[:, np.newaxis], 0, [width, height]).astype(int)
+        upper = np.clip(upper + pad[:, np.newaxis], 0, [width, height]).astype(int)
+        boxes = [list(box) for box in np.hstack([lower, upper])]
+
+        # Merge boxes until none overlap, so each marker is searched only once
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(boxes)):
+                for j in range(i + 1, len(boxes)):
+                    a, b = boxes[i], boxes[j]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        boxes[i] = [min(a[0], b[0]), min(a[1], b[1]),
+                                    max(a[2], b[2]), max(a[3], b[3])]
+                        del boxes[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+        return [box for box in boxes if box[2] > box[0] and box[3] > box[1]]
+
+
+def make_pose(rvec, tvec):
+    """
+    Given a rotation vector and a translation vector, returns a Pose.
+    ----------
+    Args:
+        rvec {np.array} -- rotation vector of the marker
+        tvec {np.array} -- translation vector of the marker
+    ----------
+    Returns:
+        Pose -- Pose of the marker
+    """
+    marker_pose = Pose()
+    tvec = np.squeeze(tvec)
+    rvec = np.squeeze(rvec)
+
+    r_mat = np.eye(3)
+    cv2.Rodrigues(rvec, r_mat)
+    tf_mat = np.eye(4)
+    tf_mat[0:3, 0:3] = r_mat
+
+    quat = tf.transformations.quaternion_from_matrix(tf_mat)
+
+    marker_pose.position.x = tvec[0]
+    marker_pose.position.y = tvec[1]
+    marker_pose.position.z = tvec[2]
+
+    marker_pose.orientation.x = quat[0]
+    marker_pose.orientation.y = quat[1]
+    marker_pose.orientation.z = quat[2]
+    marker_pose.orientation.w = quat[3]
+
+    return marker_pose
@@ -3,8 +3,11 @@
 from logging import raiseExceptions
 from sys import path
 import os 
+import threading
+import time
 import rospy
 import cv2
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import imutils
 import argparse
@@ -17,33 +20,18 @@ from sensor_msgs.msg import Image
 from sensor_msgs.msg import CameraInfo
 from geometry_msgs.msg import Pose, PoseArray, TransformStamped
 from cv_bridge import CvBridge, CvBridgeError
-import cv2.aruco as aruco
 
 import utils
+import aruco_detector
+import camera_model
+import frame_pipeline
+import image_io
+import image_renderer
+import pose_filter
+import tracked_objects
+import transform_reloader
+import transform_table
 
-# Names of each possible ArUco tag OpenCV supports
-ARUCO_DICT = {
-        "DICT_4X4_50": aruco.DICT_4X4_50,
-        "DICT_4X4_100": aruco.DICT_4X4_100,
-        "DICT_4X4_250": aruco.DICT_4X4_250,
-        "DICT_4X4_1000": aruco.DICT_4X4_1000,
-        "DICT_5X5_50": aruco.DICT_5X5_50,
-        "DICT_5X5_100": aruco.DICT_5X5_100,
-        "DICT_5X5_250": aruco.DICT_5X5_250,
-        "DICT_5X5_1000": aruco.DICT_5X5_1000,
-        "DICT_6X6_50": aruco.DICT_6X6_50,
-        "DICT_6X6_100": aruco.DICT_6X6_100,
-        "DICT_6X6_250": aruco.DICT_6X6_250,
-        "DICT_6X6_1000": aruco.DICT_6X6_1000,
-        "DICT_7X7_50": aruco.DICT_7X7_50,
-        "DICT_7X7_100": aruco.DICT_7X7_100,
-        "DICT_7X7_250": aruco.DICT_7X7_250,
-        "DICT_7X7_1000": aruco.DICT_7X7_1000,
-        "DICT_ARUCO_ORIGINAL": aruco.DICT_ARUCO_ORIGINAL,
-        "DICT_APRILTAG_16h5": aruco.DICT_APRILTAG_16h5,
-        "DICT_APRILTAG_25h9": aruco.DICT_APRILTAG_25h9,
-        "DICT_APRILTAG_36h10": aruco.DICT_APRILTAG_36h10,
-        "DICT_APRILTAG_36h11": aruco.DICT_APRILTAG_36h11 }
 
 class ImageConverter(object):
     def __init__(self, **kwargs):
@@ -54,25 +42,89 @@ class ImageConverter(object):
         Keyword Args:
             marker_type {string}: The type of ArUco marker to detect.
             marker_size {float}: The size of the ArUco marker in m.
-            marker_transform_file {string}: The file containing the transformation matrixes between markers and desired pose.
+            aruco_detector_profile {string}: The detector parameter profile (see aruco_detector.DETECTOR_PROFILES).
+            aruco_img_rate {float}: Maximum rate of the annotated aruco_img in Hz. 0 publishes every frame.
+            aruco_img_scale {float}: Scale of the annotated aruco_img relative to the camera image.
+            aruco_pyramid_factor {float}: Find the markers on an image downscaled by this factor and refine the corners at full resolution. 1 disables it.
+            aruco_inlier_translation {float}: Maximum distance in m between candidate object poses averaged together.
+            aruco_inlier_rotation {float}: Maximum rotation in rad between candidate object poses averaged together.
+            aruco_pose_method {string}: "average" averages the poses of the single markers, "pnp" solves the object
+                pose from the corners of all its markers at once, "pnp_ransac" also rejects outlier corners.
+            aruco_pnp_reprojection_error {float}: Maximum reprojection error of a pnp_ransac inlier in pixels.
+            aruco_pnp_warm_start {bool}: Start the PnP solve from the pose of the previous frame.
+            aruco_filter_rate {float}: Publish the object poses predicted by a constant velocity filter at this rate in Hz.
+                0 disables the filter.
+            aruco_filter_acceleration_noise {float}: Filter process noise, linear acceleration std in m/s^2.
+            aruco_filter_angular_acceleration_noise {float}: Filter process noise, angular acceleration std in rad/s^2.
+            aruco_filter_translation_noise {float}: Filter measurement noise, translation std in m.
+            aruco_filter_rotation_noise {float}: Filter measurement noise, rotation std in rad.
+            aruco_filter_timeout {float}: Stop publishing an object this many s after its last detection.
+            aruco_cpu_budget {float}: Skip frames so detection uses at most this share of one core. 0 processes every frame.
+            aruco_max_frame_interval {float}: Longest time between processed frames in s while skipping.
+            aruco_boost_speed {float}: Process every frame while an object moves faster than this in m/s.
+            aruco_boost_angular_speed {float}: Process every frame while an object turns faster than this in rad/s.
+            aruco_boost_duration {float}: How long every frame is processed after fast motion or lost markers in s.
+            aruco_detection_processes {int}: Detect on this many processes instead of one thread. 0 disables it.
+            aruco_detection_max_pixels {int}: Largest image the detection processes take, in pixels.
+            aruco_tracking {bool}: Only scan padded regions around the previously detected markers, moved to
+                where the last (or filtered) object pose projects them.
+            aruco_tracking_padding {float}: Padding of the tracked regions relative to the marker size in pixels.
+            aruco_full_scan_interval {int}: Number of frames between full frame scans while tracking.
+            aruco_transforms {string}: The file containing the transformation matrixes between markers and desired pose.
             aruco_update_rate {float}: The rate at which the ArUco markers are updated.
             aruco_obj_id {string}: The name of the object. A TF frame with that name will be broadcasted.
+            aruco_main_marker_id {int}: The id of the main marker.
+            objects {list}: Several objects tracked from the same detections, one dict with
+                aruco_obj_id, aruco_main_marker_id and aruco_transforms per object. Replaces the three parameters above.
+            aruco_publish_mode {string}: "event" publishes the object pose after every processed frame, "poll" only when update_object_pose is called.
             save_dir {string}: The directory where the marker_transform_file will be saved after callibration.
             camera_img_topic {string}: The topic where the camera image is published.
             camera_info_topic {string}: The topic where the camera info is published.
             camera_frame_id {string}: The frame id of the camera.
+            aruco_img_topic {string}: The topic of the annotated image.
+            detector, marker_tables, tf_brodcaster, tf_buffer, tf_listener, worker_pool:
+                Optional objects shared between the cameras of one node. Created if missing.
+                marker_tables is a {file: MarkerTransformTable} dictionary filled as files are loaded.
         """
         self.bridge = CvBridge()
         # Settings
         self.marker_type = kwargs["aruco_type"]
         self.marker_size = kwargs["aruco_length"]
-        self.marker_transform_file = kwargs["aruco_transforms"]
         self.aruco_update_rate = kwargs["aruco_update_rate"]
-        self.aruco_obj_id = kwargs["aruco_obj_id"]
+        # Candidate object poses further apart are not averaged together
+        self.inlier_translation = kwargs.get("aruco_inlier_translation", 0.02)
+        self.inlier_rotation = kwargs.get("aruco_inlier_rotation", 0.2)
+        self.pose_method = kwargs.get("aruco_pose_method", "average")
+        self.pnp_reprojection_error = kwargs.get("aruco_pnp_reprojection_error", 3.0)
+        self.pnp_warm_start = kwargs.get("aruco_pnp_warm_start", True)
+        self.filter_rate = kwargs.get("aruco_filter_rate", 0.0)
+        self.boost_speed = kwargs.get("aruco_boost_speed", 0.5)
+        self.boost_angular_speed = kwargs.get("aruco_boost_angular_speed", 1.0)
+        self.aruco_publish_mode = kwargs.get("aruco_publish_mode", "poll")
         self.camera_img_topic = kwargs["camera_img_topic"]
         self.camera_info_topic = kwargs["camera_info_topic"]
         self.camera_frame_id = kwargs["camera_frame_id"]
 
+        # Dictionary and detector parameters are built once
+        self.detector = kwargs.get("detector", None)
+        if self.detector is None:
+            self.detector = aruco_detector.ArucoDetector(
+                self.marker_type, self.marker_size, kwargs.get("aruco_detector_profile", "default"))
+        self.marker_finder = self.detector
+        self.tracking = False
+        if kwargs.get("aruco_pyramid_factor", 1.0) > 1.0:
+            self.marker_finder = aruco_detector.PyramidDetector(
+                self.marker_finder, kwargs["aruco_pyramid_factor"])
+        self.detection_processes = kwargs.get("aruco_detection_processes", 0)
+        if kwargs.get("aruco_tracking", False) and self.detection_processes > 0:
+            # Consecutive frames go to different processes, so there is no previous frame to track
+            rospy.logwarn("aruco_tracking is not supported with aruco_detection_processes, disabled.")
+        elif kwargs.get("aruco_tracking", False):
+            self.tracking = True
+            self.marker_finder = aruco_detector.RoiTracker(
+                self.marker_finder,
+                padding=kwargs.get("aruco_tracking_padding", 0.5),
+                full_scan_interval=kwargs.get("aruco_full_scan_interval", 10))
 
         #--- Used when finding transforms between markers ----#
         self.marker_transforms_list = [] # Transformations between markers
@@ -81,29 +133,92 @@ class ImageConverter(object):
         #-----------------------------------------------------#
 
         #---- Markers detected at each camera frame ----#
-        self.marker_pose_list = PoseArray() # Poses of markers in camera frame
-        self.detected_ids = [] # Coresponding detected ids
+        # (marker_trans, marker_quats, detected_ids, corners, stamp) of the last processed frame.
+        # Replaced as a whole so readers never see a half-updated detection.
+        self.detections = (np.zeros((0, 3)), np.zeros((0, 4)), np.zeros(0, dtype=int),
+                           np.zeros((0, 4, 2)), rospy.Time())
+        self.frame_count = 0 # Number of processed frames
+        self.published_frame_count = 0 # Frame count the object pose was last computed for
+        # The detection worker and the poll loop may both update, each frame is used once
+        self.object_pose_lock = threading.Lock()
         #----------------------------------------------#
 
-        #---- Used at prediction time ----#
-        self.obj_transform = Pose()
+        #---- Camera model, set by info_cb ----#
+        self.camera_models = camera_model.CameraModelCache(max_size=1)
+        self.camera_model = None
+        self.K = None
+        self.D = None
+        #--------------------------------------#
 
-        if not self.marker_transform_file is None:
-            try:
-                self.marker_transforms = self.load_marker_transform(self.marker_transform_file)
-            except:
-                ValueError("Invalid marker transform file")
+        #---- Used at prediction time ----#
+        # Objects sharing a file share its table
+        marker_tables = kwargs.get("marker_tables", {})
+        self.objects = []
+        for config in tracked_objects.object_configs(kwargs):
+            marker_transform_file = config["aruco_transforms"]
+            if marker_transform_file not in marker_tables:
+                marker_tables[marker_transform_file] = self.load_marker_transform(marker_transform_file)
+            self.objects.append(tracked_objects.TrackedObject(
+                config["aruco_obj_id"], config["aruco_main_marker_id"],
+                marker_tables[marker_transform_file], marker_transform_file))
+        # Routes each detected marker to its object, detection runs once for all objects
+        self.object_index = tracked_objects.ObjectIndex(self.objects)
+        if self.filter_rate > 0:
+            for tracked_object in self.objects:
+                tracked_object.filter = pose_filter.ConstantVelocityPoseFilter(
+                    kwargs.get("aruco_filter_acceleration_noise", 1.0),
+                    kwargs.get("aruco_filter_angular_acceleration_noise", 2.0),
+                    kwargs.get("aruco_filter_translation_noise", 0.005),
+                    kwargs.get("aruco_filter_rotation_noise", 0.02),
+                    kwargs.get("aruco_filter_timeout", 0.5))
         #--------------------------------#
 
         # ROS Publisher
-        self.aruco_pub = rospy.Publisher("aruco_img", Image, queue_size=10)
-        self.tf_brodcaster = tf2.TransformBroadcaster()
-        self.tf_static_brodcaster = tf2.StaticTransformBroadcaster()
-        self.tf_buffer = tf2.Buffer()
-        self.tf_listener = tf2.TransformListener(self.tf_buffer)
+        self.image_publisher = image_renderer.AnnotatedImagePublisher(
+            self.detector, kwargs.get("aruco_img_topic", "aruco_img"),
+            kwargs.get("aruco_img_rate", 0.0), kwargs.get("aruco_img_scale", 1.0))
+        self.tf_brodcaster = kwargs.get("tf_brodcaster", None)
+        if self.tf_brodcaster is None:
+            self.tf_brodcaster = tf2.TransformBroadcaster()
+        self.tf_buffer = kwargs.get("tf_buffer", None)
+        self.tf_listener = kwargs.get("tf_listener", None)
+        if self.tf_buffer is None:
+            self.tf_buffer = tf2.Buffer()
+            self.tf_listener = tf2.TransformListener(self.tf_buffer)
+        # Detection runs on its own thread (or the shared pool), always on the newest frame,
+        # or on a pool of processes that handle every frame in order. The processes are
+        # started here, before the subscribers, and not from a callback thread.
+        self.process_pool = None
+        if self.detection_processes > 0:
+            self.process_pool = frame_pipeline.ProcessDetectionPool(
+                self.detection_processes, self.process_result,
+                (self.marker_type, self.marker_size, kwargs.get("aruco_detector_profile", "default")),
+                kwargs.get("aruco_pyramid_factor", 1.0),
+                slot_size=kwargs.get("aruco_detection_max_pixels", 3840 * 2160))
+            rospy.on_shutdown(self.process_pool.close)
+        else:
+            self.detection_worker = frame_pipeline.DetectionWorker(
+                self.process_frame, "aruco_detection_" + self.camera_frame_id.strip("/"),
+                kwargs.get("worker_pool", None))
+
+        # Frames are skipped in img_cb, before they are converted
+        self.frame_skipper = None
+        if kwargs.get("aruco_cpu_budget", 0.0) > 0 and self.detection_processes > 0:
+            rospy.logwarn("aruco_cpu_budget is not supported with aruco_detection_processes, disabled.")
+        elif kwargs.get("aruco_cpu_budget", 0.0) > 0:
+            self.frame_skipper = frame_pipeline.AdaptiveFrameSkipper(
+                kwargs["aruco_cpu_budget"], kwargs.get("aruco_max_frame_interval", 0.5),
+                kwargs.get("aruco_boost_duration", 1.0))
+
+        # Predicted poses are published independent of the detection rate
+        self.filter_timer = None
+        if self.filter_rate > 0:
+            self.filter_timer = rospy.Timer(rospy.Duration(1.0 / self.filter_rate), self.publish_predictions)
+
         # ROS Subscriber
+        # queue_size=1 with a large buffer keeps rospy from queueing stale images
         self.image_sub = rospy.Subscriber(
-            self.camera_img_topic, Image, self.img_cb)
+            self.camera_img_topic, Image, self.img_cb, queue_size=1, buff_size=2**24)
         self.info_sub = rospy.Subscriber(
             self.camera_info_topic, CameraInfo, self.info_cb)
 
@@ -115,37 +230,101 @@ class ImageConverter(object):
             marker_transform_file {string}: The file containing the marker transforms.
         ----------
         Returns:
-            dict: A dictionary containing the marker transforms.
+            MarkerTransformTable: The marker transforms as an (N,4,4) array with an id lookup.
         """
-        load_unformated = np.load(marker_transform_file, allow_pickle=True)
-        mk_transform = load_unformated['mk_tf_dict'][()]
+        mk_transform = transform_table.load_marker_transforms(marker_transform_file)
         rospy.loginfo(" TF between markers successfully loaded from file.")
         return mk_transform
     
         
     def img_cb(self, msg): # Callback function for image msg
         """
-        Callback when a new image is received.
+        Callback when a new image is received. The image replaces any image that
+        is still waiting for the detection worker.
         ----------
         Args:
             msg {Image}: The image message.
-        ----------
-            self.markers_img: An image with drawn markers.
-            self.marker_pose_list {PoseArray}: A list of poses of the markers in the camera frame.
-            self.detected_ids {list}: A corresponding list to self.marker_pose_list, containing the detected ids.
         """
+        if self.frame_skipper is not None and not self.frame_skipper.accept():
+            return
+        if self.process_pool is None:
+            self.detection_worker.submit(msg)
+            return
+
+        if self.K is None:
+            return
+        try:
+            frame = image_io.ImageFrame(msg, self.bridge)
+        except CvBridgeError as e:
+            print(e)
+            return
+        # Only the single channel image is copied into shared memory
+        self.process_pool.submit(frame.gray, msg.header, self.K, self.D, frame)
 
+    def process_frame(self, msg):
+        """
+        Detect the markers in an image message. Runs on the detection worker thread.
+        ----------
+        Args:
+            msg {Image}: The image message.
+        ----------
+            self.detections {tuple}: (marker_trans, marker_quats, detected_ids, corners, stamp) of the markers in the camera frame.
+        """
         try:
             self.color_msg = msg
-            self.color_img = self.bridge.imgmsg_to_cv2(self.color_msg,"bgr8")
+            frame = image_io.ImageFrame(self.color_msg, self.bridge)
 
         except CvBridgeError as e:
             print(e)
-            
-        markers_img, marker_pose_list, id_list = self.detect_aruco(self.color_img)
-        self.merkers_img = markers_img
-        self.marker_pose_list = marker_pose_list
-        self.detected_ids = id_list
+            return
+
+        start_time = time.time()
+        detections = self.detect_aruco(frame)
+        if self.frame_skipper is not None:
+            self.frame_skipper.record(time.time() - start_time)
+        self.store_detections(detections + (msg.header.stamp,))
+
+    def process_result(self, header, detections, frame):
+        """
+        Take the markers detected by the process pool. Called in the order the frames arrived.
+        ----------
+        Args:
+            header {Header}: The header of the image message.
+            detections {tuple}: (corners, ids, rejected, marker_trans, marker_quats, rvecs).
+            frame {ImageFrame}: The image the markers were detected in.
+        """
+        corners, ids, rejected, marker_trans, marker_quats, rvecs = detections
+        self.image_publisher.submit(
+            frame, corners, ids, rejected, rvecs, marker_trans, self.K, self.D)
+
+        id_list = np.zeros(0, dtype=int) if ids is None else np.reshape(ids, -1).astype(int)
+        self.store_detections(
+            (marker_trans, marker_quats, id_list, np.reshape(corners, (-1, 4, 2)), header.stamp))
+
+    def store_detections(self, detections):
+        """
+        Store the detections of a processed frame and publish the object pose in event mode.
+        With the filter every frame is folded in, the filter timer publishes the poses.
+        While tracking every frame is used, the next frame is searched around the new pose, and
+        while skipping frames the motion is checked on every frame, so skipping stops in time.
+        """
+        self.detections = detections
+        self.frame_count += 1
+
+        if (self.aruco_publish_mode == "event" or self.filter_rate > 0 or self.tracking
+                or self.frame_skipper is not None):
+            self.update_object_pose()
+
+    def update_object_pose(self):
+        """
+        Compute and broadcast the object pose if a new frame was processed since the last call.
+        """
+        with self.object_pose_lock:
+            frame_count = self.frame_count
+            if frame_count == self.published_frame_count:
+                return
+            self.published_frame_count = frame_count
+            self.calculate_transforms()
 
 
     def info_cb(self, msg):
@@ -155,244 +334,466 @@ class ImageConverter(object):
         Args:
             msg {CameraInfo}: The camera information message.
         ----------
+            self.camera_model {CameraModel}: The cached camera model.
             self.K {numpy.array}: The camera matrix.
             self.D {numpy.array}: The distortion coefficients.
         """
-        self.K = np.reshape(msg.K,(3,3))    # Camera matrix
-        self.D = np.array(msg.D) # Distortion matrix. 5 for IntelRealsense, 8 for AzureKinect
+        # The model is only rebuilt when the intrinsics change
+        model = self.camera_models.get(msg)
+        if model is not self.camera_model:
+            self.camera_model = model
+            self.K, self.D = model.K, model.D
 
-    def detect_aruco(self, img, broadcast_markers_tf=False):
+    def detect_aruco(self, frame, broadcast_markers_tf=False):
         """
-        Given an RDB image detect aruco markers. 
+        Given an image detect aruco markers. 
         ----------
         Args:
-            img -- RBG image
+            frame {ImageFrame} -- The camera image
         ----------
         Returns:
-            image_with_aruco -- image with aruco markers
-            marker_pose_list {PoseArray} -- list of poses of the detected markers
-            id_list {list} -- list of detected ids
+            marker_trans {np.array} -- (N,3) positions of the detected markers, None if not estimated
+            marker_quats {np.array} -- (N,4) orientations of the detected markers, None if not estimated
+            id_list {np.array} -- (N,) detected ids
+            corners {np.array} -- (N,4,2) corners of the detected markers
         """
-      
-        # Create parameters for marker detection
-        aruco_dict = aruco.Dictionary_get(ARUCO_DICT[self.marker_type])
-        parameters = aruco.DetectorParameters_create()
-
-        parameters.minCornerDistanceRate = 0.02
-        parameters.minMarkerDistanceRate = 0.02
-        parameters.cornerRefinementMethod = aruco.CORNER_REFINE_CONTOUR
-
         # Detect aruco markers
-        corners, ids, rejected = aruco.detectMarkers(img, aruco_dict, parameters = parameters)
-               
-        marker_pose_list = PoseArray()
-        id_list = []
-        if len(corners) > 0:
-            markerLength = self.marker_size
+        if self.tracking:
+            corners, ids, rejected = self.marker_finder.detect(
+                frame.gray, self.predicted_corners(frame.header.stamp))
+        else:
+            corners, ids, rejected = self.marker_finder.detect(frame.gray)
+
+        # The PnP methods only need the corners, single marker poses are only for the image and TF
+        estimate_markers = (self.pose_method == "average" or broadcast_markers_tf
+                            or self.image_publisher.wants_frame())
+        if len(corners) > 0 and not estimate_markers:
+            marker_trans, marker_quats, rvecs = None, None, None
+            id_list = np.reshape(ids, -1).astype(int)
+        elif len(corners) > 0:
             cameraMatrix = self.K 
             distCoeffs   = self.D
-            output_img = img.copy()
-
-            # For numerous markers:
-            for i, marker_id in enumerate(ids):
-                # Draw bounding box on the marker
-                img = aruco.drawDetectedMarkers(img, [corners[i]], marker_id)
-                
-                rvec,tvec,_ = aruco.estimatePoseSingleMarkers([corners[i]],markerLength, cameraMatrix, distCoeffs) 
-                output_img = aruco.drawAxis(img, cameraMatrix, distCoeffs, rvec, tvec, 0.05)
-                
-                # Convert its pose to Pose.msg format in order to publish
-                marker_pose = self.make_pose(rvec, tvec)
-
-                if broadcast_markers_tf == True:
+
+            # All markers are estimated in one call
+            marker_trans, marker_quats, rvecs = self.detector.estimate_marker_poses(
+                corners, cameraMatrix, distCoeffs)
+            id_list = np.reshape(ids, -1).astype(int)
+
+            if broadcast_markers_tf == True:
+                for i, marker_id in enumerate(id_list):
                     tf_marker = TransformStamped()
                     tf_marker.header.stamp = rospy.Time.now()
                     tf_marker.header.frame_id = self.camera_frame_id
                     tf_marker.child_frame_id = "marker_{}".format(marker_id)
+                    marker_pose = utils.quat_trans_to_pose(marker_trans[i], marker_quats[i])
                     tf_marker.transform.translation = marker_pose.position
                     tf_marker.transform.rotation = marker_pose.orientation
                     self.tf_brodcaster.sendTransform(tf_marker)
 
-                marker_pose_list.poses.append(marker_pose)
-                id_list.append(int(marker_id))
-
-            output_img = aruco.drawDetectedMarkers(
-                img, rejected, borderColor=(100, 0, 240))
-
         else:
-            output_img = img
-
-        out_img = Image()
-        out_img = self.bridge.cv2_to_imgmsg(output_img, "bgr8")
-        self.aruco_pub.publish(out_img)
+            marker_trans = np.zeros((0, 3))
+            marker_quats = np.zeros((0, 4))
+            id_list = np.zeros(0, dtype=int)
+            rvecs = np.zeros((0, 3))
+
+        # Drawing happens on the render worker, only while someone is subscribed
+        if rvecs is not None:
+            self.image_publisher.submit(
+                frame, corners, ids, rejected, rvecs, marker_trans, self.K, self.D)
     
-        return output_img, marker_pose_list, id_list
+        return marker_trans, marker_quats, id_list, np.reshape(corners, (-1, 4, 2))
 
-    def make_pose(self, rvec, tvec):
+    def predicted_corners(self, stamp):
         """
-        Given a rotation vector and a translation vector, returns a Pose.
+        Where the markers of the previous frame are expected in the new frame: the markers of
+        objects with a known pose are moved to the projection of the pose (predicted by the
+        filter for stamp, or the last estimated pose), the others keep their previous corners.
         ----------
         Args:
-            id {int} -- id of the marker
-            rvec {np.array} -- rotation vector of the marker
-            tvec {np.array} -- translation vector of the marker
+            stamp {Time} -- Stamp of the new image
         ----------
         Returns:
-            Pose -- Pose of the marker
+            np.array -- (N,4,2) expected corners, None if no marker was seen in the previous frame
         """
-        marker_pose = Pose()
-        tvec = np.squeeze(tvec)
-        rvec = np.squeeze(rvec)
-
-        r_mat = np.eye(3)
-        cv2.Rodrigues(rvec, r_mat)
-        tf_mat = np.eye(4)
-        tf_mat[0:3,0:3] = r_mat
-
-        quat = tf.transformations.quaternion_from_matrix(tf_mat)
-
-        marker_pose.position.x = tvec[0]
-        marker_pose.position.y = tvec[1]
-        marker_pose.position.z = tvec[2]
-
-        marker_pose.orientation.x = quat[0]
-        marker_pose.orientation.y = quat[1]
-        marker_pose.orientation.z = quat[2]
-        marker_pose.orientation.w = quat[3]
+        _, _, detected_ids, corners, _ = self.detections
+        if len(detected_ids) == 0:
+            return None
+        hint_corners = np.array(corners, dtype=np.float64)
+        if self.K is None:
+            return hint_corners
+        if stamp.secs == 0 and stamp.nsecs == 0:
+            stamp = rospy.Time.now()
+
+        groups, _ = self.object_index.split(detected_ids)
+        for tracked_object, mask in groups:
+            if tracked_object.filter is not None:
+                trans, rot = tracked_object.filter.predict(stamp.to_sec())
+            elif tracked_object.last_measurement is not None:
+                trans, rot = tracked_object.last_measurement[1:3]
+            else:
+                continue
+            if rot is None:
+                continue
+            ids, points = tracked_object.object_points(self.marker_size)
+            marker_ids = detected_ids[mask]
+            rows = np.minimum(np.searchsorted(ids, marker_ids), len(ids) - 1)
+            known = ids[rows] == marker_ids
+            object_points = points[rows[known]].reshape(-1, 3)
+            rotation = utils.quaternions_to_matrices(rot)[0]
+            if np.any(np.dot(object_points, rotation[2]) + trans[2] <= 0):
+                # Behind the camera, projectPoints would mirror the corners
+                continue
+            projected, _ = cv2.projectPoints(
+                object_points, utils.quaternions_to_rvecs(rot)[0], np.asarray(trans, dtype=np.float64),
+                self.K, self.D)
+            hint_corners[np.flatnonzero(mask)[known]] = projected.reshape(-1, 4, 2)
+        return hint_corners
 
-        return marker_pose
+    def calculate_transforms(self):
+        """
+        Split the detected markers between the objects and calculate the pose of each
+        object with a detected marker.
+        """
+        marker_trans, marker_quats, detected_ids, corners, stamp = self.detections
+        if stamp.secs == 0 and stamp.nsecs == 0:
+            stamp = rospy.Time.now()
+        try:
+            # Only rebuilt after a reload replaced a table
+            self.object_index.refresh()
+        except ValueError as e:
+            rospy.logerr("Keeping the previous marker to object index: {}".format(e))
+
+        groups, unknown = self.object_index.split(detected_ids)
+        if np.any(unknown):
+            rospy.logwarn(
+                "Unknown marker ID detected {}".format(detected_ids[unknown].tolist()))
+        seen = set()
+        for tracked_object, mask in groups:
+            seen.add(id(tracked_object))
+            if self.pose_method == "average":
+                self.calculate_transform(
+                    tracked_object, marker_trans[mask], marker_quats[mask], detected_ids[mask], stamp)
+            else:
+                self.calculate_transform_pnp(tracked_object, corners[mask], detected_ids[mask], stamp)
+        for tracked_object in self.objects:
+            if id(tracked_object) not in seen:
+                # Lost objects restart the PnP solve from scratch
+                tracked_object.pnp_guess = None
+                if self.frame_skipper is not None and tracked_object.last_measurement is not None:
+                    self.frame_skipper.boost()
+                tracked_object.last_measurement = None
+
+    def calculate_transform(self, tracked_object, marker_trans, marker_quats, detected_ids, stamp):
+        """
+        Given transforms of the detected markers of an object calculate the pose of the object.
+        ----------
+        Args:
+            tracked_object {TrackedObject} -- The object
+            marker_trans {np.array} -- (N,3) positions of its detected markers
+            marker_quats {np.array} -- (N,4) orientations of its detected markers
+            detected_ids {np.array} -- (N,) ids of its detected markers
+            stamp {Time} -- Stamp of the image
+        """
+        # Read once, a reload swaps in a new table between frames
+        marker_transforms = tracked_object.marker_transforms
+
+        # Map every visible marker to a candidate object pose at once
+        transforms_trans, transforms_rot, known = marker_transforms.object_candidates(
+            tracked_object.main_marker_id, detected_ids, marker_trans, marker_quats)
+
+        # The main marker is trusted when two markers disagree
+        avg_trans, avg_rot, inliers = utils.average_object_candidates(
+            transforms_trans, transforms_rot, self.inlier_translation, self.inlier_rotation,
+            detected_ids[known] == tracked_object.main_marker_id)
+        if avg_rot is None:
+            return
+        if not np.all(inliers):
+            rospy.logdebug("Outlier markers {}".format(detected_ids[known][~inliers].tolist()))
+        self.check_motion(tracked_object, avg_trans, avg_rot, stamp, len(detected_ids))
+        self.broadcast_object_pose(tracked_object, avg_trans, avg_rot, stamp)
 
+    def calculate_transform_pnp(self, tracked_object, corners, detected_ids, stamp):
+        """
+        Given the corners of the detected markers of an object calculate the pose of the object
+        with one PnP solve over all corners.
+        ----------
+        Args:
+            tracked_object {TrackedObject} -- The object
+            corners {np.array} -- (N,4,2) corners of its detected markers
+            detected_ids {np.array} -- (N,) ids of its detected markers
+            stamp {Time} -- Stamp of the image
+        """
+        if self.K is None:
+            return
+        trans, rot, inliers = tracked_object.estimate_pose(
+            detected_ids, corners, self.marker_size, self.K, self.D,
+            ransac=self.pose_method == "pnp_ransac",
+            reprojection_error=self.pnp_reprojection_error, warm_start=self.pnp_warm_start)
+        if rot is None:
+            return
+        if not np.all(inliers):
+            rospy.logdebug("Outlier markers {}".format(detected_ids[~inliers].tolist()))
+        self.check_motion(tracked_object, trans, rot, stamp, len(detected_ids))
+        self.broadcast_object_pose(tracked_object, trans, rot, stamp)
 
-    def calculate_transform(self, id_main):
+    def check_motion(self, tracked_object, trans, rot, stamp, marker_count):
         """
-        Given transforms of all detected markers calculate the pose of the object.
+        Process every frame for a while if the object moves fast or some of its markers
+        were lost since the previous frame.
         ----------
         Args:
-            id_main {int} -- id of the main marker
+            tracked_object {TrackedObject} -- The object
+            trans {np.array} -- (3,) estimated position of the object
+            rot {np.array} -- (4,) estimated orientation of the object
+            stamp {Time} -- Stamp of the image
+            marker_count {int} -- Number of detected markers of the object
+        """
+        last_measurement = tracked_object.last_measurement
+        # Also the pose projected by predicted_corners
+        tracked_object.last_measurement = (stamp.to_sec(), trans, rot, marker_count)
+        if self.frame_skipper is None or last_measurement is None:
+            return
+        last_stamp, last_trans, last_rot, last_marker_count = last_measurement
+        dt = stamp.to_sec() - last_stamp
+        if marker_count < last_marker_count:
+            self.frame_skipper.boost()
+        elif dt > 0:
+            rotation = tf.transformations.quaternion_multiply(
+                rot, tf.transformations.quaternion_inverse(last_rot))
+            speed = np.linalg.norm(trans - last_trans) / dt
+            angular_speed = np.linalg.norm(utils.quaternions_to_rvecs(rotation)) / dt
+            if speed > self.boost_speed or angular_speed > self.boost_angular_speed:
+                self.frame_skipper.boost()
+
+    def broadcast_object_pose(self, tracked_object, avg_trans, avg_rot, stamp):
+        """
+        Smooth the estimated pose of an object with aruco_update_rate and broadcast it.
+        With the filter enabled the pose is only folded into the filter.
         ----------
-        Returns:
-            Pose -- Estimated pose of the object
-        """
-        marker_pose_list, detected_ids = self.marker_pose_list, self.detected_ids
-        transforms_rot = []
-        transforms_trans = []
-        for i, marker_id in enumerate(detected_ids):
-            
-            trans, rot = utils.pose_to_quat_trans(marker_pose_list.poses[i])
-            
-            if marker_id == id_main:
-                transforms_rot.append(rot)
-                transforms_trans.append(trans)
-                continue
-            else:
-                if not marker_id in self.marker_transforms:
-                    rospy.logwarn(
-                        "Unknown marker ID detected {}".format(marker_id))
-                    continue
-                tf_matrix = utils.quat_trans_to_matrix(trans, rot)
-                full_tf = np.dot(
-                    tf_matrix, self.marker_transforms[marker_id])
-                trans, rot= utils.matrix_to_quat_trans(full_tf)
-                transforms_rot.append(rot)
-                transforms_trans.append(trans)
-
-        transforms_rot = np.array(transforms_rot)
-        transforms_trans = np.array(transforms_trans)
-
-        if len(transforms_rot) == 0:
+        Args:
+            tracked_object {TrackedObject} -- The object
+            avg_trans {np.array} -- (3,) estimated position of the object
+            avg_rot {np.array} -- (4,) estimated orientation of the object
+            stamp {Time} -- Stamp of the image
+        """
+        if tracked_object.filter is not None:
+            tracked_object.filter.update(stamp.to_sec(), avg_trans, avg_rot)
             return
-        elif len(transforms_rot) > 2:
-            rotation_mtxs = np.array(
-                [tf.transformations.quaternion_matrix(rt) for rt in transforms_rot])
-            z_axis = np.array([0, 0, 1, 1])
-            z_rotated = np.einsum(
-                "ijk,k->ij", rotation_mtxs[:, 0:3, 0:3], z_axis[0:3])
-            z_rotated = np.squeeze(z_rotated)
-            z_rotated_compare = np.dot(z_rotated, z_rotated.T)
-
-            col_avg = np.average(z_rotated_compare, axis=0)
-            outlier = np.argmin(col_avg)
-            
-            transforms_rot = np.delete(transforms_rot, outlier, axis=0)
-            transforms_trans = np.delete(transforms_trans, outlier, axis=0)
-
-        if len(transforms_rot) > 1:
-            transforms_rot = np.array(transforms_rot)
-            transforms_trans = np.array(transforms_trans)
-            
-            avg_rot = utils.average_quaternions(transforms_rot)
-            avg_trans = np.average(transforms_trans, axis=0)
-        else:
-            avg_rot = transforms_rot[0]
-            avg_trans = transforms_trans[0]
-
-        object_tf = TransformStamped()
-        object_tf.header.stamp = rospy.Time.now()
-        object_tf.header.frame_id = self.camera_frame_id
-        object_tf.child_frame_id = self.aruco_obj_id
-        
 
-        
         if self.aruco_update_rate >= 1:
-            self.obj_transform = utils.quat_trans_to_pose(avg_trans, avg_rot)
-            object_tf.transform.translation = self.obj_transform.position
-            object_tf.transform.rotation = self.obj_transform.orientation
-            self.tf_brodcaster.sendTransform(object_tf)
+            tracked_object.obj_transform = utils.quat_trans_to_pose(avg_trans, avg_rot)
+            self.send_object_tf(tracked_object, rospy.Time.now())
             return
         elif self.aruco_update_rate <= 0:
             raise ValueError("Aruco update rate should be between 1 and 0")
         else:
-            trans_old, rot_old = utils.pose_to_quat_trans(self.obj_transform)
+            trans_old, rot_old = utils.pose_to_quat_trans(tracked_object.obj_transform)
 
             trans_final = trans_old * \
                 (1-(self.aruco_update_rate)**2) + \
                 (self.aruco_update_rate)**2*avg_trans
             rot_final = utils.average_quaternions([rot_old, avg_rot], weights = [(1-self.aruco_update_rate), self.aruco_update_rate])
-            self.obj_transform = utils.quat_trans_to_pose(trans_final, rot_final)
-        
-            object_tf.transform.translation = self.obj_transform.position
-            object_tf.transform.rotation = self.obj_transform.orientation
-            self.tf_brodcaster.sendTransform(object_tf)
+            tracked_object.obj_transform = utils.quat_trans_to_pose(trans_final, rot_final)
+            self.send_object_tf(tracked_object, rospy.Time.now())
+
+    def publish_predictions(self, event=None):
+        """
+        Broadcast the pose of each object predicted by its filter for the current time.
+        Runs on the filter timer. Objects not detected recently are not broadcast.
+        """
+        now = rospy.Time.now()
+        for tracked_object in self.objects:
+            trans, rot = tracked_object.filter.predict(now.to_sec())
+            if rot is None:
+                continue
+            tracked_object.obj_transform = utils.quat_trans_to_pose(trans, rot)
+            self.send_object_tf(tracked_object, now)
+
+    def send_object_tf(self, tracked_object, stamp):
+        """
+        Broadcast tracked_object.obj_transform as the TF frame of the object.
+        """
+        object_tf = TransformStamped()
+        object_tf.header.stamp = stamp
+        object_tf.header.frame_id = self.camera_frame_id
+        object_tf.child_frame_id = tracked_object.name
+        object_tf.transform.translation = tracked_object.obj_transform.position
+        object_tf.transform.rotation = tracked_object.obj_transform.orientation
+        self.tf_brodcaster.sendTransform(object_tf)
 
     
 
+def make_camera_pipelines(params, cameras, worker_threads):
+    """
+    Create one detection pipeline per camera in this process. The detector, the
+    marker transforms, the TF objects and the worker pool are shared between them.
+    ----------
+    Args:
+        params {dict}: The node parameters, see ImageConverter.
+        cameras {list}: One dict per camera with camera_img_topic, camera_info_topic and
+            camera_frame_id. Optional: name, aruco_obj_id, objects, aruco_img_topic or any other
+            ImageConverter parameter to override for that camera. The marker type,
+            size and detector profile are shared.
+        worker_threads {int}: Number of threads detecting markers for all cameras.
+    ----------
+    Returns:
+        list: The ImageConverter of each camera.
+    """
+    # One listener fills the buffer shared by all cameras
+    tf_buffer = tf2.Buffer()
+    shared = {
+        "detector": aruco_detector.ArucoDetector(
+            params["aruco_type"], params["aruco_length"], params["aruco_detector_profile"]),
+        "marker_tables": {},
+        "tf_brodcaster": tf2.TransformBroadcaster(),
+        "tf_buffer": tf_buffer,
+        "tf_listener": tf2.TransformListener(tf_buffer),
+        "worker_pool": ThreadPool(worker_threads),
+    }
+
+    converters = []
+    for i, camera in enumerate(cameras):
+        name = camera.get("name", "camera_{}".format(i))
+        camera_params = dict(params)
+        camera_params.update(shared)
+        # Each camera broadcasts its own object frames and annotated image
+        camera_params["aruco_obj_id"] = "{}_{}".format(params["aruco_obj_id"], name)
+        if params.get("objects", None) is not None:
+            camera_params["objects"] = [
+                dict(config, aruco_obj_id="{}_{}".format(config["aruco_obj_id"], name))
+                for config in params["objects"]]
+        camera_params["aruco_img_topic"] = "{}/aruco_img".format(name)
+        camera_params.update(camera)
+        converters.append(ImageConverter(**camera_params))
+    return converters
+
+
 def main():
     rospy.loginfo("Starting ArUco node")
     rospy.init_node('aruco_marker_detect')
 
     aruco_type = rospy.get_param("~aruco_type", "DICT_6X6_100")
     aruco_length = rospy.get_param("~aruco_length", "0.0489")
+    aruco_detector_profile = rospy.get_param("~aruco_detector_profile", "default")
+    aruco_img_rate = rospy.get_param("~aruco_img_rate", 0.0)
+    aruco_img_scale = rospy.get_param("~aruco_img_scale", 1.0)
+    aruco_pyramid_factor = rospy.get_param("~aruco_pyramid_factor", 1.0)
+    aruco_detection_processes = rospy.get_param("~aruco_detection_processes", 0)
+    aruco_detection_max_pixels = rospy.get_param("~aruco_detection_max_pixels", 3840 * 2160)
+    aruco_inlier_translation = rospy.get_param("~aruco_inlier_translation", 0.02)
+    aruco_inlier_rotation = rospy.get_param("~aruco_inlier_rotation", 0.2)
+    aruco_pose_method = rospy.get_param("~aruco_pose_method", "average")
+    aruco_pnp_reprojection_error = rospy.get_param("~aruco_pnp_reprojection_error", 3.0)
+    aruco_pnp_warm_start = rospy.get_param("~aruco_pnp_warm_start", True)
+    aruco_filter_rate = rospy.get_param("~aruco_filter_rate", 0.0)
+    aruco_filter_acceleration_noise = rospy.get_param("~aruco_filter_acceleration_noise", 1.0)
+    aruco_filter_angular_acceleration_noise = rospy.get_param("~aruco_filter_angular_acceleration_noise", 2.0)
+    aruco_filter_translation_noise = rospy.get_param("~aruco_filter_translation_noise", 0.005)
+    aruco_filter_rotation_noise = rospy.get_param("~aruco_filter_rotation_noise", 0.02)
+    aruco_filter_timeout = rospy.get_param("~aruco_filter_timeout", 0.5)
+    aruco_cpu_budget = rospy.get_param("~aruco_cpu_budget", 0.0)
+    aruco_max_frame_interval = rospy.get_param("~aruco_max_frame_interval", 0.5)
+    aruco_boost_speed = rospy.get_param("~aruco_boost_speed", 0.5)
+    aruco_boost_angular_speed = rospy.get_param("~aruco_boost_angular_speed", 1.0)
+    aruco_boost_duration = rospy.get_param("~aruco_boost_duration", 1.0)
+    aruco_tracking = rospy.get_param("~aruco_tracking", False)
+    aruco_tracking_padding = rospy.get_param("~aruco_tracking_padding", 0.5)
+    aruco_full_scan_interval = rospy.get_param("~aruco_full_scan_interval", 10)
     aruco_transforms = rospy.get_param("~aruco_transforms", None)
     aruco_update_rate = rospy.get_param("~aruco_update_rate", "0.1")
     aruco_main_marker_id = rospy.get_param("~aruco_main_marker_id", "0")
     aruco_obj_id = rospy.get_param("~aruco_obj_id", "aruco_obj")
+    aruco_publish_mode = rospy.get_param("~aruco_publish_mode", "poll")
     camera_img_topic = rospy.get_param("~camera_img_topic", "/camera/rgb/image_raw")
     camera_info_topic = rospy.get_param("~camera_info_topic", "/camera/rgb/camera_info")
     camera_frame_id = rospy.get_param("~camera_frame_id", "rgb_camera_link")
+    cameras = rospy.get_param("~cameras", None)
+    objects = rospy.get_param("~objects", None)
+    aruco_transforms_watch_period = rospy.get_param("~aruco_transforms_watch_period", 1.0)
 
     params = {
         "aruco_type": aruco_type,
         "aruco_length": aruco_length,
+        "aruco_detector_profile": aruco_detector_profile,
+        "aruco_img_rate": aruco_img_rate,
+        "aruco_img_scale": aruco_img_scale,
+        "aruco_pyramid_factor": aruco_pyramid_factor,
+        "aruco_detection_processes": aruco_detection_processes,
+        "aruco_detection_max_pixels": aruco_detection_max_pixels,
+        "aruco_inlier_translation": aruco_inlier_translation,
+        "aruco_inlier_rotation": aruco_inlier_rotation,
+        "aruco_pose_method": aruco_pose_method,
+        "aruco_pnp_reprojection_error": aruco_pnp_reprojection_error,
+        "aruco_pnp_warm_start": aruco_pnp_warm_start,
+        "aruco_filter_rate": aruco_filter_rate,
+        "aruco_filter_acceleration_noise": aruco_filter_acceleration_noise,
+        "aruco_filter_angular_acceleration_noise": aruco_filter_angular_acceleration_noise,
+        "aruco_filter_translation_noise": aruco_filter_translation_noise,
+        "aruco_filter_rotation_noise": aruco_filter_rotation_noise,
+        "aruco_filter_timeout": aruco_filter_timeout,
+        "aruco_cpu_budget": aruco_cpu_budget,
+        "aruco_max_frame_interval": aruco_max_frame_interval,
+        "aruco_boost_speed": aruco_boost_speed,
+        "aruco_boost_angular_speed": aruco_boost_angular_speed,
+        "aruco_boost_duration": aruco_boost_duration,
+        "aruco_tracking": aruco_tracking,
+        "aruco_tracking_padding": aruco_tracking_padding,
+        "aruco_full_scan_interval": aruco_full_scan_interval,
         "aruco_transforms": aruco_transforms,
         "aruco_update_rate": aruco_update_rate,
         "aruco_obj_id": aruco_obj_id,
         "aruco_main_marker_id": aruco_main_marker_id,
+        "objects": objects,
+        "aruco_publish_mode": aruco_publish_mode,
         "camera_img_topic": camera_img_topic,
         "camera_info_topic": camera_info_topic,
         "camera_frame_id": camera_frame_id,
     }
 
 
-    if aruco_transforms is None:
+    configs = tracked_objects.object_configs(params)
+    if any(config.get("aruco_transforms", None) is None for config in configs):
         raise ValueError("No marker transforms provided. Shutting Down")
 
-    aruco_detect = ImageConverter(**params)
+    if aruco_publish_mode not in ("poll", "event"):
+        raise ValueError("aruco_publish_mode should be 'poll' or 'event'")
+
+    if aruco_pose_method not in ("average", "pnp", "pnp_ransac"):
+        raise ValueError("aruco_pose_method should be 'average', 'pnp' or 'pnp_ransac'")
+
+    if cameras is None:
+        aruco_detects = [ImageConverter(**params)]
+    else:
+        worker_threads = rospy.get_param("~aruco_worker_threads", len(cameras))
+        aruco_detects = make_camera_pipelines(params, cameras, worker_threads)
+    # Swap in recalibrated transforms without restarting the node, one reloader per file
+    consumers = defaultdict(list)
+    files = []  # (file, name of the first object using it)
+    for aruco_detect in aruco_detects:
+        for tracked_object in aruco_detect.objects:
+            if tracked_object.marker_transform_file not in consumers:
+                files.append((tracked_object.marker_transform_file, tracked_object.name))
+            consumers[tracked_object.marker_transform_file].append(tracked_object)
+    reloaders = []
+    for marker_transform_file, name in files:
+        service_name = "aruco_reload_transforms"
+        if len(files) > 1:
+            service_name = "{}/aruco_reload_transforms".format(name)
+        reloaders.append(transform_reloader.MarkerTransformReloader(
+            marker_transform_file, consumers[marker_transform_file],
+            aruco_transforms_watch_period, service_name))
     start_time = rospy.get_time()
 
+    if aruco_publish_mode == "event":
+        # The detection workers publish the object pose after every frame
+        rospy.spin()
+        return
+
     while not rospy.is_shutdown():
 
         rospy.sleep(0.2)
-        aruco_detect.calculate_transform(aruco_main_marker_id)
+        for aruco_detect in aruco_detects:
+            aruco_detect.update_object_pose()
 
 
 if __name__ == '__main__':
@@ -1,73 +1,116 @@
 #!/usr/bin/env python
 
 from __future__ import print_function
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
 import rospy
 import cv2
 import numpy as np
 import tf2_ros as tf2
 import tf
 from collections import defaultdict
-from std_msgs.msg import String
+from std_msgs.msg import Bool, String
 from sensor_msgs.msg import Image
 from sensor_msgs.msg import CameraInfo
 from geometry_msgs.msg import Pose, PoseArray, TransformStamped
+from std_srvs.srv import Trigger, TriggerResponse
 from cv_bridge import CvBridge, CvBridgeError
 
 from aruco_detect.srv import ArucoPoseEstimate, ArucoPoseEstimateResponse, ArucoPoseEstimateRequest
-
-import cv2.aruco as aruco
+from aruco_detect.srv import ArucoPoseEstimateBatch, ArucoPoseEstimateBatchResponse, ArucoPoseEstimateBatchRequest
+from aruco_detect.srv import ArucoPoseEstimateLatest, ArucoPoseEstimateLatestResponse, ArucoPoseEstimateLatestRequest
 
 import utils
+import aruco_detector
+import camera_model
+import image_io
+import image_renderer
+import result_cache
+import transform_reloader
+import transform_table
 
-# Names of each possible ArUco tag OpenCV supports
-ARUCO_DICT = {
-    "DICT_4X4_50": aruco.DICT_4X4_50,
-    "DICT_4X4_100": aruco.DICT_4X4_100,
-    "DICT_4X4_250": aruco.DICT_4X4_250,
-    "DICT_4X4_1000": aruco.DICT_4X4_1000,
-    "DICT_5X5_50": aruco.DICT_5X5_50,
-    "DICT_5X5_100": aruco.DICT_5X5_100,
-    "DICT_5X5_250": aruco.DICT_5X5_250,
-    "DICT_5X5_1000": aruco.DICT_5X5_1000,
-    "DICT_6X6_50": aruco.DICT_6X6_50,
-    "DICT_6X6_100": aruco.DICT_6X6_100,
-    "DICT_6X6_250": aruco.DICT_6X6_250,
-    "DICT_6X6_1000": aruco.DICT_6X6_1000,
-    "DICT_7X7_50": aruco.DICT_7X7_50,
-    "DICT_7X7_100": aruco.DICT_7X7_100,
-    "DICT_7X7_250": aruco.DICT_7X7_250,
-    "DICT_7X7_1000": aruco.DICT_7X7_1000,
-    "DICT_ARUCO_ORIGINAL": aruco.DICT_ARUCO_ORIGINAL,
-    "DICT_APRILTAG_16h5": aruco.DICT_APRILTAG_16h5,
-    "DICT_APRILTAG_25h9": aruco.DICT_APRILTAG_25h9,
-    "DICT_APRILTAG_36h10": aruco.DICT_APRILTAG_36h10,
-    "DICT_APRILTAG_36h11": aruco.DICT_APRILTAG_36h11}
 
 class ArucoDetection(object):
     def __init__(self, *args, **kwargs):
         """
         Aruco detection class.
+        ----------
+        Keyword Args:
+            camera_img_topic {string}: If set, the latest image of this topic is kept and
+                aruco_pose_estimate_latest answers from it.
+            camera_info_topic {string}: The camera info of camera_img_topic.
+            aruco_latest_timeout {float}: Default time in s to wait for a new enough image.
+            aruco_inlier_translation {float}: Maximum distance in m between candidate object poses averaged together.
+            aruco_inlier_rotation {float}: Maximum rotation in rad between candidate object poses averaged together.
+            aruco_transforms_watch_period {float}: How often the transforms file is checked for changes in s. 0 disables it.
+            aruco_cache_size {int}: Number of estimated poses kept per image. 0 disables the cache.
+            aruco_cache_hash {bool}: Also key the cache on a hash of the image data.
         """
         # CvBridge to convert ROS image to OpenCV image
         self.bridge = CvBridge()
+        # Models of the cameras in the requests, rebuilt only when their intrinsics change
+        self.camera_models = camera_model.CameraModelCache()
 
         # Get params
         self.marker_transform_file = kwargs.get('aruco_transforms', None)
         self.marker_type = kwargs.get('aruco_type', 'DICT_6X6_100')
         self.marker_size = kwargs.get('aruco_length', 0.05)
         self.main_marker_id = kwargs.get('main_marker_id', 0)
-
-        # Create the service
+        # Candidate object poses further apart are not averaged together
+        self.inlier_translation = kwargs.get('aruco_inlier_translation', 0.02)
+        self.inlier_rotation = kwargs.get('aruco_inlier_rotation', 0.2)
+        self.detector_profile = kwargs.get('aruco_detector_profile', 'default')
+
+        # Dictionary and detector parameters are built once
+        self.detector = aruco_detector.ArucoDetector(
+            self.marker_type, self.marker_size, self.detector_profile)
+        self.marker_finder = self.detector
+        if kwargs.get('aruco_pyramid_factor', 1.0) > 1.0:
+            self.marker_finder = aruco_detector.PyramidDetector(
+                self.detector, kwargs['aruco_pyramid_factor'])
+
+        # Poses of recently requested images, keyed by their header
+        self.result_cache = result_cache.PoseResultCache(
+            kwargs.get('aruco_cache_size', 32), kwargs.get('aruco_cache_hash', False))
+
+        # Images of a batch request are processed in parallel
+        self.batch_pool = ThreadPool(
+            kwargs.get('aruco_batch_threads', 0) or multiprocessing.cpu_count())
+
+        # Create the services
         self.pose_estimate_srv = rospy.Service('aruco_pose_estimate',
                                 ArucoPoseEstimate, self.estimate_pose_cb)
+        self.pose_estimate_batch_srv = rospy.Service('aruco_pose_estimate_batch',
+                                ArucoPoseEstimateBatch, self.estimate_pose_batch_cb)
+        self.cache_stats_srv = rospy.Service('aruco_pose_cache_stats',
+                                Trigger, self.cache_stats_cb)
+
+        #---- Latest live frame, when subscribed to a camera ----#
+        self.latest_img = None
+        self.latest_camera_model = None
+        self.latest_condition = threading.Condition()
+        self.latest_timeout = kwargs.get('aruco_latest_timeout', 1.0)
+        camera_img_topic = kwargs.get('camera_img_topic', None)
+        if camera_img_topic:
+            self.image_sub = rospy.Subscriber(
+                camera_img_topic, Image, self.img_cb, queue_size=1, buff_size=2**24)
+            self.info_sub = rospy.Subscriber(
+                kwargs['camera_info_topic'], CameraInfo, self.info_cb)
+            self.pose_estimate_latest_srv = rospy.Service('aruco_pose_estimate_latest',
+                                ArucoPoseEstimateLatest, self.estimate_pose_latest_cb)
+        #--------------------------------------------------------#
 
         #---- Markers detected at each camera frame ----#
-        self.marker_pose_list = PoseArray()  # Poses of markers in camera frame
-        self.detected_ids = []  # Coresponding detected ids
+        self.marker_trans = np.zeros((0, 3))  # Positions of markers in camera frame
+        self.marker_quats = np.zeros((0, 4))  # Orientations of markers in camera frame
+        self.detected_ids = np.zeros(0, dtype=int)  # Coresponding detected ids
         #----------------------------------------------#
 
         # ROS publishers
-        self.aruco_pub = rospy.Publisher("aruco_img", Image, queue_size=10)
+        self.image_publisher = image_renderer.AnnotatedImagePublisher(
+            self.detector, "aruco_img",
+            kwargs.get('aruco_img_rate', 0.0), kwargs.get('aruco_img_scale', 1.0))
 
         #---- Used at prediction time ----#
         if not self.marker_transform_file is None:
@@ -76,11 +119,14 @@ class ArucoDetection(object):
                     self.marker_transform_file)
             except:
                 ValueError("Invalid marker transform file")
+            # Swap in recalibrated transforms without restarting the service
+            self.transform_reloader = transform_reloader.MarkerTransformReloader(
+                self.marker_transform_file, [self],
+                kwargs.get('aruco_transforms_watch_period', 1.0))
         #--------------------------------#
         rospy.logerr(self.marker_transform_file)
         rospy.logerr(self.marker_transforms)
         rospy.loginfo("Aruco detection service ready.")
-        self.aruco_pub = rospy.Publisher("aruco_img", Image, queue_size=10)
 
     def load_marker_transform(self, marker_transform_file):
         """
@@ -90,13 +136,71 @@ class ArucoDetection(object):
             marker_transform_file {string}: The file containing the marker transforms.
         ----------
         Returns:
-            dict: A dictionary containing the marker transforms.
+            MarkerTransformTable: The marker transforms as an (N,4,4) array with an id lookup.
         """
-        load_unformated = np.load(marker_transform_file, allow_pickle=True)
-        mk_transform = load_unformated['mk_tf_dict'][()]
+        mk_transform = transform_table.load_marker_transforms(marker_transform_file)
         rospy.loginfo(" TF between markers successfully loaded from file.")
         return mk_transform
 
+    def img_cb(self, msg):
+        """
+        Keep the latest camera image. It is only converted when a request uses it.
+        """
+        with self.latest_condition:
+            self.latest_img = msg
+            self.latest_condition.notify_all()
+
+    def info_cb(self, msg):
+        self.latest_camera_model = self.camera_models.get(msg)
+
+    def wait_for_latest(self, min_stamp, timeout):
+        """
+        Wait for a camera image stamped at or after min_stamp.
+        ----------
+        Args:
+            min_stamp {rospy.Time}: The oldest accepted stamp. 0 accepts any image.
+            timeout {float}: Time to wait in s.
+        ----------
+        Returns:
+            Image: The latest image, None if no new enough image arrived in time.
+        """
+        deadline = rospy.get_time() + timeout
+        with self.latest_condition:
+            while self.latest_img is None or self.latest_img.header.stamp < min_stamp:
+                remaining = deadline - rospy.get_time()
+                if remaining <= 0 or rospy.is_shutdown():
+                    return None
+                self.latest_condition.wait(min(remaining, 0.1))
+            return self.latest_img
+
+    def estimate_pose_latest_cb(self, req):
+        """
+        Estimate the pose of the object in the latest camera image, given a request (min_stamp, timeout).
+        Waits up to timeout (aruco_latest_timeout if 0) for an image stamped at or after min_stamp.
+        ----------
+        Response:
+            ArucoPoseEstimateLatestResponse: The estimated pose of the object, the header of the image used. Success or failure.
+        """
+        assert isinstance(req, ArucoPoseEstimateLatestRequest)
+        timeout = req.timeout.to_sec() if req.timeout.to_sec() > 0 else self.latest_timeout
+        image = self.wait_for_latest(req.min_stamp, timeout)
+        model = self.latest_camera_model
+
+        response = ArucoPoseEstimateLatestResponse()
+        response.success.data = False
+        if image is None or model is None:
+            rospy.logwarn("No camera image stamped after {} and camera info available.".format(
+                req.min_stamp.to_sec()))
+            return response
+
+        estimated_pose = self.estimate_pose(image, model.K, model.D)
+        response.header = image.header
+        if estimated_pose is not None:
+            response.success.data = True
+            response.aruco_pose = estimated_pose
+
+        return response
+
     def estimate_pose_cb(self, req):
         """
         Estimate the pose of the object given a request (Image, CameraInfo)
@@ -105,19 +209,8 @@ class ArucoDetection(object):
             ArucoPoseEstimateResponse: The estimated pose of the object. Success or failure.
         """
         assert isinstance(req, ArucoPoseEstimateRequest)
-        image = req.img
-        camera_info = req.camera_info
-        K, D = self.caminfo_to_matrx_dist(camera_info)
-
-        try:
-            color_img = self.bridge.imgmsg_to_cv2(image, "bgr8")
-        except CvBridgeError as e:
-            print(e)
-
-        # Detect markers
-        output_img, marker_pose_list, detected_id_list = self.detect_aruco(color_img, K, D)
-
-        estimated_pose = self.calculate_transform(self.main_marker_id, marker_pose_list, detected_id_list)
+        K, D = self.caminfo_to_matrx_dist(req.camera_info)
+        estimated_pose = self.estimate_pose(req.img, K, D)
 
         response = ArucoPoseEstimateResponse()
         if estimated_pose is None:
@@ -128,6 +221,76 @@ class ArucoDetection(object):
 
         return response
 
+    def estimate_pose_batch_cb(self, req):
+        """
+        Estimate the pose of the object in each image of a request (Image[], CameraInfo[]).
+        The images are processed in parallel. camera_infos holds one CameraInfo shared
+        by all images or one per image.
+        ----------
+        Response:
+            ArucoPoseEstimateBatchResponse: The estimated poses, in the order of the images. Success or failure of each.
+        """
+        assert isinstance(req, ArucoPoseEstimateBatchRequest)
+        camera_infos = req.camera_infos
+        if len(camera_infos) == 1:
+            camera_infos = camera_infos * len(req.imgs)
+        elif len(camera_infos) != len(req.imgs):
+            raise rospy.ServiceException(
+                "Expected 1 or {} camera infos, got {}".format(len(req.imgs), len(camera_infos)))
+
+        estimated_poses = self.batch_pool.map(
+            lambda args: self.estimate_pose(args[0], *self.caminfo_to_matrx_dist(args[1])),
+            zip(req.imgs, camera_infos))
+
+        response = ArucoPoseEstimateBatchResponse()
+        for estimated_pose in estimated_poses:
+            success = Bool()
+            success.data = estimated_pose is not None
+            response.success.append(success)
+            response.aruco_poses.append(Pose() if estimated_pose is None else estimated_pose)
+
+        return response
+
+    def cache_stats_cb(self, req):
+        """
+        Report the hit and miss counters of the result cache.
+        """
+        return TriggerResponse(success=True, message=self.result_cache.stats())
+
+    def estimate_pose(self, image, K, D):
+        """
+        Estimate the pose of the object in one image. Images that were already
+        processed are answered from the result cache.
+        ----------
+        Args:
+            image {Image}: The image message.
+            K {numpy.array}: The camera matrix.
+            D {numpy.array}: The distortion coefficients.
+        ----------
+        Returns:
+            Pose: The estimated pose of the object, None if it was not found.
+        """
+        # Read once, the cached pose belongs to this table
+        marker_transforms = self.marker_transforms
+        cache_key = self.result_cache.key(image, K, D, marker_transforms)
+        found, estimated_pose = self.result_cache.get(cache_key)
+        if found:
+            return estimated_pose
+
+        try:
+            frame = image_io.ImageFrame(image, self.bridge)
+        except CvBridgeError as e:
+            print(e)
+            return None
+
+        # Detect markers
+        marker_trans, marker_quats, detected_id_list = self.detect_aruco(frame, K, D)
+
+        estimated_pose = self.calculate_transform(
+            self.main_marker_id, marker_trans, marker_quats, detected_id_list, marker_transforms)
+        self.result_cache.put(cache_key, estimated_pose)
+        return estimated_pose
+
     def caminfo_to_matrx_dist(self, caminfo):
         """
         Converts a camera info message to a camera matrix and distortion coefficients.
@@ -139,165 +302,74 @@ class ArucoDetection(object):
             K {numpy.array}: The camera matrix.
             D {numpy.array}: The distortion coefficients.
         """
-        K = np.reshape(caminfo.K, (3, 3))    # Camera matrix
-        # Distortion matrix. 5 for IntelRealsense, 8 for AzureKinect
-        D = np.array(caminfo.D)
-        return K, D
+        model = self.camera_models.get(caminfo)
+        return model.K, model.D
 
-    def detect_aruco(self, img, camera_matrix, dist_coeffs):
+    def detect_aruco(self, frame, camera_matrix, dist_coeffs):
         """
-        Given an RDB image detect aruco markers. 
+        Given an image detect aruco markers. 
         ----------
         Args:
-            img {Image} -- RBG image
+            frame {ImageFrame} -- The camera image
             camera_matrix {np.array} -- camera matrix 3x3
             dist_coeffs {np.array} -- distortion coefficients (len 4,5,8 or 12)
         ----------
         Returns:
-            output_img -- image with aruco markers
-            marker_pose_list {PoseArray} -- list of poses of the detected markers
-            id_list {list} -- list of detected ids
+            marker_trans {np.array} -- (N,3) positions of the detected markers
+            marker_quats {np.array} -- (N,4) orientations of the detected markers
+            id_list {np.array} -- (N,) detected ids
         """
-
-        # Create parameters for marker detection
-        aruco_dict = aruco.Dictionary_get(ARUCO_DICT[self.marker_type])
-        parameters = aruco.DetectorParameters_create()
-        parameters.minCornerDistanceRate = 0.02
-        parameters.minMarkerDistanceRate = 0.02
-        parameters.cornerRefinementMethod = aruco.CORNER_REFINE_CONTOUR
-
         # Detect aruco markers
-        corners, ids, rejected = aruco.detectMarkers(
-            img, aruco_dict, parameters=parameters)
+        corners, ids, rejected = self.marker_finder.detect(frame.gray)
 
-        marker_pose_list = PoseArray()
-        id_list = []
         if len(corners) > 0:
-            markerLength = self.marker_size
-
-            # For numerous markers:
-            for i, marker_id in enumerate(ids):
-                # Draw bounding box on the marker
-                img = aruco.drawDetectedMarkers(img, [corners[i]], marker_id)
-
-                rvec, tvec, _ = aruco.estimatePoseSingleMarkers(
-                    [corners[i]], markerLength, camera_matrix, dist_coeffs)
-                output_img = aruco.drawAxis(
-                    img, camera_matrix, dist_coeffs, rvec, tvec, 0.05)
-                    
-                # Convert its pose to Pose.msg format in order to publish
-                marker_pose = self.make_pose(rvec, tvec)
-
-                marker_pose_list.poses.append(marker_pose)
-                id_list.append(int(marker_id))
-
-            output_img = aruco.drawDetectedMarkers(
-                img, rejected, borderColor=(100, 0, 240))
+            # All markers are estimated in one call
+            marker_trans, marker_quats, rvecs = self.detector.estimate_marker_poses(
+                corners, camera_matrix, dist_coeffs)
+            id_list = np.reshape(ids, -1).astype(int)
 
         else:
-            output_img = img
-
-        out_img = Image()
-        out_img = self.bridge.cv2_to_imgmsg(output_img, "bgr8")
-        self.aruco_pub.publish(out_img)
-
-        return output_img, marker_pose_list, id_list
-
-    def make_pose(self, rvec, tvec):
-        """
-        Given rotation vector and a translation vector, returns a Pose.
-        ----------
-        Args:
-            rvec {np.array} -- rotation vector of the marker
-            tvec {np.array} -- translation vector of the marker
-        ----------
-        Returns:
-            Pose -- Pose of the marker
-        """
-        marker_pose = Pose()
-        tvec = np.squeeze(tvec)
-        rvec = np.squeeze(rvec)
+            marker_trans = np.zeros((0, 3))
+            marker_quats = np.zeros((0, 4))
+            id_list = np.zeros(0, dtype=int)
+            rvecs = np.zeros((0, 3))
 
-        r_mat = np.eye(3)
-        cv2.Rodrigues(rvec, r_mat)
-        tf_mat = np.eye(4)
-        tf_mat[0:3, 0:3] = r_mat
+        # Drawing happens on the render worker, only while someone is subscribed
+        self.image_publisher.submit(
+            frame, corners, ids, rejected, rvecs, marker_trans, camera_matrix, dist_coeffs)
 
-        quat = tf.transformations.quaternion_from_matrix(tf_mat)
+        return marker_trans, marker_quats, id_list
 
-        marker_pose.position.x = tvec[0]
-        marker_pose.position.y = tvec[1]
-        marker_pose.position.z = tvec[2]
-
-        marker_pose.orientation.x = quat[0]
-        marker_pose.orientation.y = quat[1]
-        marker_pose.orientation.z = quat[2]
-        marker_pose.orientation.w = quat[3]
-
-        return marker_pose
-
-    def calculate_transform(self, id_main, marker_pose_list, detected_ids):
+    def calculate_transform(self, id_main, marker_trans, marker_quats, detected_ids, marker_transforms=None):
         """
         Given transforms of all detected markers calculate the pose of the object.
         ----------
         Args:
             id_main {int} -- id of the main marker
-            marker_pose_list {PoseArray} -- list of poses of the detected markers
-            detected_ids {list} -- list of detected ids
+            marker_trans {np.array} -- (N,3) positions of the detected markers
+            marker_quats {np.array} -- (N,4) orientations of the detected markers
+            detected_ids {np.array} -- (N,) detected ids
+            marker_transforms {MarkerTransformTable} -- The table to use, the current one if None
         ----------
         Returns:
             Pose -- Estimated pose of the object
         """
-        transforms_rot = []
-        transforms_trans = []
-        for i, marker_id in enumerate(detected_ids):
-
-            trans, rot = utils.pose_to_quat_trans(marker_pose_list.poses[i])
-
-            if marker_id == id_main:
-                transforms_rot.append(rot)
-                transforms_trans.append(trans)
-                continue
-            else:
-                tf_matrix = utils.quat_trans_to_matrix(trans, rot)
-                if marker_id in self.marker_transforms:
-                    full_tf = np.dot(
-                        tf_matrix, self.marker_transforms[marker_id])
-                    trans, rot = utils.matrix_to_quat_trans(full_tf)
-                    transforms_rot.append(rot)
-                    transforms_trans.append(trans)
-                else:
-                    rospy.logwarn("Unknown Aruco marker present.")
-                    continue
-        transforms_rot = np.array(transforms_rot)
-        transforms_trans = np.array(transforms_trans)
-
-        if len(transforms_rot) == 0:
+        # Read once, a reload swaps in a new table between requests
+        if marker_transforms is None:
+            marker_transforms = self.marker_transforms
+
+        # Map every visible marker to a candidate object pose at once
+        transforms_trans, transforms_rot, known = marker_transforms.object_candidates(
+            id_main, detected_ids, marker_trans, marker_quats)
+        if not np.all(known):
+            rospy.logwarn("Unknown Aruco marker present.")
+
+        # The main marker is trusted when two markers disagree
+        avg_trans, avg_rot, inliers = utils.average_object_candidates(
+            transforms_trans, transforms_rot, self.inlier_translation, self.inlier_rotation,
+            np.reshape(detected_ids, -1)[known] == int(id_main))
+        if avg_rot is None:
             return
-        elif len(transforms_rot) > 2:
-            rotation_mtxs = np.array(
-                [tf.transformations.quaternion_matrix(rt) for rt in transforms_rot])
-            z_axis = np.array([0, 0, 1, 1])
-            z_rotated = np.einsum(
-                "ijk,k->ij", rotation_mtxs[:, 0:3, 0:3], z_axis[0:3])
-            z_rotated = np.squeeze(z_rotated)
-            z_rotated_compare = np.dot(z_rotated, z_rotated.T)
-
-            col_avg = np.average(z_rotated_compare, axis=0)
-            outlier = np.argmin(col_avg)
-
-            transforms_rot = np.delete(transforms_rot, outlier, axis=0)
-            transforms_trans = np.delete(transforms_trans, outlier, axis=0)
-
-        if len(transforms_rot) > 1:
-            transforms_rot = np.array(transforms_rot)
-            transforms_trans = np.array(transforms_trans)
-
-            avg_rot = utils.average_quaternions(transforms_rot)
-            avg_trans = np.average(transforms_trans, axis=0)
-        else:
-            avg_rot = transforms_rot[0]
-            avg_trans = transforms_trans[0]
 
         obj_transform = Pose()
 
@@ -312,11 +384,37 @@ if __name__ == "__main__":
 
     aruco_type = rospy.get_param("~aruco_type", "DICT_6X6_100")
     aruco_length = rospy.get_param("~aruco_length", "0.0489")
+    aruco_detector_profile = rospy.get_param("~aruco_detector_profile", "default")
+    aruco_img_rate = rospy.get_param("~aruco_img_rate", 0.0)
+    aruco_img_scale = rospy.get_param("~aruco_img_scale", 1.0)
+    aruco_pyramid_factor = rospy.get_param("~aruco_pyramid_factor", 1.0)
+    aruco_batch_threads = rospy.get_param("~aruco_batch_threads", 0)
+    aruco_latest_timeout = rospy.get_param("~aruco_latest_timeout", 1.0)
+    aruco_cache_size = rospy.get_param("~aruco_cache_size", 32)
+    aruco_cache_hash = rospy.get_param("~aruco_cache_hash", False)
+    aruco_transforms_watch_period = rospy.get_param("~aruco_transforms_watch_period", 1.0)
+    aruco_inlier_translation = rospy.get_param("~aruco_inlier_translation", 0.02)
+    aruco_inlier_rotation = rospy.get_param("~aruco_inlier_rotation", 0.2)
+    camera_img_topic = rospy.get_param("~camera_img_topic", "")
+    camera_info_topic = rospy.get_param("~camera_info_topic", "")
     aruco_transforms = rospy.get_param("~aruco_transforms")
     aruco_main_marker_id = rospy.get_param("~aruco_main_marker_id")
 
     params = {"aruco_type": aruco_type,
               "aruco_length": aruco_length,
+              "aruco_detector_profile": aruco_detector_profile,
+              "aruco_img_rate": aruco_img_rate,
+              "aruco_img_scale": aruco_img_scale,
+              "aruco_pyramid_factor": aruco_pyramid_factor,
+              "aruco_batch_threads": aruco_batch_threads,
+              "aruco_latest_timeout": aruco_latest_timeout,
+              "aruco_cache_size": aruco_cache_size,
+              "aruco_cache_hash": aruco_cache_hash,
+              "aruco_transforms_watch_period": aruco_transforms_watch_period,
+              "aruco_inlier_translation": aruco_inlier_translation,
+              "aruco_inlier_rotation": aruco_inlier_rotation,
+              "camera_img_topic": camera_img_topic,
+              "camera_info_topic": camera_info_topic,
               "aruco_transforms": aruco_transforms,
               "aruco_main_marker_id": aruco_main_marker_id}
 
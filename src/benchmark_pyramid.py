@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+"""
+Speed/accuracy benchmark of the coarse-to-fine (pyramid) detection.
+
+Without arguments the markers are rendered into synthetic 1920x1080 frames with
+known corners. With --images the frames of a folder are used and the full
+resolution detection is taken as the reference.
+
+The pyramid refines the corners with cornerSubPix, so factor 1 is reported twice:
+with the corner refinement of the detector profile, and with the same cornerSubPix
+refinement as the pyramid. The second row isolates the effect of the downscaling.
+
+    python benchmark_pyramid.py --factors 1 2 4
+    python benchmark_pyramid.py --images /path/to/frames --aruco_type DICT_6X6_1000
+"""
+
+from __future__ import print_function
+import argparse
+import glob
+import os
+import time
+
+import cv2
+import cv2.aruco as aruco
+import numpy as np
+
+import aruco_detector
+
+
+def synthetic_frames(aruco_type, count, markers, width=1920, height=1080, seed=0):
+    """
+    Render markers with random perspective into noisy frames.
+    ----------
+    Returns:
+        frames {list}: (image, {marker_id: (4,2) corners}) tuples.
+    """
+    rng = np.random.RandomState(seed)
+    aruco_dict = aruco.Dictionary_get(aruco_detector.ARUCO_DICT[aruco_type])
+    frames = []
+    for _ in range(count):
+        img = np.full((height, width), 200, dtype=np.uint8)
+        truth = {}
+        cell_w = width // markers
+        for k in range(markers):
+            size = rng.randint(80, 200)
+            marker = aruco.drawMarker(aruco_dict, k, size)
+            marker = cv2.copyMakeBorder(marker, size // 6, size // 6, size // 6, size // 6,
+                                        cv2.BORDER_CONSTANT, value=255)
+            border = size // 6
+            centre = np.array([cell_w * k + cell_w / 2.0, rng.uniform(height * 0.3, height * 0.7)])
+            half = min(size, cell_w * 0.6) / 2.0
+            square = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]], dtype=np.float64) * half
+            dst = centre + square + rng.uniform(-0.15, 0.15, (4, 2)) * half
+
+            # Pixel centres: the outer marker corners lie half a pixel outside the first pixel
+            src = np.array([[border - 0.5, border - 0.5], [border + size - 0.5, border - 0.5],
+                            [border + size - 0.5, border + size - 0.5], [border - 0.5, border + size - 0.5]])
+            homography = cv2.getPerspectiveTransform(src.astype(np.float32), dst.astype(np.float32))
+            warped = cv2.warpPerspective(marker, homography, (width, height),
+                                         flags=cv2.INTER_LINEAR, borderValue=0)
+            mask = cv2.warpPerspective(np.full(marker.shape, 255, np.uint8), homography, (width, height),
+                                       flags=cv2.INTER_NEAREST, borderValue=0)
+            img[mask > 0] = warped[mask > 0]
+            truth[k] = dst
+        noise = rng.normal(0, 3, img.shape)
+        img = np.clip(img + noise, 0, 255).astype(np.uint8)
+        frames.append((cv2.cvtColor(img, cv2.COLOR_GRAY2BGR), truth))
+    return frames
+
+
+def folder_frames(folder, reference):
+    frames = []
+    for path in sorted(glob.glob(os.path.join(folder, "*"))):
+        img = cv2.imread(path)
+        if img is None:
+            continue
+        corners, ids, _ = reference.detect(img)
+        truth = {}
+        if ids is not None:
+            truth = dict((int(i), np.reshape(c, (4, 2))) for i, c in zip(ids.ravel(), corners))
+        frames.append((img, truth))
+    return frames
+
+
+class SubPixDetector(object):
+    def __init__(self, detector):
+        """
+        Full resolution detection followed by the cornerSubPix refinement of PyramidDetector.
+        """
+        self.detector = detector
+        self.refiner = aruco_detector.PyramidDetector(detector, 1.0)
+
+    def detect(self, img):
+        corners, ids, rejected = self.detector.detect(img)
+        if len(corners) > 0:
+            corners = self.refiner.refine(img, corners)
+        return corners, ids, rejected
+
+
+def run(finder, frames, repeat):
+    times = []
+    errors = []
+    found = 0
+    expected = 0
+    for img, truth in frames:
+        for _ in range(repeat):
+            start = time.time()
+            corners, ids, _ = finder.detect(img)
+            times.append(time.time() - start)
+        expected += len(truth)
+        if ids is None:
+            continue
+        for marker_id, marker_corners in zip(ids.ravel(), corners):
+            if int(marker_id) not in truth:
+                continue
+            found += 1
+            diff = np.reshape(marker_corners, (4, 2)) - truth[int(marker_id)]
+            errors.extend(np.linalg.norm(diff, axis=1))
+    errors = np.array(errors) if len(errors) > 0 else np.array([np.nan])
+    return np.mean(times) * 1000, found, expected, np.mean(errors), np.max(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", default=None, help="Folder of recorded frames")
+    parser.add_argument("--aruco_type", default="DICT_6X6_100")
+    parser.add_argument("--profile", default="default")
+    parser.add_argument("--factors", type=float, nargs="+", default=[1.0, 2.0, 4.0])
+    parser.add_argument("--frames", type=int, default=20, help="Number of synthetic frames")
+    parser.add_argument("--markers", type=int, default=8, help="Markers per synthetic frame")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    detector = aruco_detector.ArucoDetector(args.aruco_type, 0.05, args.profile)
+    if args.images is None:
+        frames = synthetic_frames(args.aruco_type, args.frames, args.markers)
+    else:
+        frames = folder_frames(args.images, detector)
+
+    print("factor  refinement  time [ms]  detected  mean err [px]  max err [px]")
+    for factor in args.factors:
+        finders = [(aruco_detector.PyramidDetector(detector, factor), "subpix")]
+        if factor <= 1.0:
+            finders = [(detector, "profile"), (SubPixDetector(detector), "subpix")]
+        for finder, refinement in finders:
+            ms, found, expected, mean_err, max_err = run(finder, frames, args.repeat)
+            print("{:6.1f}  {:10s}  {:9.2f}  {:4d}/{:<4d}  {:13.3f}  {:12.3f}".format(
+                factor, refinement, ms, found, expected, mean_err, max_err))
+
+
+if __name__ == "__main__":
+    main()
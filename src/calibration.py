@@ -0,0 +1,249 @@
+import itertools
+import os
+from collections import defaultdict, deque
+
+import numpy as np
+import tf
+
+import pose_graph
+import transform_table
+import utils
+
+
+class RunningStats(object):
+    def __init__(self, size):
+        """
+        Running mean and variance of a vector (Welford's algorithm), in O(1) memory.
+        ----------
+        Args:
+            size {int}: Length of the vector.
+        """
+        self.count = 0
+        self.mean = np.zeros(size)
+        self.m2 = np.zeros(size)
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def variance(self):
+        """
+        Returns:
+            np.array: The sample variance of each component, inf before two samples.
+        """
+        if self.count < 2:
+            return np.full(len(self.mean), np.inf)
+        return self.m2 / (self.count - 1)
+
+
+class PairwiseTransformEstimator(object):
+    def __init__(self):
+        """
+        Estimates the transforms between markers seen together in the same frame,
+        independent of where the frames come from (live camera or recording).
+        Each pair keeps a running mean and variance of its translation and rotation.
+        ----------
+            self.marker_transforms_list {list}: A list of [translation, quaternion] mean transforms between the markers.
+            self.marker_id_list {list}: A list of combination of markers.
+            self.marker_updates_list {list}: How many times each combination has been updated.
+            self.translation_stats {list}: RunningStats of the translation of each combination.
+            self.rotation_stats {list}: RunningStats of the quaternion of each combination.
+            self.seen_ids {set}: Ids of every marker detected so far, also alone in a frame.
+        """
+        self.marker_transforms_list = []  # Transformations between markers
+        self.marker_id_list = []  # Ids of markers
+        self.marker_updates_list = []
+        self.translation_stats = []
+        self.rotation_stats = []
+        self.combination_index = {}  # (id_a, id_b): index in the lists above
+        self.seen_ids = set()
+
+    def update(self, marker_trans, marker_quats, detected_ids):
+        """
+        Given the markers detected in one frame, find and update the transforms between the markers.
+        ----------
+        Args:
+            marker_trans {np.array}: (N,3) positions of the markers in the camera frame.
+            marker_quats {np.array}: (N,4) orientations of the markers in the camera frame.
+            detected_ids {np.array}: (N,) the corresponding detected ids.
+        """
+        detected_ids = [int(marker_id) for marker_id in detected_ids]
+        self.seen_ids.update(detected_ids)
+
+        # Get all possible combinations of markers
+        id_index = range(len(detected_ids))
+        pose_combinations = list(itertools.combinations(id_index, 2))
+
+        # For each possible calculation, calculate the transfromation matrix
+        for i, j in pose_combinations:
+            combination = (detected_ids[i], detected_ids[j])
+            if combination[::-1] in self.combination_index:
+                combination = combination[::-1]
+                i, j = j, i
+
+            # Find the transform between the two markers
+            tf_matrix_0 = utils.quat_trans_to_matrix(marker_trans[i], marker_quats[i])
+            tf_matrix_1 = utils.quat_trans_to_matrix(marker_trans[j], marker_quats[j])
+
+            tf_matrix_0_inv = tf.transformations.inverse_matrix(tf_matrix_0)
+
+            tf_0_to_1 = np.dot(tf_matrix_0_inv, tf_matrix_1)
+
+            trans, rotation = utils.matrix_to_quat_trans(tf_0_to_1)
+            trans, rotation = np.array(trans), np.array(rotation)
+
+            # If the transform does not yet exist add it
+            if combination not in self.combination_index:
+                self.combination_index[combination] = len(self.marker_id_list)
+                self.marker_transforms_list.append([trans, rotation])
+                self.marker_id_list.append(list(combination))
+                self.marker_updates_list.append(0)
+                self.translation_stats.append(RunningStats(3))
+                self.rotation_stats.append(RunningStats(4))
+
+            combination_idx = self.combination_index[combination]
+            rotation_stats = self.rotation_stats[combination_idx]
+            # q and -q are the same rotation, keep the samples in one hemisphere
+            if rotation_stats.count > 0 and np.dot(rotation, rotation_stats.mean) < 0:
+                rotation = -rotation
+            self.translation_stats[combination_idx].add(trans)
+            rotation_stats.add(rotation)
+
+            self.marker_transforms_list[combination_idx] = [
+                self.translation_stats[combination_idx].mean.copy(),
+                utils.normalize_quaternion(rotation_stats.mean.copy())]
+            self.marker_updates_list[combination_idx] = rotation_stats.count
+
+    def edge_variances(self, combination_idx):
+        """
+        Sample variance of the transform of a combination, i.e. the spread of the single
+        frame measurements, not of their mean.
+        ----------
+        Returns:
+            translation_var {float}: Sum of the variances of x, y and z in m^2.
+            rotation_var {float}: Variance of the rotation angle in rad^2 (small angle approximation).
+        """
+        translation_var = np.sum(self.translation_stats[combination_idx].variance())
+        # The vector part of a quaternion is about angle/2 * axis
+        rotation_var = 4.0 * np.sum(self.rotation_stats[combination_idx].variance())
+        return translation_var, rotation_var
+
+    def spanning_edges(self, id_main):
+        """
+        Breadth first spanning tree of the markers connected to the main marker.
+        ----------
+        Returns:
+            list: Indices of the combinations in the tree.
+        """
+        graph = defaultdict(list)
+        for combination_idx, (a, b) in enumerate(self.marker_id_list):
+            graph[a].append((b, combination_idx))
+            graph[b].append((a, combination_idx))
+
+        explored = set([int(id_main)])
+        queue = deque([int(id_main)])
+        edges = []
+        while queue:
+            node = queue.popleft()
+            for neighbour, combination_idx in graph[node]:
+                if neighbour not in explored:
+                    explored.add(neighbour)
+                    edges.append(combination_idx)
+                    queue.append(neighbour)
+        return edges
+
+    def converged(self, id_main, max_translation_var, max_rotation_var, min_samples=30, min_markers=0):
+        """
+        Whether every marker seen so far is connected to the main marker and every combination
+        of the spanning tree of the main marker has enough samples and a small enough variance.
+        ----------
+        Args:
+            id_main {int}: The id of the main marker.
+            max_translation_var {float}: Maximum sample variance of the translation of a combination in m^2.
+            max_rotation_var {float}: Maximum sample variance of the rotation of a combination in rad^2.
+            min_samples {int}: Minimum number of samples of each combination.
+            min_markers {int}: Minimum number of markers connected to the main marker, main marker included.
+        """
+        edges = self.spanning_edges(id_main)
+        if len(edges) == 0 or len(edges) + 1 < min_markers:
+            return False
+        connected = set([int(id_main)])
+        for combination_idx in edges:
+            connected.update(self.marker_id_list[combination_idx])
+        if not self.seen_ids <= connected:
+            return False
+        for combination_idx in edges:
+            if self.marker_updates_list[combination_idx] < min_samples:
+                return False
+            translation_var, rotation_var = self.edge_variances(combination_idx)
+            if translation_var > max_translation_var or rotation_var > max_rotation_var:
+                return False
+        return True
+
+    def save_statistics(self, save_dir):
+        """
+        Save the statistics of each combination next to the marker transforms.
+        ----------
+        Returns:
+            string: The path of the saved file.
+        """
+        path = os.path.join(save_dir, 'marker_transforms_stats.npz')
+        count = len(self.marker_id_list)
+        np.savez(path,
+                 combinations=np.reshape(np.array(self.marker_id_list, dtype=np.int64), (count, 2)),
+                 counts=np.array(self.marker_updates_list, dtype=np.int64),
+                 translation_mean=np.reshape([s.mean for s in self.translation_stats], (count, 3)),
+                 translation_var=np.reshape([s.variance() for s in self.translation_stats], (count, 3)),
+                 rotation_mean=np.reshape([t[1] for t in self.marker_transforms_list], (count, 4)),
+                 rotation_var=np.reshape([s.variance() for s in self.rotation_stats], (count, 4)))
+        return path
+
+    def marker_ids(self):
+        return set(marker_id for combination in self.marker_id_list for marker_id in combination)
+
+    def solve(self, id_main):
+        """
+        Combine the transforms between marker pairs in one least squares solve of the pose graph,
+        each pair weighted by how many times it was updated.
+        ----------
+        Args:
+            id_main {int}: The id of the main marker.
+        ----------
+        Returns:
+            mk_tf {dict}: {marker_id: 4x4 transform from the marker to the main marker}, for the markers
+                connected to the main marker.
+        """
+        id_main = int(id_main)
+        edge_tfs = utils.quat_trans_to_matrices(
+            np.reshape([marker_tf[0] for marker_tf in self.marker_transforms_list], (-1, 3)),
+            np.reshape([marker_tf[1] for marker_tf in self.marker_transforms_list], (-1, 4)))
+        # Pose of each marker in the frame of the main marker
+        marker_poses = pose_graph.solve_pose_graph(
+            self.marker_id_list, edge_tfs, self.marker_updates_list, id_main)
+
+        mk_tf = {}
+        for marker_id, marker_pose in marker_poses.items():
+            if marker_id == id_main:
+                continue
+            mk_tf[marker_id] = tf.transformations.inverse_matrix(marker_pose)
+        return mk_tf
+
+
+def save_marker_transforms(save_dir, mk_tf):
+    """
+    Save the marker transforms as "marker_transforms.mkt" (binary table) and as the
+    legacy "marker_transforms.npz". The node and the service load either.
+    ----------
+    Returns:
+        string: The path of the legacy file.
+    """
+    transform_table.save_table(os.path.join(save_dir, 'marker_transforms.mkt'),
+                               transform_table.MarkerTransformTable.from_dict(mk_tf))
+    path = os.path.join(save_dir, 'marker_transforms.npz')
+    # Renamed into place, running nodes reload only complete files
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, mk_tf_dict=mk_tf)
+    os.rename(path + '.tmp', path)
+    return path
@@ -0,0 +1,100 @@
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+def camera_info_key(msg):
+    """
+    The contents of a CameraInfo message that define the camera model.
+    """
+    return (msg.width, msg.height, msg.distortion_model, tuple(msg.K), tuple(msg.D))
+
+
+class CameraModel(object):
+    def __init__(self, K, D, width=0, height=0):
+        """
+        Camera intrinsics converted once to the arrays OpenCV expects. Derived data is
+        computed on first use and kept.
+        ----------
+        Args:
+            K {list}: The camera matrix, 9 values or 3x3.
+            D {list}: The distortion coefficients. 5 for IntelRealsense, 8 for AzureKinect.
+            width {int}: The image width in pixels.
+            height {int}: The image height in pixels.
+        ----------
+            self.K {np.array}: 3x3 camera matrix.
+            self.D {np.array}: (N,) distortion coefficients.
+        """
+        self.K = np.ascontiguousarray(np.reshape(K, (3, 3)), dtype=np.float64)
+        self.D = np.ascontiguousarray(np.reshape(D, -1), dtype=np.float64)
+        self.width = int(width)
+        self.height = int(height)
+        self.optimal_matrices = {}
+        self.maps = {}
+
+    @classmethod
+    def from_camera_info(cls, msg):
+        return cls(msg.K, msg.D, msg.width, msg.height)
+
+    def optimal_camera_matrix(self, alpha=0.0):
+        """
+        The camera matrix of the undistorted image, see cv2.getOptimalNewCameraMatrix.
+        ----------
+        Args:
+            alpha {float}: 0 keeps only valid pixels, 1 keeps all source pixels.
+        ----------
+        Returns:
+            new_K {np.array}: 3x3 camera matrix.
+            roi {tuple}: (x, y, w, h) of the valid pixels.
+        """
+        if alpha not in self.optimal_matrices:
+            size = (self.width, self.height)
+            self.optimal_matrices[alpha] = cv2.getOptimalNewCameraMatrix(
+                self.K, self.D, size, alpha, size)
+        return self.optimal_matrices[alpha]
+
+    def undistort_maps(self, alpha=0.0):
+        """
+        Returns:
+            map1, map2: The cv2.remap maps from the distorted to the undistorted image.
+        """
+        if alpha not in self.maps:
+            new_K, _ = self.optimal_camera_matrix(alpha)
+            self.maps[alpha] = cv2.initUndistortRectifyMap(
+                self.K, self.D, None, new_K, (self.width, self.height), cv2.CV_16SC2)
+        return self.maps[alpha]
+
+    def undistort(self, img, alpha=0.0):
+        map1, map2 = self.undistort_maps(alpha)
+        return cv2.remap(img, map1, map2, cv2.INTER_LINEAR)
+
+
+class CameraModelCache(object):
+    def __init__(self, max_size=8):
+        """
+        CameraModels keyed on the CameraInfo contents. A model is only built when the
+        intrinsics change, so repeated CameraInfo messages reuse the same arrays.
+        ----------
+        Args:
+            max_size {int}: Number of cameras to keep, least recently used are dropped.
+        """
+        self.max_size = max_size
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, msg):
+        """
+        Returns:
+            CameraModel: The model of the CameraInfo message.
+        """
+        key = camera_info_key(msg)
+        with self.lock:
+            model = self.models.pop(key, None)
+            if model is None:
+                model = CameraModel.from_camera_info(msg)
+                while len(self.models) >= self.max_size:
+                    self.models.popitem(last=False)
+            self.models[key] = model
+        return model
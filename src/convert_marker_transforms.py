@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+"""
+Convert a legacy marker_transforms.npz (pickled dictionary) to the binary table
+format, which loads without pickle and can be memory mapped.
+
+    python convert_marker_transforms.py marker_transforms.npz
+    python convert_marker_transforms.py marker_transforms.npz --output board.mkt
+"""
+
+from __future__ import print_function
+import argparse
+import os
+
+import transform_table
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="Legacy .npz file")
+    parser.add_argument("--output", default=None, help="Output file (default: the input with a .mkt extension)")
+    args = parser.parse_args()
+
+    output = args.output
+    if output is None:
+        output = os.path.splitext(args.input)[0] + ".mkt"
+
+    table = transform_table.load_legacy(args.input)
+    transform_table.save_table(output, table)
+    print("Converted {} marker transforms to {}".format(len(table), output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,430 @@
+import ctypes
+import math
+import multiprocessing
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+import rospy
+
+import aruco_detector
+
+
+class LatestFrameBuffer(object):
+    def __init__(self):
+        """
+        Single slot frame buffer. A new frame replaces the one that was not yet taken,
+        so the consumer always gets the newest frame.
+        ----------
+            self.received {int}: Number of frames put into the buffer.
+            self.dropped {int}: Number of frames replaced before they were taken.
+        """
+        self.condition = threading.Condition()
+        self.frame = None
+        self.received = 0
+        self.dropped = 0
+
+    def put(self, frame):
+        with self.condition:
+            if self.frame is not None:
+                self.dropped += 1
+            self.frame = frame
+            self.received += 1
+            self.condition.notify()
+
+    def take(self, timeout=None):
+        """
+        Take the newest frame, waiting up to timeout seconds for one to arrive.
+        ----------
+        Returns:
+            The frame, or None if no frame arrived in time.
+        """
+        with self.condition:
+            if self.frame is None:
+                self.condition.wait(timeout)
+            frame, self.frame = self.frame, None
+            return frame
+
+    def pending(self):
+        return self.frame is not None
+
+
+class DetectionWorker(object):
+    def __init__(self, process_frame, name="aruco_detection", pool=None):
+        """
+        Runs process_frame on the newest received frame, in a dedicated thread or on
+        a shared pool. Frames arriving while a frame is processed replace each other,
+        so the latency stays at about one frame of processing time.
+        ----------
+        Args:
+            process_frame {callable}: Called with each frame taken from the buffer.
+            name {string}: Name of the worker thread.
+            pool {ThreadPool}: Shared pool to run on instead of a dedicated thread.
+                At most one task per worker is queued on the pool at a time.
+        """
+        self.process_frame = process_frame
+        self.buffer = LatestFrameBuffer()
+        self.processed = 0
+
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.scheduled = False
+        if self.pool is None:
+            self.thread = threading.Thread(target=self.run, name=name)
+            self.thread.daemon = True
+            self.thread.start()
+
+    @property
+    def dropped(self):
+        return self.buffer.dropped
+
+    def submit(self, frame):
+        self.buffer.put(frame)
+        if self.pool is None:
+            return
+        with self.lock:
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.pool.apply_async(self.drain)
+
+    def run(self):
+        while not rospy.is_shutdown():
+            frame = self.buffer.take(0.5)
+            if frame is None:
+                continue
+            self.process(frame)
+
+    def drain(self):
+        """
+        Pool task: process frames until the buffer is empty.
+        """
+        while not rospy.is_shutdown():
+            frame = self.buffer.take(0)
+            if frame is None:
+                with self.lock:
+                    # A frame put after take() is either seen here or schedules a new task
+                    if not self.buffer.pending():
+                        self.scheduled = False
+                        return
+                continue
+            self.process(frame)
+
+    def process(self, frame):
+        try:
+            self.process_frame(frame)
+        except Exception as e:
+            rospy.logerr("Aruco detection failed: {}".format(e))
+        self.processed += 1
+        if self.buffer.dropped > 0:
+            rospy.loginfo_throttle(
+                10, "Aruco detection: {} frames processed, {} dropped".format(
+                    self.processed, self.buffer.dropped))
+
+
+class AdaptiveFrameSkipper(object):
+    def __init__(self, cpu_budget=0.5, max_interval=0.5, boost_duration=1.0, smoothing=0.1):
+        """
+        Chooses how many incoming frames to skip between processed frames, so detection
+        uses at most cpu_budget of one core. The measured detection time grows when the
+        computer is busy, so the rate backs off by itself and recovers when it is idle.
+        ----------
+        Args:
+            cpu_budget {float}: Share of one core detection may use, e.g. 0.25.
+            max_interval {float}: Latency budget, longest time between processed frames in s,
+                whatever the cpu budget.
+            boost_duration {float}: How long every frame is processed after boost() in s.
+            smoothing {float}: Weight of a new sample in the running averages of the
+                detection time and the frame interval.
+        ----------
+            self.detection_time {float}: Running average of the detection time per frame in s.
+            self.frame_interval {float}: Running average of the time between incoming frames in s.
+            self.skip {int}: Number of frames currently skipped after each processed frame.
+        """
+        self.cpu_budget = cpu_budget
+        self.max_interval = max_interval
+        self.boost_duration = boost_duration
+        self.smoothing = smoothing
+        self.lock = threading.Lock()
+        self.detection_time = None
+        self.frame_interval = None
+        self.last_arrival = None
+        self.last_accepted = None
+        self.skip = 0
+        self.skipped = 0  # Frames skipped since the last accepted frame
+        self.boost_until = 0.0
+
+    def running_average(self, average, sample):
+        if average is None:
+            return sample
+        return average + self.smoothing * (sample - average)
+
+    def accept(self):
+        """
+        Called for every incoming frame.
+        ----------
+        Returns:
+            bool: Whether the frame should be processed.
+        """
+        now = time.time()
+        with self.lock:
+            if self.last_arrival is not None:
+                self.frame_interval = self.running_average(self.frame_interval, now - self.last_arrival)
+            self.last_arrival = now
+            # Skipping this frame would wait at least one more frame interval
+            late = (self.last_accepted is not None and self.frame_interval is not None
+                    and now - self.last_accepted + self.frame_interval > self.max_interval)
+            if self.skipped >= self.skip or now < self.boost_until or late:
+                self.skipped = 0
+                self.last_accepted = now
+                return True
+            self.skipped += 1
+            return False
+
+    def record(self, detection_time):
+        """
+        Report how long the detection of a processed frame took in s.
+        """
+        with self.lock:
+            self.detection_time = self.running_average(self.detection_time, detection_time)
+            skip = self.target_skip()
+            if skip != self.skip:
+                rospy.logdebug("Aruco detection: processing every {} frame(s), {:.1f} ms per frame".format(
+                    skip + 1, 1000.0 * self.detection_time))
+            self.skip = skip
+
+    def target_skip(self):
+        if self.detection_time is None or not self.frame_interval:
+            return 0
+        # Processing every (skip + 1)th frame uses detection_time / ((skip + 1) * frame_interval) of a core
+        skip = int(math.ceil(self.detection_time / (self.cpu_budget * self.frame_interval))) - 1
+        # and waits (skip + 1) * frame_interval between frames, which the latency budget caps
+        max_skip = int(math.floor(self.max_interval / self.frame_interval + 1e-9)) - 1
+        return max(min(skip, max_skip), 0)
+
+    def boost(self):
+        """
+        Process every frame for boost_duration, e.g. while the object moves fast or markers were lost.
+        """
+        with self.lock:
+            self.boost_until = time.time() + self.boost_duration
+
+
+# State of a detection process, set up once by _init_detection_process
+_process_state = {}
+
+
+def _init_detection_process(slots, detector_args, pyramid_factor):
+    # Each process runs single threaded, the pool provides the parallelism
+    cv2.setNumThreads(1)
+    detector = aruco_detector.ArucoDetector(*detector_args)
+    finder = detector
+    if pyramid_factor > 1.0:
+        finder = aruco_detector.PyramidDetector(detector, pyramid_factor)
+    _process_state["slots"] = slots
+    _process_state["detector"] = detector
+    _process_state["finder"] = finder
+
+
+def _detect_in_slot(seq, slot, shape, dtype, camera_matrix, dist_coeffs):
+    """
+    Detect the markers and estimate their poses on the image in a shared memory slot.
+    Runs in a detection process.
+    ----------
+    Returns:
+        seq {int}: The sequence number of the frame.
+        detections {tuple}: (corners, ids, rejected, marker_trans, marker_quats, rvecs), None on error.
+        error {string}: The error message, None on success.
+    """
+    try:
+        img = np.frombuffer(_process_state["slots"][slot], dtype=dtype,
+                            count=int(np.prod(shape))).reshape(shape)
+        corners, ids, rejected = _process_state["finder"].detect(img)
+        if len(corners) > 0:
+            marker_trans, marker_quats, rvecs = _process_state["detector"].estimate_marker_poses(
+                corners, camera_matrix, dist_coeffs)
+        else:
+            marker_trans = np.zeros((0, 3))
+            marker_quats = np.zeros((0, 4))
+            rvecs = np.zeros((0, 3))
+        return seq, (corners, ids, rejected, marker_trans, marker_quats, rvecs), None
+    except Exception as e:
+        return seq, None, str(e)
+
+
+class ProcessDetectionPool(object):
+    def __init__(self, processes, on_result, detector_args, pyramid_factor=1.0, slots_per_process=2,
+                 slot_size=3840 * 2160, timeout=2.0):
+        """
+        Detects markers on a pool of processes, so detection is not limited to one core
+        by the GIL. Frames are copied into shared memory slots instead of being pickled,
+        and the results are handed to on_result in the order the frames were submitted.
+        A frame is dropped when all slots are busy or it does not fit into a slot.
+        The processes are started here, create the pool before any ROS callback can submit.
+        A frame whose task fails or does not come back within timeout (e.g. its process
+        died) is given up, so the frames after it are not held back.
+        ----------
+        Args:
+            processes {int}: Number of detection processes.
+            on_result {callable}: Called as on_result(header, detections, context) for every
+                frame, in order.
+            detector_args {tuple}: (marker_type, marker_size, profile) of the ArucoDetector.
+            pyramid_factor {float}: See aruco_detector.PyramidDetector. 1 disables it.
+            slots_per_process {int}: Frames that can be in flight per process.
+            slot_size {int}: Size of a slot in bytes, the largest frame that can be detected.
+            timeout {float}: Time in s after which a frame still in flight is given up.
+        ----------
+            self.received {int}: Number of submitted frames.
+            self.dropped {int}: Number of frames dropped because all slots were busy.
+            self.processed {int}: Number of frames handed to on_result.
+            self.lost {int}: Number of frames whose task failed or timed out.
+        """
+        self.processes = processes
+        self.on_result = on_result
+        self.detector_args = tuple(detector_args)
+        self.pyramid_factor = pyramid_factor
+        self.slot_count = processes * slots_per_process
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        # Held while results are handed out, so they stay in order whichever thread releases them
+        self.deliver_lock = threading.Lock()
+        self.received = 0
+        self.dropped = 0
+        self.processed = 0
+        self.lost = 0
+
+        # The slots are inherited by the processes, so they are sized once up front
+        self.slot_size = slot_size
+        self.slots = [multiprocessing.RawArray(ctypes.c_uint8, slot_size) for _ in range(self.slot_count)]
+        self.pool = multiprocessing.Pool(
+            self.processes, _init_detection_process,
+            (self.slots, self.detector_args, self.pyramid_factor))
+        self.free_slots = list(range(self.slot_count))
+        self.next_seq = 0       # Sequence number of the next submitted frame
+        self.next_result = 0    # Sequence number of the next frame handed to on_result
+        self.in_flight = {}     # seq: (slot, header, context, submit time)
+        self.results = {}       # seq: (header, context, detections, error) waiting for earlier frames
+        self.last_stamp = None
+
+    def slot_view(self, slot, shape, dtype):
+        return np.frombuffer(self.slots[slot], dtype=dtype,
+                             count=int(np.prod(shape))).reshape(shape)
+
+    def submit(self, img, header, camera_matrix, dist_coeffs, context=None):
+        """
+        Copy a frame into a free slot and queue it for detection. context is handed
+        back to on_result with the detections.
+        ----------
+        Returns:
+            bool: False if the frame was dropped.
+        """
+        # Frames lost by the pool are given up here too, in case no other result comes back
+        self.deliver(expire=True)
+        with self.lock:
+            self.received += 1
+            if self.pool is None:
+                return False
+            if img.nbytes > self.slot_size:
+                self.dropped += 1
+                rospy.logerr_throttle(
+                    10, "Aruco detection: {} byte frame does not fit into the {} byte slots, dropped".format(
+                        img.nbytes, self.slot_size))
+                return False
+            if len(self.free_slots) == 0:
+                self.dropped += 1
+                return False
+            slot = self.free_slots.pop()
+            seq = self.next_seq
+            self.next_seq += 1
+            dtype = img.dtype.str
+            np.copyto(self.slot_view(slot, img.shape, dtype), img)
+            self.in_flight[seq] = (slot, header, context, time.time())
+
+            kwargs = {}
+            if sys.version_info[0] >= 3:
+                # Errors raised outside _detect_in_slot, e.g. while pickling the result
+                kwargs["error_callback"] = lambda e, seq=seq: self.collect((seq, None, str(e)))
+            self.pool.apply_async(
+                _detect_in_slot, (seq, slot, img.shape, dtype, camera_matrix, dist_coeffs),
+                callback=self.collect, **kwargs)
+        return True
+
+    def collect(self, result):
+        """
+        Pool callback. Results are buffered until all earlier frames are done and then
+        handed to on_result in order. The pool calls this from a single result thread.
+        """
+        seq, detections, error = result
+        with self.lock:
+            self.finish(seq, detections, error)
+        self.deliver(expire=True)
+
+    def finish(self, seq, detections, error):
+        """
+        Free the slot of a frame and buffer its result. Called with self.lock held.
+        Results of frames that were already given up are ignored.
+        """
+        if seq not in self.in_flight:
+            return
+        # The slot is no longer needed once the detections are back
+        slot, header, context, _ = self.in_flight.pop(seq)
+        self.free_slots.append(slot)
+        self.results[seq] = (header, context, detections, error)
+
+    def deliver(self, expire=False):
+        """
+        Hand the results of all frames whose earlier frames are done to on_result.
+        ----------
+        Args:
+            expire {bool}: First give up the frames in flight for longer than the timeout.
+        """
+        with self.deliver_lock:
+            with self.lock:
+                if self.pool is None:
+                    return
+                if expire:
+                    now = time.time()
+                    for seq in sorted(self.in_flight):
+                        if now - self.in_flight[seq][3] > self.timeout:
+                            self.finish(seq, None, "no result after {} s".format(self.timeout))
+                ready = []
+                while self.next_result in self.results:
+                    ready.append(self.results.pop(self.next_result))
+                    self.next_result += 1
+
+            for header, context, detections, error in ready:
+                try:
+                    if error is not None:
+                        self.lost += 1
+                        rospy.logerr("Aruco detection failed: {}".format(error))
+                    elif self.in_order(header):
+                        self.on_result(header, detections, context)
+                        self.processed += 1
+                except Exception as e:
+                    rospy.logerr("Aruco detection failed: {}".format(e))
+
+        if self.dropped > 0 or self.lost > 0:
+            rospy.loginfo_throttle(
+                10, "Aruco detection: {} frames processed, {} dropped, {} lost".format(
+                    self.processed, self.dropped, self.lost))
+
+    def in_order(self, header):
+        """
+        Whether the frame is not older than the last frame handed to on_result.
+        """
+        stamp = getattr(header, "stamp", None)
+        if stamp is None:
+            return True
+        if self.last_stamp is not None and stamp < self.last_stamp:
+            return False
+        self.last_stamp = stamp
+        return True
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
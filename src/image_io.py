@@ -0,0 +1,74 @@
+import cv2
+import numpy as np
+from cv_bridge import CvBridge
+
+# Conversion of each supported 8 bit encoding to grayscale and to BGR.
+# None means the image is already in that format.
+# ROS names Bayer patterns by the first row, OpenCV by the second.
+ENCODINGS = {
+    "mono8": (1, None, cv2.COLOR_GRAY2BGR),
+    "bgr8": (3, cv2.COLOR_BGR2GRAY, None),
+    "rgb8": (3, cv2.COLOR_RGB2GRAY, cv2.COLOR_RGB2BGR),
+    "bgra8": (4, cv2.COLOR_BGRA2GRAY, cv2.COLOR_BGRA2BGR),
+    "rgba8": (4, cv2.COLOR_RGBA2GRAY, cv2.COLOR_RGBA2BGR),
+    "bayer_rggb8": (1, cv2.COLOR_BayerBG2GRAY, cv2.COLOR_BayerBG2BGR),
+    "bayer_bggr8": (1, cv2.COLOR_BayerRG2GRAY, cv2.COLOR_BayerRG2BGR),
+    "bayer_gbrg8": (1, cv2.COLOR_BayerGR2GRAY, cv2.COLOR_BayerGR2BGR),
+    "bayer_grbg8": (1, cv2.COLOR_BayerGB2GRAY, cv2.COLOR_BayerGB2BGR)}
+
+
+def image_view(msg):
+    """
+    View the pixels of an 8 bit image message as a numpy array, without copying.
+    The view is read only and keeps the row padding of msg.step out of the image.
+    ----------
+    Args:
+        msg {Image}: The image message, with an encoding from ENCODINGS.
+    ----------
+    Returns:
+        np.array: (H,W) or (H,W,C) uint8 view of msg.data.
+    """
+    channels = ENCODINGS[msg.encoding][0]
+    rows = np.frombuffer(msg.data, dtype=np.uint8, count=msg.height * msg.step)
+    img = rows.reshape(msg.height, msg.step)[:, :msg.width * channels]
+    if channels == 1:
+        return img
+    return img.reshape(msg.height, msg.width, channels)
+
+
+class ImageFrame(object):
+    def __init__(self, msg, bridge=None):
+        """
+        A camera image prepared for detection. Detection gets a single channel image,
+        converted straight from msg.data (mono8 is used as is). The colour image is
+        only rebuilt when bgr() is called, i.e. when the annotated image is rendered.
+        Encodings outside ENCODINGS go through cv_bridge as before.
+        ----------
+        Args:
+            msg {Image}: The image message.
+            bridge {CvBridge}: Used for other encodings.
+        ----------
+            self.gray {np.array}: (H,W) image for detection. Read only.
+            self.header {Header}: The header of the image message.
+        """
+        self.header = msg.header
+        self.encoding = msg.encoding
+        if msg.encoding in ENCODINGS:
+            self.raw = image_view(msg)
+            to_gray = ENCODINGS[msg.encoding][1]
+            self.gray = self.raw if to_gray is None else cv2.cvtColor(self.raw, to_gray)
+        else:
+            bridge = CvBridge() if bridge is None else bridge
+            self.encoding = "bgr8"
+            self.raw = bridge.imgmsg_to_cv2(msg, "bgr8")
+            self.gray = cv2.cvtColor(self.raw, cv2.COLOR_BGR2GRAY)
+
+    def bgr(self):
+        """
+        Returns:
+            np.array: (H,W,3) writable BGR image, owned by the caller.
+        """
+        to_bgr = ENCODINGS[self.encoding][2]
+        if to_bgr is None:
+            return self.raw.copy()
+        return cv2.cvtColor(self.raw, to_bgr)
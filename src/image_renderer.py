@@ -0,0 +1,93 @@
+import threading
+
+import cv2
+import numpy as np
+import rospy
+from sensor_msgs.msg import Image
+from cv_bridge import CvBridge, CvBridgeError
+
+import image_io
+
+
+class AnnotatedImagePublisher(object):
+    def __init__(self, detector, topic="aruco_img", max_rate=0.0, scale=1.0):
+        """
+        Publishes the image with drawn markers from a background worker thread.
+        Nothing is drawn or encoded while the topic has no subscribers, and only the
+        newest submitted frame is rendered, so detection never waits on drawing.
+        ----------
+        Args:
+            detector {ArucoDetector}: The detector used to draw the markers.
+            topic {string}: The topic the annotated image is published on.
+            max_rate {float}: Maximum publishing rate in Hz. 0 renders every frame.
+            scale {float}: Scale of the published image relative to the camera image.
+        """
+        self.detector = detector
+        self.max_rate = float(max_rate)
+        self.scale = float(scale)
+        self.bridge = CvBridge()
+        self.aruco_pub = rospy.Publisher(topic, Image, queue_size=1)
+
+        self.last_submit_time = None
+        self.pending = None
+        self.lock = threading.Lock()
+        self.new_frame = threading.Event()
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def wants_frame(self):
+        """
+        Whether a frame submitted now would be rendered.
+        """
+        if self.aruco_pub.get_num_connections() == 0:
+            return False
+        if self.max_rate > 0 and self.last_submit_time is not None:
+            return rospy.get_time() - self.last_submit_time >= 1.0 / self.max_rate
+        return True
+
+    def submit(self, img, corners, ids, rejected, rvecs, tvecs, camera_matrix, dist_coeffs, header=None):
+        """
+        Hand a frame and its detections to the render worker. img is a BGR image the
+        worker owns afterwards and may draw on, or an image_io.ImageFrame whose colour
+        image is rebuilt on the worker. Older frames that were not yet rendered are dropped.
+        """
+        if not self.wants_frame():
+            return
+        self.last_submit_time = rospy.get_time()
+        with self.lock:
+            self.pending = (img, corners, ids, rejected, rvecs, tvecs,
+                            camera_matrix, dist_coeffs, header)
+        self.new_frame.set()
+
+    def run(self):
+        while not rospy.is_shutdown():
+            if not self.new_frame.wait(0.5):
+                continue
+            with self.lock:
+                frame, self.pending = self.pending, None
+                self.new_frame.clear()
+            if frame is None:
+                continue
+            try:
+                self.render(*frame)
+            except (cv2.error, CvBridgeError) as e:
+                rospy.logwarn("Failed to render the aruco image: {}".format(e))
+
+    def render(self, img, corners, ids, rejected, rvecs, tvecs, camera_matrix, dist_coeffs, header):
+        if isinstance(img, image_io.ImageFrame):
+            img = img.bgr()
+        if self.scale != 1.0:
+            img = cv2.resize(img, None, fx=self.scale, fy=self.scale,
+                             interpolation=cv2.INTER_AREA)
+            corners = [c * self.scale for c in corners]
+            rejected = [c * self.scale for c in rejected]
+            camera_matrix = np.array(camera_matrix, dtype=np.float64)
+            camera_matrix[0:2, :] *= self.scale
+
+        output_img = self.detector.draw(
+            img, corners, ids, rejected, rvecs, tvecs, camera_matrix, dist_coeffs)
+        out_img = self.bridge.cv2_to_imgmsg(output_img, "bgr8")
+        if header is not None:
+            out_img.header = header
+        self.aruco_pub.publish(out_img)
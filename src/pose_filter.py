@@ -0,0 +1,134 @@
+import threading
+
+import numpy as np
+import tf
+
+import utils
+
+
+class ConstantVelocityPoseFilter(object):
+    def __init__(self, acceleration_noise=1.0, angular_acceleration_noise=2.0,
+                 translation_noise=0.005, rotation_noise=0.02, timeout=0.5):
+        """
+        Kalman filter of a pose moving with constant linear and angular velocity.
+        Measurements are folded in whenever detection results arrive, and the pose can
+        be predicted for any later time, e.g. to publish it faster than detection runs.
+
+        The translation and the rotation (as a rotation vector around the current
+        orientation estimate) are six independent axes, each with a [value, rate] state.
+        ----------
+        Args:
+            acceleration_noise {float}: Process noise, linear acceleration std in m/s^2.
+            angular_acceleration_noise {float}: Process noise, angular acceleration std in rad/s^2.
+            translation_noise {float}: Measurement noise, translation std in m.
+            rotation_noise {float}: Measurement noise, rotation std in rad.
+            timeout {float}: After this many s without a measurement the pose is no
+                longer predicted and the next measurement restarts the filter.
+        ----------
+            self.x {np.array}: (6,2) [value, rate] of x, y, z and of the rotation vector axes.
+            self.P {np.array}: (6,2,2) covariance of each axis.
+            self.quat {np.array}: (4,) orientation around which the rotation vector is defined.
+            self.stamp {float}: Time of the state in s, None before the first measurement.
+        """
+        self.process_noise = np.repeat(
+            [acceleration_noise**2, angular_acceleration_noise**2], 3)
+        self.measurement_noise = np.repeat(
+            [translation_noise**2, rotation_noise**2], 3)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.x = np.zeros((6, 2))
+            self.P = np.zeros((6, 2, 2))
+            self.quat = np.array([0.0, 0.0, 0.0, 1.0])
+            self.stamp = None
+
+    def transition(self, dt):
+        """
+        Returns:
+            F {np.array}: (2,2) state transition over dt.
+            Q {np.array}: (6,2,2) process noise of each axis over dt (white acceleration).
+        """
+        F = np.array([[1.0, dt], [0.0, 1.0]])
+        Q = np.array([[dt**3 / 3.0, dt**2 / 2.0], [dt**2 / 2.0, dt]])
+        return F, self.process_noise[:, np.newaxis, np.newaxis] * Q
+
+    def extrapolate(self, dt):
+        """
+        Returns:
+            trans {np.array}: (3,) the position after dt.
+            quat {np.array}: (4,) the orientation after dt.
+        """
+        trans = self.x[0:3, 0] + self.x[0:3, 1] * dt
+        rotation = utils.rvecs_to_quaternions(self.x[3:6, 0] + self.x[3:6, 1] * dt)[0]
+        return trans, tf.transformations.quaternion_multiply(rotation, self.quat)
+
+    def update(self, stamp, trans, quat):
+        """
+        Fold in a measured pose.
+        ----------
+        Args:
+            stamp {float}: Time of the measurement in s, e.g. the image stamp.
+            trans {np.array}: (3,) measured position.
+            quat {np.array}: (4,) measured orientation.
+        """
+        with self.lock:
+            if self.stamp is None or stamp - self.stamp > self.timeout:
+                self.start(stamp, trans, quat)
+                return
+            # Late measurements are applied at the time of the state
+            dt = max(stamp - self.stamp, 0.0)
+
+            # Predict, the rotation over dt is moved into the reference orientation
+            F, Q = self.transition(dt)
+            x = np.einsum("ij,nj->ni", F, self.x)
+            P = np.einsum("ij,njk,lk->nil", F, self.P, F) + Q
+            pred_trans, pred_quat = self.extrapolate(dt)
+            x[3:6, 0] = 0.0
+
+            # Innovation: the translation error and the rotation from the prediction
+            innovation = np.empty(6)
+            innovation[0:3] = np.asarray(trans, dtype=np.float64) - pred_trans
+            innovation[3:6] = utils.quaternions_to_rvecs(tf.transformations.quaternion_multiply(
+                quat, tf.transformations.quaternion_inverse(pred_quat)))[0]
+
+            # Only the value of each axis is measured: H = [1, 0]
+            S = P[:, 0, 0] + self.measurement_noise
+            K = P[:, :, 0] / S[:, np.newaxis]
+            x += K * innovation[:, np.newaxis]
+            P = P - K[:, :, np.newaxis] * P[:, np.newaxis, 0, :]
+
+            # Move the rotation correction into the reference orientation
+            correction = utils.rvecs_to_quaternions(x[3:6, 0])[0]
+            self.quat = utils.normalize_quaternion(
+                tf.transformations.quaternion_multiply(correction, pred_quat))
+            x[3:6, 0] = 0.0
+            self.x, self.P, self.stamp = x, P, stamp
+
+    def start(self, stamp, trans, quat):
+        # At rest, with the measurement noise on the pose and a large rate uncertainty
+        self.x = np.zeros((6, 2))
+        self.x[0:3, 0] = trans
+        self.quat = utils.normalize_quaternion(quat)
+        self.P = np.zeros((6, 2, 2))
+        self.P[:, 0, 0] = self.measurement_noise
+        self.P[:, 1, 1] = self.process_noise * self.timeout
+        self.stamp = stamp
+
+    def predict(self, stamp):
+        """
+        Predict the pose at a time after the last measurement, without changing the state.
+        ----------
+        Args:
+            stamp {float}: The time in s.
+        ----------
+        Returns:
+            trans {np.array}: (3,) predicted position, None if there is no recent measurement.
+            quat {np.array}: (4,) predicted orientation, None if there is no recent measurement.
+        """
+        with self.lock:
+            if self.stamp is None or stamp - self.stamp > self.timeout:
+                return None, None
+            return self.extrapolate(max(stamp - self.stamp, 0.0))
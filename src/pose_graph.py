@@ -0,0 +1,144 @@
+from collections import defaultdict, deque
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+
+def connected_nodes(edge_ids, root):
+    """
+    Find the nodes connected to root.
+    ----------
+    Args:
+        edge_ids {np.array}: (E,2) node ids of each edge.
+        root {int}: The id of the root node.
+    ----------
+    Returns:
+        set: The ids of the nodes connected to root, root included.
+    """
+    graph = defaultdict(list)
+    for a, b in edge_ids:
+        graph[a].append(b)
+        graph[b].append(a)
+
+    explored = set([root])
+    queue = deque([root])
+    while queue:
+        node = queue.popleft()
+        for neighbour in graph[node]:
+            if neighbour not in explored:
+                explored.add(neighbour)
+                queue.append(neighbour)
+    return explored
+
+
+def project_to_rotations(matrices):
+    """
+    Closest rotation matrix (in the Frobenius norm) to each 3x3 matrix.
+    """
+    U, _, Vt = np.linalg.svd(matrices)
+    # Flip the last axis where the closest orthogonal matrix is a reflection
+    det = np.linalg.det(np.einsum("nij,njk->nik", U, Vt))
+    U[:, :, 2] *= np.where(det < 0, -1.0, 1.0)[:, np.newaxis]
+    return np.einsum("nij,njk->nik", U, Vt)
+
+
+def block_matrix(rows, cols, blocks, n):
+    """
+    Sparse (3n,3n) matrix from 3x3 blocks, blocks at the same position are summed.
+    ----------
+    Args:
+        rows {np.array}: (K,) block row of each block.
+        cols {np.array}: (K,) block column of each block.
+        blocks {np.array}: (K,3,3) the blocks.
+        n {int}: Number of block rows and columns.
+    """
+    offsets = np.arange(3)
+    row_index = 3 * rows[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis]
+    col_index = 3 * cols[:, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]
+    row_index, col_index = np.broadcast_arrays(row_index, col_index)
+    return scipy.sparse.coo_matrix(
+        (np.reshape(blocks, -1), (np.reshape(row_index, -1), np.reshape(col_index, -1))),
+        shape=(3 * n, 3 * n)).tocsc()
+
+
+def solve_pose_graph(edge_ids, edge_tfs, weights, id_root):
+    """
+    Find the pose of every node relative to the root node from all measured relative
+    transforms at once, instead of chaining them along one path.
+
+    Minimises sum(w_ab * |X_b - X_a * E_ab|^2) over the node poses X, with X_root = I.
+    The rotations are solved first (chordal relaxation, projected back to SO(3)),
+    then the translations. Both are sparse linear least squares problems on the graph,
+    with one nonzero block per node and per edge.
+    ----------
+    Args:
+        edge_ids {np.array}: (E,2) node ids [a,b] of each edge.
+        edge_tfs {np.array}: (E,4,4) measured transform of each edge, inv(T_a) * T_b.
+        weights {np.array}: (E,) weight of each edge, e.g. the number of measurements.
+        id_root {int}: The id of the root node. Its pose is the identity.
+    ----------
+    Returns:
+        poses {dict}: {node_id: 4x4 pose of the node in the root frame}, for the nodes
+            connected to the root.
+    """
+    edge_ids = np.reshape(np.asarray(edge_ids, dtype=np.int64), (-1, 2))
+    edge_tfs = np.reshape(np.asarray(edge_tfs, dtype=np.float64), (-1, 4, 4))
+    weights = np.reshape(np.asarray(weights, dtype=np.float64), -1)
+
+    nodes = connected_nodes(edge_ids, id_root)
+    nodes.discard(id_root)
+    nodes = sorted(nodes)
+    poses = {id_root: np.eye(4)}
+    if len(nodes) == 0:
+        return poses
+
+    # Unknowns are indexed 0..n-1, the root is -1
+    index = dict((node, i) for i, node in enumerate(nodes))
+    keep = np.array([a in index or a == id_root for a, _ in edge_ids], dtype=bool)
+    edge_ids, edge_tfs, weights = edge_ids[keep], edge_tfs[keep], weights[keep]
+    a = np.array([index.get(node, -1) for node in edge_ids[:, 0]], dtype=np.int64)
+    b = np.array([index.get(node, -1) for node in edge_ids[:, 1]], dtype=np.int64)
+    n = len(nodes)
+    Q = edge_tfs[:, 0:3, 0:3]
+    p = edge_tfs[:, 0:3, 3]
+    w = weights[:, np.newaxis, np.newaxis]
+
+    #---- Rotations: each row of R_b - R_a * Q_ab is independent ----#
+    # Normal equations with one 3x3 block per node pair, shared by the three rows
+    B = np.zeros((n, 3, 3))
+    identity = np.eye(3)[np.newaxis] * w
+    a_known, b_known = a >= 0, b >= 0
+    both = a_known & b_known
+    A = block_matrix(
+        np.concatenate([a[a_known], b[b_known], a[both], b[both]]),
+        np.concatenate([a[a_known], b[b_known], b[both], a[both]]),
+        np.concatenate([identity[a_known], identity[b_known], -w[both] * Q[both],
+                        -w[both] * np.transpose(Q[both], (0, 2, 1))]), n)
+    # Edges to the root move to the right hand side, with R_root = I
+    np.add.at(B, b[b_known & ~a_known], (w * np.transpose(Q, (0, 2, 1)))[b_known & ~a_known])
+    np.add.at(B, a[a_known & ~b_known], (w * Q)[a_known & ~b_known])
+
+    # Column i of the solution block of a node is row i of its rotation
+    X = np.reshape(scipy.sparse.linalg.spsolve(A, B.reshape(3 * n, 3)), (3 * n, 3))
+    R = project_to_rotations(np.transpose(X.reshape(n, 3, 3), (0, 2, 1)))
+
+    #---- Translations: t_b - t_a = R_a * p_ab, with t_root = 0 ----#
+    R_a = np.concatenate([R, np.eye(3)[np.newaxis]])[a]
+    offsets = np.einsum("nij,nj->ni", R_a, p) * weights[:, np.newaxis]
+    L = scipy.sparse.coo_matrix(
+        (np.concatenate([weights[a_known], weights[b_known], -weights[both], -weights[both]]),
+         (np.concatenate([a[a_known], b[b_known], a[both], b[both]]),
+          np.concatenate([a[a_known], b[b_known], b[both], a[both]]))),
+        shape=(n, n)).tocsc()
+    rhs = np.zeros((n, 3))
+    np.add.at(rhs, b[b_known], offsets[b_known])
+    np.add.at(rhs, a[a_known], -offsets[a_known])
+    t = np.reshape(scipy.sparse.linalg.spsolve(L, rhs), (n, 3))
+
+    for i, node in enumerate(nodes):
+        pose = np.eye(4)
+        pose[0:3, 0:3] = R[i]
+        pose[0:3, 3] = t[i]
+        poses[node] = pose
+    return poses
@@ -0,0 +1,74 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class PoseResultCache(object):
+    def __init__(self, max_size=32, hash_content=False):
+        """
+        Bounded LRU cache of estimated poses, keyed by the image header and the camera
+        model, so a snapshot asked about several times is only detected once.
+        ----------
+        Args:
+            max_size {int}: Number of results to keep. 0 disables the cache.
+            hash_content {bool}: Add a hash of the image data to the key. Also allows
+                caching images without a stamp.
+        ----------
+            self.hits {int}: Number of lookups answered from the cache.
+            self.misses {int}: Number of lookups that had to run the detection.
+        """
+        self.max_size = max_size
+        self.hash_content = hash_content
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, image, K, D, marker_transforms=None):
+        """
+        Args:
+            marker_transforms {MarkerTransformTable}: The table the pose is computed with. Compared
+                by identity, so poses computed before a reload are never returned after it.
+        ----------
+        Returns:
+            tuple: The cache key of the image, None if the image can not be cached.
+        """
+        if self.max_size <= 0:
+            return None
+        header = image.header
+        key = (header.frame_id, header.stamp.secs, header.stamp.nsecs, header.seq,
+               K.tobytes(), D.tobytes(), marker_transforms)
+        if self.hash_content:
+            return key + (hashlib.sha1(image.data).digest(),)
+        if header.stamp.secs == 0 and header.stamp.nsecs == 0:
+            # Unstamped images of different snapshots would share a key
+            return None
+        return key
+
+    def get(self, key):
+        """
+        Returns:
+            found {bool}: Whether a result is stored for key.
+            Pose: The stored pose, None if the object was not found in that image.
+        """
+        with self.lock:
+            if key is None or key not in self.results:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            pose = self.results.pop(key)
+            self.results[key] = pose
+            return True, pose
+
+    def put(self, key, pose):
+        if key is None:
+            return
+        with self.lock:
+            self.results.pop(key, None)
+            while len(self.results) >= self.max_size:
+                self.results.popitem(last=False)
+            self.results[key] = pose
+
+    def stats(self):
+        return "hits: {}, misses: {}, size: {}/{}".format(
+            self.hits, self.misses, len(self.results), self.max_size)
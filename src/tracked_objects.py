@@ -0,0 +1,234 @@
+import cv2
+import numpy as np
+from geometry_msgs.msg import Pose
+
+import aruco_detector
+import utils
+
+
+class TrackedObject(object):
+    def __init__(self, name, main_marker_id, marker_transforms, marker_transform_file=None):
+        """
+        A rigid object carrying a set of markers.
+        ----------
+        Args:
+            name {string}: The name of the object. A TF frame with that name is broadcast.
+            main_marker_id {int}: The id of the main marker. The object pose is its pose.
+            marker_transforms {MarkerTransformTable}: Transforms from the other markers to the main marker.
+            marker_transform_file {string}: The file marker_transforms was loaded from.
+        ----------
+            self.obj_transform {Pose}: The last broadcast pose of the object, used for smoothing.
+            self.pnp_guess {tuple}: (rvec, tvec) of the last joint PnP solve, None while the object is not seen.
+            self.filter {ConstantVelocityPoseFilter}: Filter of the object pose, None if not filtered.
+            self.last_measurement {tuple}: (stamp, trans, quat, marker count) of the last estimated pose,
+                None while the object is not seen.
+        """
+        self.name = name
+        self.main_marker_id = int(main_marker_id)
+        self.marker_transforms = marker_transforms
+        self.marker_transform_file = marker_transform_file
+        self.obj_transform = Pose()
+        self.pnp_guess = None
+        self.filter = None
+        self.last_measurement = None
+        self.object_points_cache = None  # (marker_transforms, marker_size, ids, points)
+
+    def marker_ids(self, marker_transforms=None):
+        """
+        Returns:
+            np.array: The ids of all markers of the object, main marker included.
+        """
+        if marker_transforms is None:
+            marker_transforms = self.marker_transforms
+        return np.union1d(marker_transforms.ids, [self.main_marker_id]).astype(np.int64)
+
+    def object_points(self, marker_size):
+        """
+        Corners of every marker of the object in the object (main marker) frame. Built once
+        per marker transform table.
+        ----------
+        Args:
+            marker_size {float}: The size of the markers in m.
+        ----------
+        Returns:
+            ids {np.array}: (M,) sorted marker ids.
+            points {np.array}: (M,4,3) corners of each marker, in the corner order of detectMarkers.
+        """
+        marker_transforms = self.marker_transforms
+        cached = self.object_points_cache
+        if cached is not None and cached[0] is marker_transforms and cached[1] == marker_size:
+            return cached[2], cached[3]
+
+        ids = self.marker_ids(marker_transforms)
+        # The table holds the object pose in each marker frame, the inverse is the marker pose
+        marker_poses = np.tile(np.eye(4), (len(ids), 1, 1))
+        rows = marker_transforms.lookup(ids)
+        in_table = (rows >= 0) & (ids != self.main_marker_id)
+        offsets = marker_transforms.transforms[rows[in_table]]
+        rotations = np.transpose(offsets[:, 0:3, 0:3], (0, 2, 1))
+        marker_poses[in_table, 0:3, 0:3] = rotations
+        marker_poses[in_table, 0:3, 3] = -np.einsum("nij,nj->ni", rotations, offsets[:, 0:3, 3])
+
+        corners = aruco_detector.marker_corner_points(marker_size)
+        points = (np.einsum("nij,kj->nki", marker_poses[:, 0:3, 0:3], corners)
+                  + marker_poses[:, np.newaxis, 0:3, 3])
+        self.object_points_cache = (marker_transforms, marker_size, ids, points)
+        return ids, points
+
+    def estimate_pose(self, detected_ids, corners, marker_size, camera_matrix, dist_coeffs,
+                      ransac=False, reprojection_error=3.0, warm_start=True):
+        """
+        Estimate the object pose from the corners of all its detected markers in one solvePnP
+        (or solvePnPRansac) call, instead of one pose per marker.
+        ----------
+        Args:
+            detected_ids {np.array}: (N,) detected ids of the markers of this object.
+            corners {np.array}: (N,4,2) their corners in the image.
+            marker_size {float}: The size of the markers in m.
+            camera_matrix {np.array}: The camera matrix.
+            dist_coeffs {np.array}: The distortion coefficients.
+            ransac {bool}: Reject outlier corners with solvePnPRansac.
+            reprojection_error {float}: Maximum reprojection error of a RANSAC inlier in pixels.
+            warm_start {bool}: Start from the pose of the previous frame, if the object was seen.
+        ----------
+        Returns:
+            trans {np.array}: (3,) position of the object, None if the solve failed.
+            quat {np.array}: (4,) orientation of the object, None if the solve failed.
+            inliers {np.array}: (N,) mask of the markers used in the pose.
+        """
+        detected_ids = np.asarray(detected_ids, dtype=np.int64).reshape(-1)
+        ids, points = self.object_points(marker_size)
+        rows = np.minimum(np.searchsorted(ids, detected_ids), len(ids) - 1)
+        known = ids[rows] == detected_ids
+        inliers = np.zeros(len(detected_ids), dtype=bool)
+        if not np.any(known):
+            self.pnp_guess = None
+            return None, None, inliers
+
+        object_points = np.ascontiguousarray(points[rows[known]].reshape(-1, 3))
+        image_points = np.ascontiguousarray(np.reshape(corners, (-1, 4, 2))[known].reshape(-1, 2),
+                                            dtype=np.float64)
+        guess = self.pnp_guess if warm_start else None
+        rvec, tvec = (None, None) if guess is None else (guess[0].copy(), guess[1].copy())
+        if ransac:
+            success, rvec, tvec, point_inliers = cv2.solvePnPRansac(
+                object_points, image_points, camera_matrix, dist_coeffs, rvec, tvec,
+                useExtrinsicGuess=guess is not None, reprojectionError=reprojection_error)
+        else:
+            success, rvec, tvec = cv2.solvePnP(
+                object_points, image_points, camera_matrix, dist_coeffs, rvec, tvec,
+                useExtrinsicGuess=guess is not None, flags=cv2.SOLVEPNP_ITERATIVE)
+            point_inliers = np.arange(len(object_points))
+        if not success or point_inliers is None:
+            self.pnp_guess = None
+            return None, None, inliers
+
+        # A marker is an inlier if most of its corners are
+        corner_inliers = np.zeros(len(object_points), dtype=bool)
+        corner_inliers[np.reshape(point_inliers, -1)] = True
+        inliers[known] = np.sum(corner_inliers.reshape(-1, 4), axis=1) >= 3
+
+        self.pnp_guess = (rvec, tvec)
+        return np.reshape(tvec, 3), utils.rvecs_to_quaternions(rvec)[0], inliers
+
+
+class ObjectIndex(object):
+    def __init__(self, objects):
+        """
+        Lookup table from marker id to the object carrying the marker, so the markers of
+        one detection pass are split between all objects at once.
+        ----------
+        Args:
+            objects {list}: The TrackedObjects. A marker id may belong to one object only.
+        ----------
+            self.objects {list}: The TrackedObjects.
+            self.rows {np.array}: Lookup table from marker id to object index, -1 for unknown ids.
+        """
+        self.objects = objects
+        self.tables = ()
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.refresh()
+
+    def refresh(self):
+        """
+        Rebuild the lookup table if the marker transforms of an object were replaced
+        (e.g. reloaded). The previous table is kept if the new one is invalid.
+        ----------
+        Raises:
+            ValueError: A marker id belongs to several objects.
+        """
+        tables = tuple(obj.marker_transforms for obj in self.objects)
+        if len(tables) == len(self.tables) and all(a is b for a, b in zip(tables, self.tables)):
+            return
+        # A failed build is only retried after a table changes again
+        self.tables = tables
+
+        marker_ids = [obj.marker_ids(table) for obj, table in zip(self.objects, tables)]
+        all_ids = np.concatenate(marker_ids)
+        unique_ids, counts = np.unique(all_ids, return_counts=True)
+        if np.any(counts > 1):
+            raise ValueError("Marker ids {} belong to several objects".format(
+                unique_ids[counts > 1].tolist()))
+        if np.any(all_ids < 0):
+            raise ValueError("Negative marker ids {}".format(all_ids[all_ids < 0].tolist()))
+
+        size = int(unique_ids[-1]) + 1 if len(unique_ids) > 0 else 0
+        rows = np.full(size, -1, dtype=np.int64)
+        for i, ids in enumerate(marker_ids):
+            rows[ids] = i
+        self.rows = rows
+
+    def lookup(self, marker_ids):
+        """
+        Map marker ids to objects.
+        ----------
+        Args:
+            marker_ids {np.array}: (N,) marker ids.
+        ----------
+        Returns:
+            rows {np.array}: (N,) index of the object of each marker, -1 for unknown ids.
+        """
+        marker_ids = np.asarray(marker_ids, dtype=np.int64).reshape(-1)
+        rows = self.rows
+        object_rows = np.full(len(marker_ids), -1, dtype=np.int64)
+        valid = (marker_ids >= 0) & (marker_ids < len(rows))
+        object_rows[valid] = rows[marker_ids[valid]]
+        return object_rows
+
+    def split(self, marker_ids):
+        """
+        Group the detected markers by object.
+        ----------
+        Args:
+            marker_ids {np.array}: (N,) detected ids.
+        ----------
+        Returns:
+            groups {list}: (TrackedObject, mask) for each object with at least one detected
+                marker, mask being the (N,) mask of its markers.
+            unknown {np.array}: (N,) mask of the markers of no object.
+        """
+        object_rows = self.lookup(marker_ids)
+        groups = [(self.objects[row], object_rows == row)
+                  for row in np.unique(object_rows[object_rows >= 0])]
+        return groups, object_rows < 0
+
+
+def object_configs(params):
+    """
+    The object configurations of the node parameters.
+    ----------
+    Args:
+        params {dict}: The node parameters. Either "objects", a list of dicts with
+            aruco_obj_id, aruco_main_marker_id and aruco_transforms, or those three
+            parameters for a single object.
+    ----------
+    Returns:
+        list: One dict per object.
+    """
+    if params.get("objects", None) is not None:
+        return params["objects"]
+    return [{
+        "aruco_obj_id": params["aruco_obj_id"],
+        "aruco_main_marker_id": params["aruco_main_marker_id"],
+        "aruco_transforms": params["aruco_transforms"],
+    }]
@@ -0,0 +1,69 @@
+import os
+
+import rospy
+from std_srvs.srv import Trigger, TriggerResponse
+
+import transform_table
+
+
+class MarkerTransformReloader(object):
+    def __init__(self, marker_transform_file, consumers, period=1.0, service_name='aruco_reload_transforms'):
+        """
+        Reloads the marker transforms when the file changes or the reload service
+        (aruco_reload_transforms by default) is called. The new table is parsed completely first and then swapped in
+        with one attribute assignment per consumer, so a frame sees either the old or
+        the new table, never a mix.
+        ----------
+        Args:
+            marker_transform_file {string}: The file containing the marker transforms.
+            consumers {list}: Objects whose marker_transforms attribute is replaced.
+            period {float}: How often the file modification time is checked in s. 0 disables it.
+            service_name {string}: The name of the reload service.
+        """
+        self.marker_transform_file = marker_transform_file
+        self.consumers = consumers
+        self.file_stamp = self.read_file_stamp()
+
+        self.reload_srv = rospy.Service(service_name, Trigger, self.reload_cb)
+        self.timer = None
+        if period > 0:
+            self.timer = rospy.Timer(rospy.Duration(period), self.check)
+
+    def read_file_stamp(self):
+        try:
+            stat = os.stat(self.marker_transform_file)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+    def check(self, event=None):
+        file_stamp = self.read_file_stamp()
+        if file_stamp is not None and file_stamp != self.file_stamp:
+            self.reload()
+
+    def reload(self):
+        """
+        Returns:
+            success {bool}: Whether the new table was loaded.
+            message {string}: What was loaded, or the error.
+        """
+        # Stamp before loading, a write during loading triggers another reload
+        file_stamp = self.read_file_stamp()
+        try:
+            table = transform_table.load_marker_transforms(self.marker_transform_file)
+        except Exception as e:
+            # Keep the current table, e.g. while the file is still being written
+            message = "Failed to reload the marker transforms: {}".format(e)
+            rospy.logerr(message)
+            return False, message
+
+        self.file_stamp = file_stamp
+        for consumer in self.consumers:
+            consumer.marker_transforms = table
+        message = "Reloaded {} marker transforms from {}".format(len(table), self.marker_transform_file)
+        rospy.loginfo(message)
+        return True, message
+
+    def reload_cb(self, req):
+        success, message = self.reload()
+        return TriggerResponse(success=success, message=message)
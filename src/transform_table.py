@@ -0,0 +1,187 @@
+import os
+import struct
+
+import numpy as np
+
+import utils
+
+# Binary marker transform file:
+#   header: 8 byte magic, uint32 version, uint32 marker count N (little endian)
+#   N int64 sorted marker ids
+#   N x 4 x 4 float64 transforms, in the order of the ids
+# Every block is 8 byte aligned, so the file can be memory mapped as is.
+MAGIC = b"ARUCOMKT"
+VERSION = 1
+HEADER = struct.Struct("<8sII")
+
+
+def is_table_file(marker_transform_file):
+    with open(marker_transform_file, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load_marker_transforms(marker_transform_file, mmap=True):
+    """
+    Loads the marker transforms saved by the calibration. Accepts the binary table
+    format and the legacy .npz file with a pickled dictionary.
+    ----------
+    Args:
+        marker_transform_file {string}: The file containing the marker transforms.
+        mmap {bool}: Memory map a binary table instead of reading it, so processes
+            loading the same file share one page cached copy.
+    ----------
+    Returns:
+        MarkerTransformTable: The marker transforms.
+    """
+    if is_table_file(marker_transform_file):
+        return load_table(marker_transform_file, mmap)
+    return load_legacy(marker_transform_file)
+
+
+def load_legacy(marker_transform_file):
+    """
+    Loads a legacy .npz file. Unpickles the stored dictionary, only load trusted files.
+    """
+    load_unformated = np.load(marker_transform_file, allow_pickle=True)
+    return MarkerTransformTable.from_dict(load_unformated['mk_tf_dict'][()])
+
+
+def load_table(marker_transform_file, mmap=True):
+    """
+    Loads a binary table file, without unpickling anything.
+    """
+    with open(marker_transform_file, "rb") as f:
+        magic, version, count = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError("{} is not a marker transform file".format(marker_transform_file))
+    if version != VERSION:
+        raise ValueError("Unsupported marker transform file version {}".format(version))
+
+    ids_offset = HEADER.size
+    transforms_offset = ids_offset + 8 * count
+    if count == 0:
+        return MarkerTransformTable(np.zeros(0, dtype=np.int64), np.zeros((0, 4, 4)))
+    if mmap:
+        ids = np.memmap(marker_transform_file, dtype="<i8", mode="r",
+                        offset=ids_offset, shape=(count,))
+        transforms = np.memmap(marker_transform_file, dtype="<f8", mode="r",
+                               offset=transforms_offset, shape=(count, 4, 4))
+    else:
+        with open(marker_transform_file, "rb") as f:
+            f.seek(ids_offset)
+            ids = np.frombuffer(f.read(8 * count), dtype="<i8")
+            transforms = np.frombuffer(f.read(128 * count), dtype="<f8").reshape(count, 4, 4)
+    return MarkerTransformTable(ids, transforms)
+
+
+def save_table(marker_transform_file, table):
+    """
+    Saves a MarkerTransformTable in the binary table format. The file is written
+    next to the target and renamed over it, so readers (and memory maps of the old
+    file) never see a partially written table.
+    """
+    tmp_file = marker_transform_file + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(table)))
+        f.write(np.ascontiguousarray(table.ids, dtype="<i8").tobytes())
+        f.write(np.ascontiguousarray(table.transforms, dtype="<f8").tobytes())
+    os.rename(tmp_file, marker_transform_file)
+
+
+class MarkerTransformTable(object):
+    def __init__(self, ids, transforms):
+        """
+        Marker to object transforms stored as one contiguous (N,4,4) array.
+        ----------
+        Args:
+            ids {np.array}: (N,) marker ids.
+            transforms {np.array}: (N,4,4) transform from each marker to the main marker.
+        ----------
+            self.ids {np.array}: (N,) sorted marker ids.
+            self.transforms {np.array}: (N,4,4) transforms, in the order of self.ids.
+            self.rows {np.array}: Lookup table from marker id to row, -1 for unknown ids.
+        """
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        transforms = np.asarray(transforms, dtype=np.float64).reshape(-1, 4, 4)
+        if np.all(ids[1:] > ids[:-1]):
+            # Already sorted, e.g. a memory mapped table file: keep it without copying
+            self.ids = ids
+            self.transforms = np.ascontiguousarray(transforms)
+        else:
+            order = np.argsort(ids)
+            self.ids = ids[order]
+            self.transforms = np.ascontiguousarray(transforms[order])
+
+        size = int(self.ids[-1]) + 1 if len(self.ids) > 0 else 0
+        self.rows = np.full(size, -1, dtype=np.int64)
+        self.rows[self.ids] = np.arange(len(self.ids))
+
+    @classmethod
+    def from_dict(cls, mk_tf_dict):
+        """
+        Build the table from a {marker_id: 4x4 matrix} dictionary.
+        """
+        ids = sorted(mk_tf_dict.keys())
+        transforms = [mk_tf_dict[marker_id] for marker_id in ids]
+        return cls(ids, np.reshape(transforms, (-1, 4, 4)))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, marker_id):
+        return 0 <= marker_id < len(self.rows) and self.rows[marker_id] >= 0
+
+    def __getitem__(self, marker_id):
+        if marker_id not in self:
+            raise KeyError(marker_id)
+        return self.transforms[self.rows[marker_id]]
+
+    def __repr__(self):
+        return "MarkerTransformTable(ids={})".format(self.ids.tolist())
+
+    def lookup(self, marker_ids):
+        """
+        Map marker ids to rows of self.transforms.
+        ----------
+        Args:
+            marker_ids {np.array}: (N,) marker ids.
+        ----------
+        Returns:
+            rows {np.array}: (N,) row of each marker, -1 for unknown ids.
+        """
+        marker_ids = np.asarray(marker_ids, dtype=np.int64).reshape(-1)
+        rows = np.full(len(marker_ids), -1, dtype=np.int64)
+        valid = (marker_ids >= 0) & (marker_ids < len(self.rows))
+        rows[valid] = self.rows[marker_ids[valid]]
+        return rows
+
+    def object_candidates(self, id_main, marker_ids, marker_trans, marker_quats):
+        """
+        Map the poses of all detected markers to candidate poses of the object.
+        ----------
+        Args:
+            id_main {int}: The id of the main marker. Its pose is the object pose.
+            marker_ids {np.array}: (N,) detected ids.
+            marker_trans {np.array}: (N,3) positions of the markers in the camera frame.
+            marker_quats {np.array}: (N,4) orientations of the markers in the camera frame.
+        ----------
+        Returns:
+            obj_trans {np.array}: (M,3) candidate positions of the object.
+            obj_quats {np.array}: (M,4) candidate orientations of the object.
+            known {np.array}: (N,) mask of the markers that produced a candidate.
+        """
+        marker_ids = np.asarray(marker_ids, dtype=np.int64).reshape(-1)
+        rows = self.lookup(marker_ids)
+        is_main = marker_ids == int(id_main)
+        known = (rows >= 0) | is_main
+
+        # The main marker keeps its own pose
+        offsets = np.tile(np.eye(4), (np.count_nonzero(known), 1, 1))
+        use_table = (rows[known] >= 0) & ~is_main[known]
+        offsets[use_table] = self.transforms[rows[known][use_table]]
+
+        marker_tfs = utils.quat_trans_to_matrices(
+            np.reshape(marker_trans, (-1, 3))[known], np.reshape(marker_quats, (-1, 4))[known])
+        object_tfs = np.einsum("nij,njk->nik", marker_tfs, offsets)
+        obj_trans, obj_quats = utils.matrices_to_quat_trans(object_tfs)
+        return obj_trans, obj_quats, known
@@ -99,3 +99,206 @@ def average_quaternions(quat_list,weights = None):
         max_eigen_vect = np.roll(max_eigen_vect, -1)
         max_eigen_vect = max_eigen_vect
         return normalize_quaternion(max_eigen_vect)
+
+def rvecs_to_quaternions(rvecs):
+    """
+    Converts a stack of Rodrigues rotation vectors to quaternions.
+    ----------
+    Args:
+        rvecs {np.array}: (N,3) rotation vectors
+    ----------
+    Returns:
+        quats {np.array}: (N,4) [q_x, q_y, q_z, q_w] quaternions
+    """
+    rvecs = np.reshape(rvecs, (-1, 3)).astype(np.float64)
+    angles = np.linalg.norm(rvecs, axis=1)
+    # sin(angle/2)/angle, which tends to 0.5 for small angles
+    scale = np.full_like(angles, 0.5)
+    nonzero = angles > 1e-12
+    scale[nonzero] = np.sin(0.5 * angles[nonzero]) / angles[nonzero]
+
+    quats = np.empty((len(rvecs), 4))
+    quats[:, 0:3] = rvecs * scale[:, np.newaxis]
+    quats[:, 3] = np.cos(0.5 * angles)
+    return quats
+
+def quaternions_to_rvecs(quats):
+    """
+    Converts a stack of quaternions to Rodrigues rotation vectors, the inverse of
+    rvecs_to_quaternions. Angles are in [0, pi].
+    ----------
+    Args:
+        quats {np.array}: (N,4) [q_x, q_y, q_z, q_w] quaternions
+    ----------
+    Returns:
+        rvecs {np.array}: (N,3) rotation vectors
+    """
+    quats = np.reshape(quats, (-1, 4)).astype(np.float64)
+    # q and -q are the same rotation, take the one with the smaller angle
+    quats = quats * np.where(quats[:, 3] < 0, -1.0, 1.0)[:, np.newaxis]
+    norms = np.linalg.norm(quats[:, 0:3], axis=1)
+    angles = 2.0 * np.arctan2(norms, quats[:, 3])
+    # angle/sin(angle/2), which tends to 2 for small angles
+    scale = np.full_like(angles, 2.0)
+    nonzero = norms > 1e-12
+    scale[nonzero] = angles[nonzero] / norms[nonzero]
+    return quats[:, 0:3] * scale[:, np.newaxis]
+
+def quaternions_to_matrices(quats):
+    """
+    Converts a stack of quaternions to rotation matrices.
+    ----------
+    Args:
+        quats {np.array}: (N,4) [q_x, q_y, q_z, q_w] quaternions
+    ----------
+    Returns:
+        rot_mtxs {np.array}: (N,3,3) rotation matrices
+    """
+    quats = np.reshape(quats, (-1, 4)).astype(np.float64)
+    quats = quats / np.linalg.norm(quats, axis=1)[:, np.newaxis]
+    x, y, z, w = quats[:, 0], quats[:, 1], quats[:, 2], quats[:, 3]
+
+    rot_mtxs = np.empty((len(quats), 3, 3))
+    rot_mtxs[:, 0, 0] = 1 - 2 * (y * y + z * z)
+    rot_mtxs[:, 0, 1] = 2 * (x * y - z * w)
+    rot_mtxs[:, 0, 2] = 2 * (x * z + y * w)
+    rot_mtxs[:, 1, 0] = 2 * (x * y + z * w)
+    rot_mtxs[:, 1, 1] = 1 - 2 * (x * x + z * z)
+    rot_mtxs[:, 1, 2] = 2 * (y * z - x * w)
+    rot_mtxs[:, 2, 0] = 2 * (x * z - y * w)
+    rot_mtxs[:, 2, 1] = 2 * (y * z + x * w)
+    rot_mtxs[:, 2, 2] = 1 - 2 * (x * x + y * y)
+    return rot_mtxs
+
+def matrices_to_quaternions(rot_mtxs):
+    """
+    Converts a stack of rotation matrices to quaternions (Shepperd's method).
+    ----------
+    Args:
+        rot_mtxs {np.array}: (N,3,3) or (N,4,4) rotation matrices
+    ----------
+    Returns:
+        quats {np.array}: (N,4) [q_x, q_y, q_z, q_w] quaternions
+    """
+    R = np.asarray(rot_mtxs, dtype=np.float64)[:, 0:3, 0:3]
+    trace = R[:, 0, 0] + R[:, 1, 1] + R[:, 2, 2]
+    diag = np.stack([R[:, 0, 0], R[:, 1, 1], R[:, 2, 2], trace], axis=1)
+    case = np.argmax(diag, axis=1)
+
+    quats = np.empty((len(R), 4))
+    # Largest component is w
+    m = case == 3
+    s = 2 * np.sqrt(1 + trace[m])
+    quats[m, 0] = (R[m, 2, 1] - R[m, 1, 2]) / s
+    quats[m, 1] = (R[m, 0, 2] - R[m, 2, 0]) / s
+    quats[m, 2] = (R[m, 1, 0] - R[m, 0, 1]) / s
+    quats[m, 3] = 0.25 * s
+    # Largest component is x
+    m = case == 0
+    s = 2 * np.sqrt(1 + R[m, 0, 0] - R[m, 1, 1] - R[m, 2, 2])
+    quats[m, 0] = 0.25 * s
+    quats[m, 1] = (R[m, 0, 1] + R[m, 1, 0]) / s
+    quats[m, 2] = (R[m, 0, 2] + R[m, 2, 0]) / s
+    quats[m, 3] = (R[m, 2, 1] - R[m, 1, 2]) / s
+    # Largest component is y
+    m = case == 1
+    s = 2 * np.sqrt(1 + R[m, 1, 1] - R[m, 0, 0] - R[m, 2, 2])
+    quats[m, 0] = (R[m, 0, 1] + R[m, 1, 0]) / s
+    quats[m, 1] = 0.25 * s
+    quats[m, 2] = (R[m, 1, 2] + R[m, 2, 1]) / s
+    quats[m, 3] = (R[m, 0, 2] - R[m, 2, 0]) / s
+    # Largest component is z
+    m = case == 2
+    s = 2 * np.sqrt(1 + R[m, 2, 2] - R[m, 0, 0] - R[m, 1, 1])
+    quats[m, 0] = (R[m, 0, 2] + R[m, 2, 0]) / s
+    quats[m, 1] = (R[m, 1, 2] + R[m, 2, 1]) / s
+    quats[m, 2] = 0.25 * s
+    quats[m, 3] = (R[m, 1, 0] - R[m, 0, 1]) / s
+    return quats
+
+def quat_trans_to_matrices(trans, quats):
+    """
+    Converts stacked translations and quaternions to (N,4,4) homogeneous matrices.
+    """
+    matrices = np.zeros((len(quats), 4, 4))
+    matrices[:, 0:3, 0:3] = quaternions_to_matrices(quats)
+    matrices[:, 0:3, 3] = trans
+    matrices[:, 3, 3] = 1.0
+    return matrices
+
+def matrices_to_quat_trans(matrices):
+    """
+    Converts (N,4,4) homogeneous matrices to stacked translations and quaternions.
+    """
+    return np.array(matrices[:, 0:3, 3]), matrices_to_quaternions(matrices)
+
+def consensus_inliers(transforms_trans, transforms_rot, max_translation=0.02, max_rotation=0.2,
+                      preferred=None):
+    """
+    Exhaustive consensus over candidate poses: every candidate is a hypothesis and the
+    one that most other candidates agree with (in translation and rotation) wins.
+    Ties go to the tightest cluster, then to the preferred candidates. Two candidates
+    that disagree with no preference between them are both kept.
+    ----------
+    Args:
+        transforms_trans {np.array}: (N,3) candidate translations
+        transforms_rot {np.array}: (N,4) candidate quaternions
+        max_translation {float}: Maximum distance between agreeing candidates in m
+        max_rotation {float}: Maximum rotation angle between agreeing candidates in rad
+        preferred {np.array}: (N,) mask of the candidates to trust on a tie, e.g. the main marker
+    ----------
+    Returns:
+        inliers {np.array}: (N,) mask of the candidates agreeing with the best hypothesis
+    """
+    transforms_trans = np.reshape(transforms_trans, (-1, 3))
+    transforms_rot = np.reshape(transforms_rot, (-1, 4))
+    # |q_i . q_j| = cos(angle / 2), compared without arccos
+    quat_dots = np.abs(np.dot(transforms_rot, transforms_rot.T))
+    diff = transforms_trans[:, np.newaxis, :] - transforms_trans[np.newaxis, :, :]
+    dist2 = np.einsum("ijk,ijk->ij", diff, diff)
+    agree = (dist2 <= max_translation ** 2) & (quat_dots >= np.cos(max_rotation / 2.0))
+
+    if preferred is None:
+        preferred = np.zeros(len(transforms_rot), dtype=bool)
+    preferred = np.reshape(preferred, -1).astype(bool)
+    if len(transforms_rot) == 2 and not agree[0, 1] and preferred[0] == preferred[1]:
+        # Nothing tells which one is wrong
+        return np.ones(2, dtype=bool)
+
+    # Most agreeing candidates first, then the tightest cluster, then the preferred ones
+    support = np.count_nonzero(agree, axis=1)
+    spread = np.sum(np.where(agree, dist2, 0.0), axis=1)
+    best = np.lexsort((~preferred, spread, -support))[0]
+    return agree[best]
+
+def average_object_candidates(transforms_trans, transforms_rot, max_translation=0.02, max_rotation=0.2,
+                              preferred=None):
+    """
+    Find the candidate poses that agree with each other and average them.
+    ----------
+    Args:
+        transforms_trans {np.array}: (N,3) candidate translations
+        transforms_rot {np.array}: (N,4) candidate quaternions
+        max_translation {float}: Maximum distance between agreeing candidates in m
+        max_rotation {float}: Maximum rotation angle between agreeing candidates in rad
+        preferred {np.array}: (N,) mask of the candidates to trust on a tie, e.g. the main marker
+    ----------
+    Returns:
+        avg_trans {np.array}: [t_x, t_y, t_z] averaged translation of the inliers, None if there are no candidates
+        avg_rot {np.array}: [q_x, q_y, q_z, q_w] averaged quaternion of the inliers, None if there are no candidates
+        inliers {np.array}: (N,) mask of the candidates used
+    """
+    if len(transforms_rot) == 0:
+        return None, None, np.zeros(0, dtype=bool)
+
+    inliers = consensus_inliers(transforms_trans, transforms_rot, max_translation, max_rotation, preferred)
+    transforms_trans = np.reshape(transforms_trans, (-1, 3))[inliers]
+    transforms_rot = np.reshape(transforms_rot, (-1, 4))[inliers]
+
+    if len(transforms_rot) > 1:
+        avg_rot = average_quaternions(transforms_rot)
+        avg_trans = np.average(transforms_trans, axis=0)
+    else:
+        avg_rot = transforms_rot[0]
+        avg_trans = transforms_trans[0]
+    return avg_trans, avg_rot, inliers